@@ -35,7 +35,9 @@ class PersonSerializer(serializers.ModelSerializer):
             'dmed_master_data_id',
             'dmed_region',
             'url',
-            'markers'
+            'markers',
+            'temperature',
+            'temperature_at',
         ]
         read_only_fields = [
             'dmed_id', 'dmed_rpn_id', 'dmed_master_data_id', 'dmed_region', 'temperature'
@@ -45,6 +47,8 @@ class PersonSerializer(serializers.ModelSerializer):
     iin = serializers.CharField(label='ИИН / ID документа', required=False)
     url = serializers.HyperlinkedIdentityField(view_name='person-detail', read_only=True)
     markers = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
+    temperature = serializers.FloatField(read_only=True)
+    temperature_at = serializers.DateTimeField(read_only=True)
 
 
 class RegionSerializer(serializers.ModelSerializer):
@@ -65,6 +69,7 @@ class CheckPointPassSerializer(serializers.ModelSerializer):
         fields = [
             'id',
             'person',  # legacy
+            'temperature',  # legacy
             'source_place',
             'destination_place',
             'add_date',
@@ -74,6 +79,7 @@ class CheckPointPassSerializer(serializers.ModelSerializer):
         read_only_fields = ['add_date', 'inspector', 'checkpoint']
 
     person = serializers.PrimaryKeyRelatedField(queryset=Person.objects.all())
+    temperature = serializers.FloatField(read_only=True)
 
     def create(self, validated_data):
         # legacy: работаем со списком анкет как с одной анкетой
@@ -1,3 +1,130 @@
+import json
+import uuid
+
 from django.test import TestCase
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from core import auth, dmedstub, metrics
+from core.testing import DMEDStubMixin, QueryBudgetMixin, seed
+
+
+class QueryBudgetTestCase(DMEDStubMixin, QueryBudgetMixin, TestCase):
+    """Число SQL-запросов и время каждого эндпоинта api на объёмах, близких к боевым"""
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.s = seed()
+        cls.person = cls.s.persons[0]
+        cls.checkpoint_pass = cls.s.passes[0]
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {auth.issue(self.s.inspector).key}')
+
+    def test_root(self):
+        self.assertGetBudget('/api/', 0)
+
+    def test_person_list(self):
+        # весь реестр без пагинации (legacy): страна, люди с температурой, маркеры
+        self.assertGetBudget('/api/person/', 2, seconds=2)
+
+    def test_person_search(self):
+        self.assertGetBudget('/api/person/', 2, iin=self.person.doc_id)
+        self.assertGetBudget('/api/person/', 2, search='ЧЕЛОВЕК 1')
+
+    def test_person_detail(self):
+        self.assertGetBudget(f'/api/person/{self.person.pk}/', 2)
+
+    def test_person_by_iin(self):
+        self.person.dmed_updated_at = timezone.now()
+        self.person.dmed_id = 1
+        self.person.save()
+        self.assertGetBudget(f'/api/person/{self.person.doc_id}/', 3)
+
+    def test_person_by_new_iin(self):
+        # анкеты нет: создание и поиск в DMED (имитатор), статистика опроса - в своей точке сохранения
+        iin = dmedstub.random_iin()
+        with self.assertBudget(22, seconds=2):
+            r = self.client.get(f'/api/person/{iin}/')
+        self.assertEqual(r.status_code, 200)
+
+    def test_person_by_new_iin_metrics(self):
+        # поиск в DMED идёт в потоках пула, но учитывается в метриках запроса
+        def dmed_calls():
+            return sum(v for (name, labels), v in metrics.registry.counters.items() if name == 'dmed_calls_total')
+
+        before = dmed_calls()
+        r = self.client.get(f'/api/person/{dmedstub.random_iin()}/')
+        self.assertEqual(r.status_code, 200)
+        self.assertGreater(dmed_calls(), before)
+
+    def test_checkpoint_pass_list(self):
+        self.assertGetBudget('/api/checkpoint-pass/', 1)
+
+    def test_checkpoint_pass_detail(self):
+        self.assertGetBudget(f'/api/checkpoint-pass/{self.checkpoint_pass.pk}/', 1)
+
+    def test_checkpoint_list(self):
+        self.assertGetBudget('/api/checkpoint/', 1)
+
+    def test_checkpoint_detail(self):
+        self.assertGetBudget(f'/api/checkpoint/{self.s.checkpoint.pk}/', 1)
+
+    def test_marker_list(self):
+        self.assertGetBudget('/api/marker/', 2)
+
+    def test_marker_detail(self):
+        self.assertGetBudget(f'/api/marker/{self.s.markers[0].pk}/', 2)
+
+    def test_region_list(self):
+        self.assertGetBudget('/api/region/', 1)
+
+    def test_region_detail(self):
+        self.assertGetBudget(f'/api/region/{self.s.region.pk}/', 1)
+
+    def test_country_list(self):
+        self.assertGetBudget('/api/country/', 1)
+
+    def test_country_detail(self):
+        self.assertGetBudget(f'/api/country/{self.s.kz.pk}/', 1)
+
+    def test_inspector(self):
+        self.assertGetBudget('/api/inspector', 0)
+
+
+class WebhookBudgetTestCase(QueryBudgetMixin, TestCase):
+    """Вебхук только ставит события в очередь: один INSERT на запрос, сколько бы событий ни пришло"""
+    client_class = APIClient
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.s = seed(captures=100)
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {auth.issue(self.s.admin).key}')
+        self.client.get('/api/inspector')  # прогревает кэш токена и пользователя
+
+    def event(self):
+        return {
+            'id': uuid.uuid4().hex,
+            'body': {
+                'source': self.s.camera.location,
+                'number': '001AAA00',
+                'latlng': [51.1, 71.4],
+                'iins': [{'iin': p.doc_id} for p in self.s.persons[:2]],
+                'raw': {'event': {'uuid': str(uuid.uuid4()), 'time': '2020-05-12T10:00:00.000+0600'}},
+            },
+        }
+
+    def test_webcam(self):
+        with self.assertBudget(1):
+            r = self.client.post('/api/webhook/webcam', json.dumps(self.event()), content_type='application/json')
+        self.assertEqual(r.status_code, 202)
 
-# Create your tests here.
+    def test_webcam_batch(self):
+        events = [self.event() for _ in range(50)]
+        with self.assertBudget(1):
+            r = self.client.post('/api/webhook/webcam/batch', json.dumps(events), content_type='application/json')
+        self.assertEqual(r.status_code, 202)
+        self.assertEqual(r.data['accepted'], 50)
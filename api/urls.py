@@ -18,4 +18,5 @@ urlpatterns = [
     path('inspector', viewsets.InspectorViewSet.as_view({'get': 'retrieve', 'put': 'update', 'patch': 'partial_update'})),
     path('auth/', include('rest_framework.urls', namespace='rest_framework')),
     path('webhook/webcam', views.WebcamWebhook.as_view()),
+    path('webhook/webcam/batch', views.WebcamBatchWebhook.as_view()),
 ]
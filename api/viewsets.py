@@ -1,6 +1,4 @@
-import threading
-
-from django.conf import settings
+from django.db.models import Prefetch
 from django.http import Http404
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import permissions, viewsets, mixins
@@ -8,9 +6,9 @@ from rest_framework.filters import SearchFilter
 from rest_framework.generics import get_object_or_404
 
 from api import serializers as ss
-from core.models import Country, Region, Checkpoint, CheckpointPass, Person, CITIZENSHIPS_KZ, CITIZENSHIP_KZ, Marker, \
+from core.models import Country, Region, Checkpoint, CheckpointPass, Person, CITIZENSHIPS_KZ, Marker, \
     User
-from core.service import DMEDService
+from core import authz, dmed, refdata
 from core.validators import is_iin
 import logging
 
@@ -18,7 +16,20 @@ import logging
 log = logging.getLogger(__name__)
 
 
-class DjangoStrictModelPermissions(permissions.DjangoModelPermissions):
+class DjangoCachedModelPermissions(permissions.DjangoModelPermissions):
+    """права проверяются по снимку core.authz, без запросов к базе"""
+
+    def has_permission(self, request, view):
+        if getattr(view, '_ignore_model_permissions', False):
+            return True
+        if not request.user or (not request.user.is_authenticated and self.authenticated_users_only):
+            return False
+        queryset = self._queryset(view)
+        perms = self.get_required_permissions(request.method, queryset.model)
+        return authz.of(request).has_perms(perms)
+
+
+class DjangoStrictModelPermissions(DjangoCachedModelPermissions):
     """с проверкой на разрешение на просмотр модели"""
     perms_map = {
         'GET': ['%(app_label)s.view_%(model_name)s'],
@@ -37,7 +48,7 @@ class InspectorViewSet(mixins.RetrieveModelMixin, mixins.UpdateModelMixin, views
     queryset = User.objects.filter(groups__name='inspectors')
 
     def get_object(self):
-        if self.request.user.groups.filter(name='inspectors').exists():
+        if authz.of(self.request).is_inspector:
             return self.request.user
         raise Http404
 
@@ -72,14 +83,14 @@ class CheckpointViewSet(viewsets.ModelViewSet):
 
 class CheckpointPassViewSet(viewsets.ModelViewSet):
     """Запись о прохождении КПП"""
-    queryset = CheckpointPass.objects.all().order_by('-add_date')
+    queryset = CheckpointPass.objects.with_legacy_person().order_by('-add_date')
     serializer_class = ss.CheckPointPassSerializer
     permission_classes = [DjangoStrictModelPermissions]
 
 
 class PersonViewSet(viewsets.ModelViewSet):
     """Анкета человека"""
-    queryset = Person.objects.all().order_by('-add_date')
+    queryset = Person.objects.with_temperature().prefetch_related('markers').order_by('-add_date')
     serializer_class = ss.PersonSerializer
     permission_classes = [permissions.IsAuthenticated, DjangoStrictModelPermissions]
     filter_backends = [SearchFilter]
@@ -115,56 +126,12 @@ class PersonViewSet(viewsets.ModelViewSet):
             return super(PersonViewSet, self).retrieve(request, *args, **kwargs)
 
         # это ИИН
-        # находим существующую или создаём свежую анкету
-        p, created = Person.objects.get_or_create(
-            doc_id=kwargs['pk'],
-            citizenship__in=CITIZENSHIPS_KZ,
-            defaults={
-                'citizenship': Country.objects.get(pk=CITIZENSHIP_KZ)
-            }
-        )
-        if p.dmed_id:
-            # инфа уже была получена, не делаем внешний запрос
-            return super(PersonViewSet, self).retrieve(request, *args, **kwargs)
-
-        # ищем в dmed и сохраняем
-        # запускаем параллельно
-        threads = []
-        for region in Region.objects.filter(dmed_url__isnull=False).order_by('dmed_priority'):
-            t = threading.Thread(target=self.update_person_from_damu, args=(p, region))
-            threads.append(t)
-
-        while threads:
-            # запускаем поиск в 2 потока
-            chunk, threads = threads[:2], threads[2:]
-            for t in chunk:
-                t.start()
-
-            # ждём когда закончат
-            for t in chunk:
-                t.join()
-                if p.dmed_id:
-                    break
-
-            if p.dmed_id:
-                break
+        # находим существующую или создаём свежую анкету, и ищем её в dmed, если ещё не искали
+        dmed.ensure_person(kwargs['pk'], checkpoint=refdata.checkpoint(request.user.checkpoint_id))
 
         # возвращаем как есть
         return super(PersonViewSet, self).retrieve(request, *args, **kwargs)
 
-    @staticmethod
-    def update_person_from_damu(p: Person, region: Region):
-        dmed = DMEDService(url=region.dmed_url, username=settings.DMED_LOGIN, password=settings.DMED_PASSWORD)
-        updated = dmed.update_person(p)
-        if updated:
-            # если апдейт успешен, сохраняем анкету
-            p.dmed_region = region  # запомним откуда получили информацию
-            p.save()
-            updated = dmed.update_person_detail(p)
-            if updated:
-                p.save()
-            dmed.update_person_markers(p)
-
     def update(self, request, *args, **kwargs):
         log.info(f'rq body: {request.body}')
         return super(PersonViewSet, self).update(request, *args, **kwargs)
@@ -185,6 +152,9 @@ class PersonViewSet(viewsets.ModelViewSet):
 
 class PersonMarkerViewSet(viewsets.ModelViewSet):
     """Все маркеры анкеты человека"""
-    queryset = Marker.objects.all().order_by('-add_date')
+    # в ответе только id людей
+    queryset = Marker.objects.prefetch_related(
+        Prefetch('persons', queryset=Person.objects.only('id'))
+    ).order_by('-add_date')
     serializer_class = ss.MarkerSerializer
     permission_classes = [DjangoStrictModelPermissions]
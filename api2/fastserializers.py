@@ -0,0 +1,153 @@
+"""Быстрая сериализация списков захватов и проходов: строки .values() в dict без объектов моделей и DRF
+
+DRF на каждой строке создаёт объект модели, обходит поля сериализатора и вызывает to_representation каждого,
+в том числе вложенного PersonSerializer - на страницах по 100 захватов это большая часть процессорного времени
+запроса. FastSerializer один раз разбирает поля DRF-сериализатора и генерирует функцию, которая собирает
+тот же JSON прямо из строки .values(): простые значения берутся как есть, даты и uuid - через to_representation
+полей DRF (формат и часовой пояс те же), вложенные сериализаторы (camera, vehicle) - из колонок связанных таблиц,
+вложенные списки (persons) - одним запросом на страницу.
+
+Только для чтения списков (FastListMixin.list). Настройка API_FAST_SERIALIZERS и параметр запроса
+?serializer=drf|fast переключают на сериализаторы DRF и обратно - для сверки ответов.
+"""
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from rest_framework import serializers
+from rest_framework.response import Response
+
+from core import models
+from . import serializers as ss
+
+SERIALIZER_QUERY_PARAM = 'serializer'
+
+# поля, у которых to_representation не меняет значение из базы
+PLAIN_FIELDS = (
+    serializers.BooleanField, serializers.CharField, serializers.ChoiceField, serializers.FloatField,
+    serializers.IntegerField, serializers.PrimaryKeyRelatedField, serializers.ReadOnlyField,
+)
+
+
+class FastSerializer:
+    """Строки .values() в форме ModelSerializer serializer_class
+
+    :param queryset: откуда брать строки, если сериализатор вложен списком (children другого)
+    :param sources: {поле: имя в .values()} для полей, которые в выборке аннотированы под другим именем
+    :param children: {поле-список: FastSerializer} для вложенных списков (many=True)
+    """
+
+    def __init__(self, serializer_class, queryset=None, sources=None, children=None):
+        self.serializer_class = serializer_class
+        self.model = serializer_class.Meta.model
+        self.queryset = queryset
+        self.sources = sources or {}
+        self.children = children or {}
+        self.names = None
+        self._links = {}  # вложенный список -> имя обратной связи для фильтра его выборки
+        self._build = None
+
+    def compile(self):
+        if self._build is not None:
+            return
+        names, consts = [], {}
+
+        def column(name):
+            if name not in names:
+                names.append(name)
+            return repr(name)
+
+        def const(value):
+            name = f'c{len(consts)}'
+            consts[name] = value
+            return name
+
+        def expr(serializer, prefix, nested):
+            items = []
+            for name, field in serializer.fields.items():
+                if field.write_only:
+                    continue
+                if isinstance(field, serializers.ListSerializer):
+                    if nested or name not in self.children:
+                        raise ImproperlyConfigured(f'{self.serializer_class.__name__}.{name}: unsupported list')
+                    self._links[name] = self.model._meta.get_field(field.source).related_query_name()
+                    value = f'many[{name!r}].get(row[{column(self.model._meta.pk.attname)}], [])'
+                elif isinstance(field, serializers.Serializer):
+                    lookup = f'{prefix}{field.source}__'
+                    pk = column(lookup + field.Meta.model._meta.pk.name)
+                    value = f'None if row[{pk}] is None else {expr(field, lookup, True)}'
+                elif isinstance(field, PLAIN_FIELDS):
+                    value = f'row[{column(prefix + self.sources.get(name, field.source))}]'
+                elif isinstance(field, (serializers.RelatedField, serializers.SerializerMethodField)):
+                    raise ImproperlyConfigured(f'{self.serializer_class.__name__}.{name}: unsupported field')
+                else:
+                    col = column(prefix + self.sources.get(name, field.source))
+                    value = f'None if row[{col}] is None else {const(field.to_representation)}(row[{col}])'
+                items.append(f'{name!r}: {value}')
+            return '{' + ', '.join(items) + '}'
+
+        code = f'def build(row, many):\n    return {expr(self.serializer_class(), "", False)}\n'
+        exec(code, consts)
+        self.names = names
+        self._build = consts['build']
+
+    def values(self, queryset, *extra):
+        """queryset строками для serialize(); extra - ещё колонки (например, ключ пагинации)"""
+        self.compile()
+        return queryset.prefetch_related(None).values(*dict.fromkeys(self.names + list(extra)))
+
+    def serialize(self, rows):
+        """Список dict, как serializer_class(many=True).data"""
+        self.compile()
+        rows = list(rows)
+        many = {name: self.fetch(name, child, rows) for name, child in self.children.items()}
+        build = self._build
+        return [build(row, many) for row in rows]
+
+    def fetch(self, name, child, rows):
+        """{pk строки: [вложенные dict]} одним запросом"""
+        ids = [row[self.model._meta.pk.attname] for row in rows]
+        if not ids:
+            return {}
+        child.compile()
+        link = self._links[name]
+        groups = defaultdict(list)
+        for row in child.queryset.filter(**{f'{link}__in': ids}).values(link, *child.names):
+            groups[row[link]].append(child._build(row, {}))
+        return groups
+
+
+persons = FastSerializer(
+    ss.PersonSerializer,
+    queryset=models.Person.objects.with_temperature(),
+    sources={'temperature': 'last_temperature', 'temperature_at': 'last_temperature_at'},
+)
+camera_captures = FastSerializer(ss.CameraCaptureSerializer, children={'persons': persons})
+checkpoint_passes = FastSerializer(ss.CheckPointPassSerializer, children={'persons': persons})
+
+
+def enabled(request):
+    """Быстрая сериализация для запроса: по ?serializer=drf|fast, иначе по настройке API_FAST_SERIALIZERS"""
+    value = request.query_params.get(SERIALIZER_QUERY_PARAM)
+    if value in ('drf', 'fast'):
+        return value == 'fast'
+    return settings.API_FAST_SERIALIZERS
+
+
+class FastListMixin:
+    """list() через fast_serializer, если он включён для запроса"""
+    fast_serializer = None  # type: FastSerializer
+
+    def list(self, request, *args, **kwargs):
+        if not enabled(request):
+            return super().list(request, *args, **kwargs)
+
+        # колонки ключа постраничной выдачи (api2.pagination) - в строках
+        keys = [f.lstrip('-') for f in getattr(self.paginator, 'ordering', ()) + getattr(
+            self.paginator, 'since_ordering', ()
+        )]
+        queryset = self.fast_serializer.values(self.filter_queryset(self.get_queryset()), *keys)
+        page = self.paginate_queryset(queryset)
+        if page is not None:
+            return self.get_paginated_response(self.fast_serializer.serialize(page))
+        return Response(self.fast_serializer.serialize(queryset))
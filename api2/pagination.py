@@ -0,0 +1,145 @@
+"""Постраничная выдача очередей инспектора по ключу (keyset)
+
+Вместо COUNT(*) и OFFSET страница выбирается условием "строки после ключа последней показанной строки"
+по составному индексу, поэтому её стоимость не зависит от длины истории.
+
+Режимы (по параметрам запроса):
+    ?cursor=        - первая страница в порядке ordering, в ответе next - ссылка на следующую
+    ?cursor=<ключ>  - следующая страница
+    ?since=<ключ>   - строки, созданные или изменённые после ключа (по add_date, id), от старых к новым;
+                      для опроса: в каждом ответе since - ключ, с которым спрашивать в следующий раз
+    без cursor и since - прежняя выдача по номеру страницы (page, count), для старых клиентов
+"""
+import base64
+import json
+from collections import OrderedDict
+from datetime import datetime
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+
+
+class KeysetPagination(BasePagination):
+    ordering = ('-add_date', '-id')  # все поля в одном направлении
+    since_ordering = ('add_date', 'id')
+    page_size = 10
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    since_query_param = 'since'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        params = request.query_params
+        if self.cursor_query_param not in params and self.since_query_param not in params:
+            self.legacy = LegacyPagination(self)
+            return self.legacy.paginate_queryset(queryset, request, view)
+        self.legacy = None
+
+        size = self.get_page_size(request)
+        self.polling = self.since_query_param in params
+        ordering = self.since_ordering if self.polling else self.ordering
+        token = params[self.since_query_param if self.polling else self.cursor_query_param]
+        key = self.decode(queryset.model, ordering, token) if token else None
+
+        q = queryset.order_by(*ordering)
+        if key is not None:
+            q = q.filter(after(ordering, key))
+        rows = list(q[:size + 1])
+        self.has_next = len(rows) > size
+        rows = rows[:size]
+
+        self.next_key = self.key(rows[-1], ordering) if rows and self.has_next else None
+        if self.polling:
+            self.since = self.key(rows[-1], ordering) if rows else key
+        elif key is None:
+            # первая страница: опрашивать новое - начиная с самой свежей строки всей выборки
+            # только ключ, без prefetch_related выборки
+            latest = queryset.prefetch_related(None).order_by(
+                *(f'-{f}' for f in self.since_ordering)
+            ).values_list(*self.since_ordering).first()
+            self.since = list(latest) if latest else None
+        else:
+            self.since = None
+        return rows
+
+    def get_paginated_response(self, data):
+        if self.legacy:
+            return self.legacy.get_paginated_response(data)
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('since', self.encode(self.since) if self.since is not None else None),
+            ('results', data),
+        ]))
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def get_next_link(self):
+        if self.next_key is None:
+            return None
+        url = self.request.build_absolute_uri()
+        param = self.since_query_param if self.polling else self.cursor_query_param
+        url = remove_query_param(url, self.cursor_query_param if self.polling else self.since_query_param)
+        return replace_query_param(url, param, self.encode(self.next_key))
+
+    @staticmethod
+    def key(obj, ordering):
+        # obj - объект модели или строка .values() (api2.fastserializers)
+        if isinstance(obj, dict):
+            return [obj[f.lstrip('-')] for f in ordering]
+        return [getattr(obj, f.lstrip('-')) for f in ordering]
+
+    @staticmethod
+    def encode(key):
+        values = [v.isoformat() if isinstance(v, datetime) else str(v) for v in key]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+    def decode(self, model, ordering, token):
+        try:
+            values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+            if len(values) != len(ordering):
+                raise ValueError
+            return [model._meta.get_field(f.lstrip('-')).to_python(v) for f, v in zip(ordering, values)]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+
+def after(ordering, key):
+    """Условие "строка идёт после key" в порядке ordering: (a, b, c) > (x, y, z) в виде, понятном ORM
+
+    Дополнительное условие на первое поле (a >= x) позволяет Postgres сразу ограничить диапазон индекса.
+    """
+    names = [f.lstrip('-') for f in ordering]
+    ops = ['lt' if f.startswith('-') else 'gt' for f in ordering]
+    q = Q()
+    for i in range(len(names)):
+        q |= Q(**{n: v for n, v in zip(names[:i], key[:i])}, **{f'{names[i]}__{ops[i]}': key[i]})
+    first = f'{names[0]}__{ops[0]}e'
+    return Q(**{first: key[0]}) & q
+
+
+class LegacyPagination(PageNumberPagination):
+    def __init__(self, keyset):
+        self.page_size = keyset.page_size
+        self.page_size_query_param = keyset.page_size_query_param
+        self.max_page_size = keyset.max_page_size
+
+
+class CapturePagination(KeysetPagination):
+    """Захваты камеры: от новых к старым"""
+    ordering = ('-add_date', '-id')
+
+
+class PassQueuePagination(KeysetPagination):
+    """Проходы КПП: сначала непроверенные, начиная с самых старых"""
+    ordering = ('status', 'add_date', 'id')
@@ -80,6 +80,8 @@ class PersonSerializer(serializers.ModelSerializer):
             'dmed_id', 'dmed_rpn_id', 'dmed_master_data_id', 'dmed_region', 'temperature'
         ]
     citizenship = serializers.PrimaryKeyRelatedField(queryset=models.Country.objects.all(), required=False)
+    temperature = serializers.FloatField(read_only=True)
+    temperature_at = serializers.DateTimeField(read_only=True)
     # markers = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
 
 
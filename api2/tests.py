@@ -0,0 +1,380 @@
+import base64
+import uuid
+from datetime import date
+from unittest import mock
+
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
+from django.utils import timezone
+from rest_framework.test import APITestCase
+
+from core import auth, dmedstub, ingest, models
+from core.testing import DMEDStubMixin, QueryBudgetMixin, seed
+
+
+class ListQueriesTestCase(APITestCase):
+    """Списки захватов и проходов КПП выполняются за постоянное число запросов, независимо от размера страницы"""
+
+    @classmethod
+    def setUpTestData(cls):
+        models.Country.objects.get_or_create(pk=models.CITIZENSHIP_KZ)
+        cls.checkpoint = models.Checkpoint.objects.create(id='cp1', name='КПП 1')
+        cls.camera = models.Camera.objects.create(location='cam1', checkpoint=cls.checkpoint)
+        cls.user = models.User.objects.create_superuser('inspector', 'inspector@example.com', 'x')
+        cls.user.checkpoint = cls.checkpoint
+        cls.user.save()
+
+        for i in range(30):
+            vehicle = models.Vehicle.objects.create(grnz=f'{i:03}AAA01')
+            persons = [models.Person.objects.create(doc_id=f'{i}{j}') for j in range(3)]
+            for p in persons:
+                markers = [models.Marker.objects.get_or_create(id=m, defaults={'name': f'm{m}'})[0] for m in range(2)]
+                p.markers.add(*markers)
+            capture = models.CameraCapture.objects.create(
+                id=uuid.uuid4(), camera=cls.camera, vehicle=vehicle, date=timezone.now(), raw_data='{}'
+            )
+            capture.persons.add(*persons)
+            capture.create_or_update_checkpoint_pass(cls.user)
+            if i % 2:
+                for p in persons:
+                    models.PersonPassData.objects.filter(
+                        person=p, checkpoint_pass=capture.checkpoint_pass
+                    ).update(temperature=36.6)
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def assertListQueries(self, url, num):
+        self.client.get(url)  # снимок прав пользователя (core.authz) собирается первым запросом
+        for page_size in (5, 30):
+            with self.assertNumQueries(num):
+                r = self.client.get(url, {'page_size': page_size})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(len(r.data['results']), page_size)
+
+    def test_camera_captures(self):
+        # count, страница с камерами и машинами, люди
+        self.assertListQueries(f'/api/v2/inspector/checkpoint/cameras/{self.camera.pk}/captures/', 3)
+
+    def test_checkpoint_passes(self):
+        # count, страница с захватами, люди
+        self.assertListQueries('/api/v2/inspector/checkpoint/passes/', 3)
+
+    def test_checkpoint_pass_persons_temperature(self):
+        r = self.client.get('/api/v2/inspector/checkpoint/passes/', {'page_size': 30})
+        temperatures = sorted(p['temperature'] or 0 for cp in r.data['results'] for p in cp['persons'])
+        self.assertEqual(temperatures, [0] * 45 + [36.6] * 45)
+
+    def test_legacy_checkpoint_passes(self):
+        with self.assertNumQueries(1):
+            r = self.client.get('/api/checkpoint-pass/')
+        self.assertEqual(len(r.data), 30)
+        self.assertTrue(all(p['person'] for p in r.data))
+
+    def test_keyset_pages(self):
+        url = f'/api/v2/inspector/checkpoint/cameras/{self.camera.pk}/captures/'
+        seen = []
+        r = self.client.get(url, {'cursor': '', 'page_size': 7})
+        while True:
+            seen += [c['id'] for c in r.data['results']]
+            if not r.data['next']:
+                break
+            with self.assertNumQueries(2):  # страница и люди, без COUNT
+                r = self.client.get(r.data['next'])
+        self.assertEqual(len(seen), 30)
+        self.assertEqual(len(set(seen)), 30)
+
+    def test_keyset_since(self):
+        url = '/api/v2/inspector/checkpoint/passes/'
+        r = self.client.get(url, {'cursor': ''})
+        since = r.data['since']
+        r = self.client.get(url, {'since': since})
+        self.assertEqual(r.data['results'], [])
+        self.assertEqual(r.data['since'], since)
+
+        changed = models.CheckpointPass.objects.order_by('add_date')[:2]
+        for cp in changed:
+            cp.status = models.CheckpointPass.Status.PASSED
+            cp.save()
+        r = self.client.get(url, {'since': since})
+        self.assertEqual([cp['id'] for cp in r.data['results']], [cp.id for cp in changed])
+        self.assertNotEqual(r.data['since'], since)
+
+    def test_legacy_pages(self):
+        r = self.client.get('/api/v2/inspector/checkpoint/passes/', {'page': 2})
+        self.assertEqual(r.data['count'], 30)
+        self.assertEqual(len(r.data['results']), 10)
+
+    def test_camera_captures_pending(self):
+        url = f'/api/v2/inspector/checkpoint/cameras/{self.camera.pk}/captures/'
+        capture = models.CameraCapture.objects.order_by('add_date').first()
+        capture.checkpoint_pass.status = models.CheckpointPass.Status.PASSED
+        capture.checkpoint_pass.save()
+        r = self.client.get(url, {'page_size': 100})
+        self.assertEqual(r.data['count'], 29)
+        self.assertNotIn(str(capture.id), [c['id'] for c in r.data['results']])
+
+        capture.checkpoint_pass.delete()
+        r = self.client.get(url, {'page_size': 100})
+        self.assertEqual(r.data['count'], 30)
+
+    def test_camera_captures_persons_filter(self):
+        url = f'/api/v2/inspector/checkpoint/cameras/{self.camera.pk}/captures/'
+        capture = models.CameraCapture.objects.order_by('add_date').first()
+        capture.persons.clear()
+        r = self.client.get(url, {'persons': '1', 'page_size': 100})
+        self.assertEqual(r.data['count'], 29)
+        r = self.client.get(url, {'persons': '0', 'page_size': 100})
+        self.assertEqual([c['id'] for c in r.data['results']], [str(capture.id)])
+
+    def assertSameAsDRF(self, url, params):
+        """Быстрая сериализация (api2.fastserializers) отдаёт тот же JSON, что и сериализаторы DRF"""
+        responses = []
+        for serializer in ('drf', 'fast'):
+            r = self.client.get(url, dict(params, serializer=serializer)).json()
+            # ссылки отличаются параметром serializer, порядок людей в списке не задан
+            for link in ('next', 'previous'):
+                if link in r:
+                    r[link] = bool(r[link])
+            for row in r['results']:
+                row['persons'].sort(key=lambda p: p['id'])
+            responses.append(r)
+        self.assertEqual(responses[1], responses[0])
+
+    def test_fast_serializers(self):
+        person = models.Person.objects.order_by('id').first()
+        person.birth_date = date(1980, 1, 2)
+        person.sex = models.Person.Sex.FEMALE
+        person.had_contact_with_infected = True
+        person.dmed_id = 1
+        person.dmed_updated_at = timezone.now()
+        person.save()
+        models.Vehicle.objects.filter(grnz='000AAA01').update(model='Camry')
+
+        for params in ({'page_size': 30}, {'cursor': '', 'page_size': 7}, {'page': 2}):
+            self.assertSameAsDRF(f'/api/v2/inspector/checkpoint/cameras/{self.camera.pk}/captures/', params)
+            self.assertSameAsDRF('/api/v2/inspector/checkpoint/passes/', params)
+
+
+class ClaimTestCase(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.checkpoint = models.Checkpoint.objects.create(id='cp1', name='КПП 1')
+        cls.camera = models.Camera.objects.create(location='cam1', checkpoint=cls.checkpoint)
+        cls.user = models.User.objects.create_superuser('inspector', 'inspector@example.com', 'x')
+        cls.user.checkpoint = cls.checkpoint
+        cls.user.save()
+        vehicle = models.Vehicle.objects.create(grnz='001AAA01')
+        cls.captures = []
+        for i in range(3):
+            capture = models.CameraCapture.objects.create(
+                id=uuid.uuid4(), camera=cls.camera, vehicle=vehicle, date=timezone.now(), raw_data='{}'
+            )
+            capture.persons.add(*[models.Person.objects.create(doc_id=f'{i}{j}') for j in range(3)])
+            cls.captures.append(capture)
+
+    def setUp(self):
+        self.client.force_authenticate(self.user)
+
+    def test_claim_drains_queue(self):
+        claimed = []
+        for capture in self.captures:
+            r = self.client.post('/api/v2/inspector/checkpoint/passes/claim/', {'camera': self.camera.pk})
+            self.assertEqual(r.status_code, 200)
+            self.assertEqual(r.data['camera_capture'], capture.pk)
+            self.assertEqual(len(r.data['persons']), 3)
+            claimed.append(r.data['id'])
+        self.assertEqual(len(set(claimed)), 3)
+
+        r = self.client.post('/api/v2/inspector/checkpoint/passes/claim/')
+        self.assertEqual(r.status_code, 204)
+
+    def test_open_twice(self):
+        capture = self.captures[0]
+        first = capture.create_or_update_checkpoint_pass(self.user)
+        # второй инспектор со старым экземпляром захвата
+        second = models.CameraCapture.objects.get(pk=capture.pk)
+        second.checkpoint_pass_id = None
+        self.assertEqual(second.create_or_update_checkpoint_pass(self.user), first)
+        self.assertEqual(models.CheckpointPass.objects.count(), 1)
+        self.assertEqual(models.PersonPassData.objects.filter(checkpoint_pass=first).count(), 3)
+
+
+class AuthTestCase(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = models.User.objects.create_superuser('inspector', 'inspector@example.com', 'secret')
+
+    def setUp(self):
+        cache.clear()
+
+    def get_token(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Basic ' + base64.b64encode(b'inspector:secret').decode())
+        r = self.client.post('/api/v2/auth/token')
+        self.assertEqual(r.status_code, 200)
+        return r.data['token']
+
+    def test_token(self):
+        token = self.get_token()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        self.assertEqual(self.client.get('/api/v2/util/dmed-status').status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/api/v2/util/dmed-status').status_code, 200)
+
+        self.assertEqual(self.client.delete('/api/v2/auth/token').status_code, 204)
+        self.assertEqual(self.client.get('/api/v2/util/dmed-status').status_code, 401)
+
+    def test_token_by_password(self):
+        r = self.client.post('/api/v2/auth/token', {'username': 'inspector', 'password': 'secret'})
+        self.assertEqual(r.data['token'], self.get_token())
+        token = r.data['token']
+        r = self.client.post('/api/v2/auth/token', {'rotate': 1})
+        self.assertNotEqual(r.data['token'], token)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        self.assertEqual(self.client.get('/api/v2/util/dmed-status').status_code, 401)
+
+    def test_basic_cached(self):
+        self.client.credentials(HTTP_AUTHORIZATION='Basic ' + base64.b64encode(b'inspector:secret').decode())
+        self.assertEqual(self.client.get('/api/v2/util/dmed-status').status_code, 200)
+        with mock.patch.object(models.User, 'check_password') as check_password:
+            self.assertEqual(self.client.get('/api/v2/util/dmed-status').status_code, 200)
+        check_password.assert_not_called()
+
+        self.user.set_password('changed')
+        self.user.save()
+        self.assertEqual(self.client.get('/api/v2/util/dmed-status').status_code, 401)
+
+
+class AuthzTestCase(APITestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.checkpoint = models.Checkpoint.objects.create(id='cp1', name='КПП 1')
+        cls.camera = models.Camera.objects.create(location='cam1', checkpoint=cls.checkpoint)
+        cls.group = Group.objects.get_or_create(name='inspectors')[0]
+        cls.group.permissions.add(Permission.objects.get(codename='view_cameracapture'))
+        cls.user = models.User.objects.create_user('inspector', checkpoint=cls.checkpoint)
+        cls.user.groups.add(cls.group)
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_authenticate(self.user)
+
+    def test_snapshot_cached(self):
+        url = f'/api/v2/inspector/checkpoint/cameras/{self.camera.pk}/captures/'
+        self.assertEqual(self.client.get(url).status_code, 200)
+        with self.assertNumQueries(1):  # count, страница пуста
+            self.assertEqual(self.client.get(url).status_code, 200)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get('/api/v2/inspector').status_code, 200)
+
+    def test_invalidation(self):
+        url = f'/api/v2/inspector/checkpoint/cameras/{self.camera.pk}/captures/'
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        self.group.permissions.clear()
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.group.permissions.add(Permission.objects.get(codename='view_cameracapture'))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        self.user.groups.remove(self.group)
+        self.assertEqual(self.client.get('/api/v2/inspector').status_code, 404)
+
+    def test_camera_moved_by_ingest(self):
+        other = models.Checkpoint.objects.create(id='cp2', name='КПП 2')
+        camera = models.Camera.objects.create(location='cam2', checkpoint=other)
+        url = f'/api/v2/inspector/checkpoint/cameras/{camera.pk}/captures/'
+        self.assertEqual(self.client.get(url).data['count'], 0)  # снимок прав без этой камеры
+
+        # EGSV перенёс камеру на КПП инспектора
+        event = {
+            'id': uuid.uuid4().hex,
+            'body': {
+                'source': camera.location, 'number': '001AAA01', 'latlng': [51.1, 71.4],
+                'raw': {'event': {'uuid': str(uuid.uuid4()), 'time': '2020-05-12T10:00:00.000+0600'}},
+            },
+        }
+        with mock.patch.object(ingest, 'fetch_camera_checkpoint', lambda location: self.checkpoint):
+            ingest.process_events([event])
+        self.assertEqual(self.client.get(url).data['count'], 1)
+
+
+class QueryBudgetTestCase(DMEDStubMixin, QueryBudgetMixin, APITestCase):
+    """Число SQL-запросов и время каждого эндпоинта api2 на объёмах, близких к боевым"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.s = seed()
+        cls.person = cls.s.persons[0]
+        cls.checkpoint_pass = next(cp for cp in cls.s.passes if cp.checkpoint_id == cls.s.checkpoint.id)
+        cls.capture = next(c for c in cls.s.captures if c.camera_id == cls.s.camera.id and c.pending)
+        cls.pass_person = cls.checkpoint_pass.personpassdata_set.first().person
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {auth.issue(self.s.inspector).key}')
+
+    def test_inspector(self):
+        self.assertGetBudget('/api/v2/inspector', 0)
+
+    def test_inspector_checkpoint(self):
+        self.assertGetBudget('/api/v2/inspector/checkpoint', 1)
+
+    def test_cameras(self):
+        self.assertGetBudget('/api/v2/inspector/checkpoint/cameras/', 1)
+        self.assertGetBudget(f'/api/v2/inspector/checkpoint/cameras/{self.s.camera.pk}/', 1)
+
+    def test_captures(self):
+        url = f'/api/v2/inspector/checkpoint/cameras/{self.s.camera.pk}/captures/'
+        self.assertGetBudget(url, 3)
+        r = self.assertGetBudget(url, 3, cursor='', page_size=100)
+        self.assertGetBudget(r.data['next'], 2)
+        self.assertGetBudget(url, 3, persons='0')
+        self.assertGetBudget(f'{url}{self.capture.pk}/', 2)
+
+    def test_passes(self):
+        url = '/api/v2/inspector/checkpoint/passes/'
+        self.assertGetBudget(url, 3)
+        r = self.assertGetBudget(url, 3, cursor='', page_size=100)
+        self.assertGetBudget(r.data['next'], 2)
+        self.assertGetBudget(f'{url}{self.checkpoint_pass.pk}/', 2)
+
+    def test_pass_persons(self):
+        url = f'/api/v2/inspector/checkpoint/passes/{self.checkpoint_pass.pk}/persons/'
+        self.assertGetBudget(url, 1)
+        self.assertGetBudget(f'{url}{self.pass_person.pk}/', 1)
+
+    def test_countries(self):
+        self.assertGetBudget('/api/v2/countries/', 1)
+        self.assertGetBudget(f'/api/v2/countries/{self.s.kz.pk}/', 1)
+
+    def test_regions(self):
+        self.assertGetBudget('/api/v2/regions/', 1)
+        self.assertGetBudget(f'/api/v2/regions/{self.s.region.pk}/', 1)
+
+    def test_checkpoints(self):
+        self.assertGetBudget('/api/v2/checkpoints/', 1)
+        self.assertGetBudget(f'/api/v2/checkpoints/{self.s.checkpoint.pk}/', 1)
+
+    def test_vehicles(self):
+        self.assertGetBudget('/api/v2/vehicles/', 2)
+        self.assertGetBudget('/api/v2/vehicles/', 2, search='00')
+        self.assertGetBudget(f'/api/v2/vehicles/{self.s.vehicles[0].pk}/', 1)
+
+    def test_country_persons(self):
+        url = f'/api/v2/countries/{self.s.kz.pk}/persons/'
+        self.assertGetBudget(url, 2)
+        self.assertGetBudget(f'{url}{self.person.doc_id}/', 1)
+
+    def test_country_person_fetch(self):
+        # анкеты нет: создание и поиск в DMED (имитатор), статистика опроса - в своей точке сохранения
+        url = f'/api/v2/countries/{self.s.kz.pk}/persons/{dmedstub.random_iin()}/'
+        with self.assertBudget(22, seconds=2):
+            r = self.client.get(url, {'fetch': 1})
+        self.assertEqual(r.status_code, 200)
+
+    def test_country_person_markers(self):
+        self.assertGetBudget(f'/api/v2/countries/{self.s.kz.pk}/persons/{self.person.doc_id}/markers/', 1)
+
+    def test_util(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {auth.issue(self.s.admin).key}')
+        self.assertGetBudget('/api/v2/util/stats', 5)
+        self.assertGetBudget('/api/v2/util/dmed-status', 0)
@@ -40,5 +40,8 @@ urlpatterns = [
     path('', include(router.urls)),
     path('', include(countries_router.urls)),
     path('', include(persons_router.urls)),
+    path('auth/token', views.AuthToken.as_view()),
     path('util/import-checkpoints-egsv', views.ImportCheckpoints.as_view()),
+    path('util/stats', views.Stats.as_view()),
+    path('util/dmed-status', views.DMEDStatus.as_view()),
 ]
@@ -1,10 +1,12 @@
 import logging
 
-import requests
 from django.shortcuts import render
-from rest_framework import permissions
+from rest_framework import exceptions, permissions, status
+from rest_framework.authtoken.serializers import AuthTokenSerializer
+from rest_framework.response import Response
 from rest_framework.views import APIView
 
+from core import auth, authz, dmed, egsv, health, ingest, refdata, service, stats
 from core.models import Camera, Checkpoint
 
 log = logging.getLogger(__name__)
@@ -21,20 +23,12 @@ class ImportCheckpoints(APIView):
         :return:
         """
 
-        r = requests.get(
-            'https://application-rubezh.egsv.kz/checkpoints?sources=1'
-        ).json()['checkpoints']
-
-        parents = set([c['parent'] for c in r.values() if c['parent']])
+        # заодно обновляет общую топологию, которой пользуется вебхук камер
+        t = egsv.topology.refresh(stale_ok=False)
 
         created_checkpoints = []
         created_cameras = []
-        for cid, c in r.items():
-            if cid in parents:
-                # игнорируем родительские категории
-                log.debug(f'ignoring {cid} - it is parent')
-                continue
-
+        for cid, c in t.leaf_checkpoints():
             checkpoint, created = Checkpoint.objects.update_or_create(pk=cid, defaults={'name': c['name']})
             if created:
                 log.info(f'created checkpoint {checkpoint}')
@@ -46,8 +40,58 @@ class ImportCheckpoints(APIView):
                     created_cameras.append(camera)
                     log.info(f'created camera {camera} for checkpoint {checkpoint}')
                 checkpoint.cameras.add(camera)
+        # привязка камер к КПП прошла через update(), без сигналов
+        authz.invalidate()
 
         return render(request, 'checkpoints-import.html', context={
             'checkpoints': created_checkpoints,
             'cameras': created_cameras
         })
+
+
+class Stats(APIView):
+    """Счётчики сервиса"""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, format=None):
+        s = stats.snapshot(*egsv.STATS, *dmed.STATS)
+        lookups = s['egsv_topology_hits'] + s['egsv_topology_misses']
+        s['egsv_topology_hit_rate'] = s['egsv_topology_hits'] / lookups if lookups else None
+        s['ingest'] = ingest.queue_status()
+        s['dmed_sessions'] = service.sessions.stats()
+        return Response(s)
+
+
+class DMEDStatus(APIView):
+    """Здоровье регионов DMED: выключатели, задержки, ошибки"""
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request, format=None):
+        return Response([
+            dict(id=r.id, name=r.name, url=r.dmed_url, priority=r.dmed_priority, **health.status(r.dmed_url))
+            for r in refdata.dmed_regions()
+        ])
+
+
+class AuthToken(APIView):
+    """Токен для заголовка Authorization: Token <ключ> вместо Basic-аутентификации"""
+    permission_classes = []
+
+    def post(self, request, format=None):
+        """Выдаёт токен пользователю, вошедшему по Basic (или с username и password в теле);
+        rotate=1 - выпускает новый токен, отзывая прежний
+        """
+        user = request.user
+        if not user.is_authenticated:
+            serializer = AuthTokenSerializer(data=request.data, context={'request': request})
+            serializer.is_valid(raise_exception=True)
+            user = serializer.validated_data['user']
+        token = auth.issue(user, rotate=str(request.data.get('rotate', '')) in ('1', 'true'))
+        return Response({'token': token.key, 'created': token.created})
+
+    def delete(self, request, format=None):
+        """Отзывает токен текущего пользователя"""
+        if not request.user.is_authenticated:
+            raise exceptions.NotAuthenticated()
+        auth.revoke(request.user)
+        return Response(status=status.HTTP_204_NO_CONTENT)
@@ -1,18 +1,20 @@
 from datetime import datetime
 
 
-from django.db.models import Q
+from django.db.models import Exists, OuterRef, Prefetch
 from django.http import Http404
 from django.shortcuts import redirect
-from rest_framework import mixins, permissions, viewsets, filters
+from rest_framework import mixins, permissions, status, viewsets, filters
 from rest_framework.decorators import action
 from rest_framework.pagination import PageNumberPagination
+from rest_framework.response import Response
 
-from api.viewsets import DjangoStrictModelPermissions
-from core import models
+from api.viewsets import DjangoCachedModelPermissions, DjangoStrictModelPermissions
+from core import authz, dmed, models, refdata
 from core.models import CheckpointPass, CITIZENSHIPS_KZ
 
-from . import serializers as ss
+from . import fastserializers, serializers as ss
+from .pagination import CapturePagination, PassQueuePagination
 import logging
 
 log = logging.getLogger(__name__)
@@ -24,7 +26,7 @@ class InspectorViewSet(mixins.RetrieveModelMixin, mixins.UpdateModelMixin, views
     queryset = models.User.objects.filter(groups__name='inspectors')
 
     def get_object(self):
-        if self.request.user.groups.filter(name='inspectors').exists():
+        if authz.of(self.request).is_inspector:
             return self.request.user
         raise Http404
 
@@ -36,36 +38,48 @@ class InspectorCheckpointViewSet(mixins.RetrieveModelMixin, mixins.UpdateModelMi
     permission_classes = [permissions.IsAuthenticated]
 
     def get_object(self):
-        if self.request.user.groups.filter(name='inspectors').exists():
+        if authz.of(self.request).is_inspector:
             return self.request.user.checkpoint
         raise Http404
 
 
-class InspectorCheckpointPassViewSet(viewsets.ModelViewSet):
+class InspectorCheckpointPassViewSet(fastserializers.FastListMixin, viewsets.ModelViewSet):
     """записи о прохождении КПП, на котором находится мединспектор"""
-    class Pagination(PageNumberPagination):
-        page_size = 10
-        page_size_query_param = 'page_size'
-        max_page_size = 100
-
-    pagination_class = Pagination
+    pagination_class = PassQueuePagination
     serializer_class = ss.CheckPointPassSerializer
+    fast_serializer = fastserializers.checkpoint_passes
     permission_classes = [DjangoStrictModelPermissions]
 
     def get_queryset(self):
         # сначала непроверенные, начиная с самых старых
         return CheckpointPass.objects.filter(
-            checkpoint=self.request.user.checkpoint,
+            checkpoint_id=self.request.user.checkpoint_id,
+        ).select_related(
+            'camera_capture',
+        ).prefetch_related(
+            Prefetch('persons', queryset=models.Person.objects.with_temperature())
         ).order_by('status', 'add_date')
 
     def create(self, request, *args, **kwargs):
         models.Vehicle.objects.get_or_create(pk=request.data['vehicle'])
         return super(InspectorCheckpointPassViewSet, self).create(request, *args, **kwargs)
 
+    @action(detail=False, methods=['post'])
+    def claim(self, request):
+        """Берёт в досмотр следующий захват с камер КПП (или с одной камеры - camera) и возвращает проход по нему
+
+        Если непринятых захватов нет - 204.
+        """
+        camera_id = request.data.get('camera') or request.query_params.get('camera')
+        checkpoint_pass = models.CameraCapture.claim_next(request.user, camera_id=camera_id)
+        if checkpoint_pass is None:
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        return Response(self.get_serializer(self.get_queryset().get(pk=checkpoint_pass.pk)).data)
+
     def perform_create(self, serializer):
         instance = serializer.save()
         instance.inspector = self.request.user
-        instance.checkpoint = self.request.user.checkpoint
+        instance.checkpoint_id = self.request.user.checkpoint_id
         instance.save()
         return instance
 
@@ -77,9 +91,9 @@ class CheckpointPassPersonViewSet(viewsets.ModelViewSet):
 
     def get_queryset(self):
         return models.PersonPassData.objects.filter(
-            checkpoint_pass__checkpoint=self.request.user.checkpoint,
+            checkpoint_pass__checkpoint_id=self.request.user.checkpoint_id,
             checkpoint_pass=self.kwargs['checkpoint_pass_pk']
-        ).order_by('-add_date')
+        ).select_related('person').order_by('-add_date')
 
     def perform_create(self, serializer):
         p, created = models.Person.objects.get_or_create(
@@ -113,30 +127,32 @@ class CheckpointViewSet(viewsets.ModelViewSet):
 class CheckpointCameraViewSet(viewsets.ModelViewSet):
     """Камеры КПП"""
     serializer_class = ss.CameraSerializer
-    permission_classes = [permissions.DjangoModelPermissions]
+    permission_classes = [DjangoCachedModelPermissions]
 
     def get_queryset(self):
-        return models.Camera.objects.filter(checkpoint=self.request.user.checkpoint)
+        return models.Camera.objects.filter(checkpoint_id=self.request.user.checkpoint_id)
 
 
-class CheckpointCameraCaptureViewSet(viewsets.ReadOnlyModelViewSet):
+class CheckpointCameraCaptureViewSet(fastserializers.FastListMixin, viewsets.ReadOnlyModelViewSet):
     """Захваты с камеры КПП"""
-    class Pagination(PageNumberPagination):
-        page_size = 10
-        page_size_query_param = 'page_size'
-        max_page_size = 100
-
-    pagination_class = Pagination
+    pagination_class = CapturePagination
 
     serializer_class = ss.CameraCaptureSerializer
+    fast_serializer = fastserializers.camera_captures
     permission_classes = [DjangoStrictModelPermissions]
 
     def get_queryset(self):
         # Захваты с одной из камер, относящихся к текущему КПП,
         # по которым ещё не был проведён досмотр
+        if not authz.of(self.request).has_camera(self.kwargs['camera_pk']):
+            return models.CameraCapture.objects.none()
         q = models.CameraCapture.objects.filter(
-            Q(camera=self.request.user.checkpoint.cameras.get(pk=self.kwargs['camera_pk'])),
-            Q(checkpoint_pass__status=models.CheckpointPass.Status.NOT_PASSED) | Q(checkpoint_pass__isnull=True),
+            camera_id=self.kwargs['camera_pk'],
+            pending=True,
+        ).select_related(
+            'vehicle', 'camera',
+        ).prefetch_related(
+            Prefetch('persons', queryset=models.Person.objects.with_temperature())
         ).order_by('-add_date')
 
         if self.request.query_params.get('ts_from'):
@@ -144,8 +160,8 @@ class CheckpointCameraCaptureViewSet(viewsets.ReadOnlyModelViewSet):
             q = q.filter(add_date__gte=dt_from)
 
         if self.request.query_params.get('persons'):
-            # без distinct дублирует те что c людьми по количеству отношений с людьми
-            q = q.filter(persons__isnull=self.request.query_params.get('persons') == '0').distinct()
+            has_persons = Exists(models.CameraCapture.persons.through.objects.filter(cameracapture_id=OuterRef('pk')))
+            q = q.filter(~has_persons if self.request.query_params['persons'] == '0' else has_persons)
 
         return q
 
@@ -196,26 +212,18 @@ class CountryPersonViewSet(viewsets.ModelViewSet):
     def retrieve(self, request, *args, **kwargs):
         if request.query_params.get('fetch') and int(kwargs['country_pk']) in CITIZENSHIPS_KZ:
             # Если запрашивают казахстанца, обновляем анкету из DAMU, создаём если таковой нет
-            p, created = models.Person.objects.get_or_create(
-                doc_id=kwargs['doc_id'],
-                citizenship__in=CITIZENSHIPS_KZ,
-                defaults={
-                    'citizenship': models.Country.objects.get(pk=kwargs['country_pk'])
-                }
-            )
-            if p.dmed_id:
-                # инфа уже была получена, не делаем внешний запрос
-                return super(CountryPersonViewSet, self).retrieve(request, *args, **kwargs)
-
-            p.update_from_dmed()
+            checkpoint = refdata.checkpoint(request.user.checkpoint_id)
+            dmed.ensure_person(kwargs['doc_id'], int(kwargs['country_pk']), checkpoint=checkpoint)
 
         return super(CountryPersonViewSet, self).retrieve(request, *args, **kwargs)
 
     def get_queryset(self):
-        return models.Person.objects.filter(citizenship=self.kwargs['country_pk']).order_by('-add_date')
+        return models.Person.objects.with_temperature().filter(
+            citizenship=self.kwargs['country_pk']
+        ).order_by('-add_date')
 
     def perform_create(self, serializer):
-        serializer.validated_data['citizenship'] = models.Country.objects.get(pk=self.kwargs['country_pk'])
+        serializer.validated_data['citizenship'] = refdata.country(int(self.kwargs['country_pk']))
         return super(CountryPersonViewSet, self).perform_create(serializer)
 
     def perform_update(self, serializer):
@@ -1,6 +1,10 @@
-from django.contrib import admin
+from django import forms as django_forms
+from django.contrib import admin, messages
 from django.contrib.auth.admin import UserAdmin
-from . import models, forms
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
+from . import models, forms, prefetch
 from django.utils.translation import gettext_lazy as _
 
 
@@ -19,19 +23,95 @@ class CustomUserAdmin(UserAdmin):
     )
 
 
+PREFETCH_WORKERS = 4  # из веб-процесса - меньше потоков, чем у manage.py dmed_prefetch
+
+
+class PrefetchForm(django_forms.Form):
+    file = django_forms.FileField(label='Список ИИН', help_text='CSV с колонкой iin (и checkpoint) или JSONL')
+
+
+class PersonAdmin(admin.ModelAdmin):
+    list_display = '__str__', 'citizenship', 'dmed_region', 'dmed_updated_at'
+    search_fields = '=doc_id', 'full_name'
+    list_select_related = 'citizenship', 'dmed_region'
+    actions = 'prefetch_from_dmed',
+    change_list_template = 'admin/core/person/change_list.html'
+
+    def prefetch_from_dmed(self, request, queryset):
+        iins = queryset.filter(citizenship__in=models.CITIZENSHIPS_KZ).values_list('doc_id', flat=True)
+        rows = [(iin, None) for iin in iins]
+        prefetch.start(rows, PREFETCH_WORKERS, f'{len(rows)} анкет из админки ({request.user})')
+        self.message_user(request, f'Наполнение {len(rows)} анкет из DMED запущено')
+        return redirect('admin:core_person_prefetch')
+    prefetch_from_dmed.short_description = 'Наполнить из DMED'
+
+    def get_urls(self):
+        return [
+            path('prefetch/', self.admin_site.admin_view(self.prefetch_view), name='core_person_prefetch'),
+        ] + super().get_urls()
+
+    def prefetch_view(self, request):
+        """Загрузка списка ИИН (CSV или JSONL) для предварительного наполнения анкет из DMED"""
+        if not self.has_change_permission(request):
+            return redirect('admin:index')
+        form = PrefetchForm(request.POST or None, request.FILES or None)
+        if form.is_valid():
+            f = form.cleaned_data['file']
+            try:
+                rows = prefetch.read(f, f.name)
+            except (ValueError, UnicodeDecodeError) as e:
+                self.message_user(request, f'Не удалось прочитать {f.name}: {e}', messages.ERROR)
+            else:
+                prefetch.start(rows, PREFETCH_WORKERS, f'{f.name} ({request.user})')
+                self.message_user(request, f'Наполнение {len(rows)} анкет из {f.name} запущено')
+                return redirect('admin:core_person_prefetch')
+        return TemplateResponse(request, 'admin/core/person/prefetch.html', dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title='Наполнение анкет из DMED',
+            form=form,
+            jobs=prefetch.jobs(),
+        ))
+
+
 class CameraCaptureAdmin(admin.ModelAdmin):
     list_display = '__str__', 'add_date'
     ordering = '-add_date',
 
 
+class CaptureEventAdmin(admin.ModelAdmin):
+    list_display = 'event_id', 'source', 'status', 'attempts', 'add_date', 'processed_at'
+    list_filter = 'status',
+    search_fields = '=event_id', 'source'
+    ordering = '-id',
+
+
+class DMEDRouteStatAdmin(admin.ModelAdmin):
+    """Выученный порядок опроса регионов DMED: для каждого места запроса - регионы по убыванию находок"""
+    list_display = 'context', 'region', 'lookups', 'hits', 'hit_rate', 'errors', 'avg_latency_ms'
+    list_filter = 'context',
+    list_select_related = 'region',
+    ordering = 'context', '-hits'
+
+    def hit_rate(self, obj):
+        if obj.lookups:
+            return f'{obj.hits / obj.lookups:.0%}'
+
+    def avg_latency_ms(self, obj):
+        if obj.lookups:
+            return obj.latency_ms // obj.lookups
+
+
 admin.site.register(models.User, CustomUserAdmin)
 admin.site.register(models.Checkpoint)
 admin.site.register(models.CheckpointPass)
 admin.site.register(models.PersonPassData)
 admin.site.register(models.Region)
-admin.site.register(models.Person)
+admin.site.register(models.Person, PersonAdmin)
 admin.site.register(models.Marker)
 admin.site.register(models.Country)
 admin.site.register(models.Camera)
 admin.site.register(models.Vehicle)
 admin.site.register(models.CameraCapture, CameraCaptureAdmin)
+admin.site.register(models.CaptureEvent, CaptureEventAdmin)
+admin.site.register(models.DMEDRouteStat, DMEDRouteStatAdmin)
@@ -3,3 +3,9 @@ from django.apps import AppConfig
 
 class CoreConfig(AppConfig):
     name = 'core'
+
+    def ready(self):
+        from core import auth, authz, refdata, signals  # noqa: F401
+        refdata.connect()
+        auth.connect()
+        authz.connect()
@@ -0,0 +1,135 @@
+"""Аутентификация API без расчёта хэша пароля на каждый запрос
+
+С Basic-аутентификацией Django считает PBKDF2 (десятки миллисекунд процессора) на каждом запросе.
+Клиенты меняют логин и пароль на токен (POST api/v2/auth/token) и дальше шлют заголовок Authorization: Token <ключ>.
+Токен и его пользователь проверяются по кэшу. Сервисные учётки (вебхук EGSV) получают токен через
+manage.py issue_token.
+
+Старые клиенты продолжают ходить с Basic-аутентификацией. Проверенная пара логин-пароль запоминается в кэше
+на AUTH_CACHE_TTL, и хэш считается раз в AUTH_CACHE_TTL, а не на каждом запросе.
+
+Отзыв: удаление токена (DELETE api/v2/auth/token, issue_token --revoke, админка) сразу убирает его из кэша.
+Сохранение пользователя (смена пароля, is_active) сбрасывает его из кэша, а вместе с ним и проверенные пароли.
+"""
+import hashlib
+import hmac
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.utils import timezone
+from django.utils.translation import gettext_lazy as _
+from rest_framework import authentication, exceptions
+from rest_framework.authtoken.models import Token
+
+from core.models import User
+
+
+def digest(*parts):
+    """Ключ кэша из секретов: ни токены, ни пароли в кэш не попадают"""
+    return hmac.new(settings.SECRET_KEY.encode(), '\0'.join(parts).encode(), hashlib.sha256).hexdigest()
+
+
+def user_key(pk):
+    return f'auth_user:{pk}'
+
+
+def token_key(key):
+    return f'auth_token:{digest(key)}'
+
+
+def get_user(pk):
+    """Пользователь по id (из кэша) или None"""
+    key = user_key(pk)
+    user = cache.get(key)
+    if user is None:
+        user = User.objects.filter(pk=pk).first()
+        if user is None:
+            return None
+        cache.set(key, user, settings.AUTH_CACHE_TTL)
+    return user
+
+
+def is_expired(created):
+    lifetime = settings.AUTH_TOKEN_LIFETIME
+    return bool(lifetime) and created < timezone.now() - timedelta(seconds=lifetime)
+
+
+def issue(user, rotate=False):
+    """Токен пользователя; новый, если токена нет, он просрочен или rotate (старый при этом отзывается)
+    :rtype: Token"""
+    with transaction.atomic():
+        token = Token.objects.filter(user=user).first()
+        if token and (rotate or is_expired(token.created)):
+            token.delete()
+            token = None
+        if token is None:
+            token = Token.objects.create(user=user)
+    return token
+
+
+def revoke(user):
+    # QuerySet.delete() отправляет post_delete для каждого токена
+    Token.objects.filter(user=user).delete()
+
+
+class CachedTokenAuthentication(authentication.TokenAuthentication):
+    """Authorization: Token <ключ>, без запросов к базе, пока токен и пользователь в кэше"""
+
+    def authenticate_credentials(self, key):
+        cache_key = token_key(key)
+        cached = cache.get(cache_key)
+        if cached is None:
+            cached = Token.objects.filter(key=key).values_list('user_id', 'created').first()
+            if cached is None:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            cache.set(cache_key, cached, settings.AUTH_CACHE_TTL)
+
+        user_id, created = cached
+        if is_expired(created):
+            raise exceptions.AuthenticationFailed('Token has expired.')
+        user = get_user(user_id)
+        if user is None or not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return user, Token(key=key, user=user, created=created)
+
+
+class CachedBasicAuthentication(authentication.BasicAuthentication):
+    """Basic-аутентификация для старых клиентов: пароль проверяется хэшем раз в AUTH_CACHE_TTL"""
+
+    def authenticate_credentials(self, userid, password, request=None):
+        cache_key = f'auth_basic:{digest(userid, password)}'
+        cached = cache.get(cache_key)
+        if cached is not None:
+            pk, password_hash = cached
+            user = get_user(pk)
+            # если пароль сменили после проверки, хэш не совпадёт - проверяем заново
+            if user is not None and user.is_active and user.password == password_hash:
+                return user, None
+
+        user, auth = super().authenticate_credentials(userid, password, request)
+        cache.set(cache_key, (user.pk, user.password), settings.AUTH_CACHE_TTL)
+        return user, auth
+
+
+def forget(key):
+    cache.delete(key)
+    # и после коммита: параллельный запрос мог успеть закэшировать ещё не изменённую запись
+    transaction.on_commit(lambda: cache.delete(key))
+
+
+def user_changed(sender, instance, **kwargs):
+    forget(user_key(instance.pk))
+
+
+def token_changed(sender, instance, **kwargs):
+    forget(token_key(instance.key))
+
+
+def connect():
+    post_save.connect(user_changed, sender=User, dispatch_uid='auth_user_save')
+    post_delete.connect(user_changed, sender=User, dispatch_uid='auth_user_delete')
+    post_save.connect(token_changed, sender=Token, dispatch_uid='auth_token_save')
+    post_delete.connect(token_changed, sender=Token, dispatch_uid='auth_token_delete')
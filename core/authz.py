@@ -0,0 +1,168 @@
+"""Снимок прав пользователя: группы, права на модели, КПП и его камеры
+
+Горячие эндпоинты мобильного приложения на каждом запросе проверяли группу инспектора, загружали права
+пользователя и камеры его КПП - 3-5 запросов к базе. Снимок собирается один раз и хранится в кэше;
+AuthzMiddleware кладёт его в request.authz (собирается при первом обращении, уже после аутентификации DRF).
+
+Изменения самого пользователя (сохранение, его группы и права) сбрасывают только его снимок,
+остальные (права групп, камеры КПП, удаление групп, прав, КПП) - увеличивают общую версию, и снимки всех
+пользователей пересобираются при следующем обращении. QuerySet.update() и reverse-add у FK сигналов не отправляют -
+после них нужно вызывать invalidate() самому.
+"""
+from django.conf import settings
+from django.contrib.auth.models import Group, Permission
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_save, post_delete, m2m_changed
+
+from core.models import Camera, Checkpoint, User
+
+INSPECTORS = 'inspectors'
+VERSION_KEY = 'authz_version'
+
+
+def user_key(pk):
+    return f'authz:{pk}'
+
+
+class Snapshot:
+    """Права пользователя на момент сборки, не меняется"""
+
+    def __init__(self, user_id=None, is_active=False, is_superuser=False, groups=(), permissions=(),
+                 checkpoint_id=None, camera_ids=(), version=None):
+        self.user_id = user_id
+        self.is_active = is_active
+        self.is_superuser = is_superuser
+        self.groups = frozenset(groups)
+        self.permissions = frozenset(permissions)
+        self.checkpoint_id = checkpoint_id
+        self.camera_ids = frozenset(camera_ids)
+        self.version = version
+
+    @classmethod
+    def build(cls, user, version=None):
+        return cls(
+            user_id=user.pk,
+            is_active=user.is_active,
+            is_superuser=user.is_superuser,
+            groups=user.groups.values_list('name', flat=True),
+            # суперпользователю разрешено всё и так, список всех прав ему не нужен;
+            # не через user.get_all_permissions(): она запоминает права на объекте пользователя
+            permissions=() if user.is_superuser else (
+                f'{app_label}.{codename}' for app_label, codename in Permission.objects.filter(
+                    Q(user=user) | Q(group__user=user)
+                ).values_list('content_type__app_label', 'codename').distinct()
+            ),
+            checkpoint_id=user.checkpoint_id,
+            camera_ids=Camera.objects.filter(
+                checkpoint_id=user.checkpoint_id
+            ).values_list('id', flat=True) if user.checkpoint_id else (),
+            version=version,
+        )
+
+    @property
+    def is_inspector(self):
+        return INSPECTORS in self.groups
+
+    def has_perm(self, perm):
+        """Как User.has_perm для права на модель (app_label.codename)"""
+        return self.is_active and (self.is_superuser or perm in self.permissions)
+
+    def has_perms(self, perms):
+        return all(self.has_perm(p) for p in perms)
+
+    def has_camera(self, pk):
+        """Камера с КПП пользователя"""
+        try:
+            return int(pk) in self.camera_ids
+        except (TypeError, ValueError):
+            return False
+
+
+ANONYMOUS = Snapshot()
+
+
+def for_user(user):
+    """Снимок прав пользователя (из кэша)
+    :rtype: Snapshot"""
+    if not user.is_authenticated:
+        return ANONYMOUS
+
+    key = user_key(user.pk)
+    cached = cache.get_many([VERSION_KEY, key])
+    version = cached.get(VERSION_KEY)
+    if version is None:
+        cache.add(VERSION_KEY, 1, None)
+        version = cache.get(VERSION_KEY)
+    snapshot = cached.get(key)
+    # версию читаем до сборки: изменение между ними приведёт к лишней пересборке, а не к устаревшему снимку
+    if snapshot is None or snapshot.version != version:
+        snapshot = Snapshot.build(user, version)
+        cache.set(key, snapshot, settings.AUTH_CACHE_TTL)
+    return snapshot
+
+
+def of(request):
+    """Снимок прав пользователя запроса: request.authz (AuthzMiddleware) или собранный здесь
+    :rtype: Snapshot"""
+    try:
+        return request.authz
+    except AttributeError:
+        request.authz = for_user(request.user)
+        return request.authz
+
+
+def invalidate():
+    """Сбрасывает снимки всех пользователей"""
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.add(VERSION_KEY, 1, None)
+
+
+def forget(user_id):
+    cache.delete(user_key(user_id))
+
+
+def on_change(fn, *args):
+    fn(*args)
+    # и после коммита: параллельный запрос мог успеть собрать снимок по ещё не изменённым данным
+    transaction.on_commit(lambda: fn(*args))
+
+
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return  # вход в админку
+    on_change(forget, instance.pk)
+
+
+def membership_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """Группы или права пользователя (и, с обратной стороны, пользователи группы или права)"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        on_change(forget, instance.pk)
+    elif pk_set:
+        for pk in pk_set:
+            on_change(forget, pk)
+    else:
+        on_change(invalidate)
+
+
+def changed(sender, action=None, **kwargs):
+    if action is not None and not action.startswith('post_'):
+        return  # m2m_changed до изменения
+    on_change(invalidate)
+
+
+def connect():
+    post_save.connect(user_changed, sender=User, dispatch_uid='authz_user_save')
+    post_delete.connect(user_changed, sender=User, dispatch_uid='authz_user_delete')
+    m2m_changed.connect(membership_changed, sender=User.groups.through, dispatch_uid='authz_user_groups')
+    m2m_changed.connect(membership_changed, sender=User.user_permissions.through, dispatch_uid='authz_user_perms')
+    m2m_changed.connect(changed, sender=Group.permissions.through, dispatch_uid='authz_group_perms')
+    for model in (Camera, Group):
+        post_save.connect(changed, sender=model, dispatch_uid=f'authz_{model.__name__}_save')
+    for model in (Camera, Checkpoint, Group, Permission):
+        post_delete.connect(changed, sender=model, dispatch_uid=f'authz_{model.__name__}_delete')
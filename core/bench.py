@@ -0,0 +1,61 @@
+"""Замеры задержки и пропускной способности для команд-бенчмарков"""
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection
+
+
+def percentile(ordered, q):
+    """q-й перцентиль (0..100) отсортированного списка"""
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+def run(fn, args, concurrency):
+    """Вызывает fn(arg) для каждого arg в concurrency потоков
+
+    Возвращает сводку: количество вызовов и ошибок, пропускную способность (в секунду),
+    среднюю задержку и p50/p95/p99 в миллисекундах, первую ошибку.
+    """
+    def timed(arg):
+        start = time.monotonic()
+        try:
+            fn(arg)
+        except Exception:
+            return time.monotonic() - start, traceback.format_exc(limit=3)
+        finally:
+            # у каждого потока своё соединение с БД
+            connection.close()
+        return time.monotonic() - start, None
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(timed, args))
+    return summary(results, time.monotonic() - start)
+
+
+def summary(results, elapsed):
+    """:param results: список (секунд, ошибка или None)"""
+    latencies = sorted(seconds * 1000 for seconds, error in results)
+    errors = [error for seconds, error in results if error]
+    return dict(
+        count=len(results),
+        errors=len(errors),
+        rps=len(results) / elapsed if elapsed else None,
+        mean_ms=sum(latencies) / len(latencies) if latencies else None,
+        p50_ms=percentile(latencies, 50),
+        p95_ms=percentile(latencies, 95),
+        p99_ms=percentile(latencies, 99),
+        first_error=errors[0] if errors else None,
+    )
+
+
+def format_summary(name, s):
+    if not s['count']:
+        return f'{name}: no requests'
+    return (
+        f'{name}: {s["count"]} requests, {s["errors"]} errors, {s["rps"]:.1f} rps, '
+        f'mean {s["mean_ms"]:.1f} ms, p50 {s["p50_ms"]:.1f} ms, p95 {s["p95_ms"]:.1f} ms, p99 {s["p99_ms"]:.1f} ms'
+    )
@@ -0,0 +1,43 @@
+"""Массовые операции, которых нет в ORM"""
+from django.db import connection
+
+
+def upsert(model, objs, conflict_fields, update_fields, returning=None, increment_fields=()):
+    """INSERT ... ON CONFLICT (conflict_fields) DO UPDATE SET update_fields одним запросом
+
+    Значения increment_fields при конфликте прибавляются к существующим.
+    В objs не должно быть двух объектов с одинаковыми значениями conflict_fields.
+    Возвращает кортежи значений полей returning для всех вставленных и обновлённых строк.
+    """
+    if not objs:
+        return []
+
+    opts = model._meta
+    fields = [f for f in opts.concrete_fields if not (f.primary_key and f.auto_created)]
+    qn = connection.ops.quote_name
+
+    columns = ', '.join(qn(f.column) for f in fields)
+    row = '(' + ', '.join(['%s'] * len(fields)) + ')'
+    params = []
+    for obj in objs:
+        params.extend(f.get_db_prep_save(f.pre_save(obj, True), connection) for f in fields)
+
+    sql = (
+        f'INSERT INTO {qn(opts.db_table)} ({columns}) VALUES {", ".join([row] * len(objs))} '
+        f'ON CONFLICT ({", ".join(qn(opts.get_field(n).column) for n in conflict_fields)}) '
+    )
+    if update_fields or increment_fields:
+        table = qn(opts.db_table)
+        sets = [f'{c} = EXCLUDED.{c}' for c in (qn(opts.get_field(n).column) for n in update_fields)]
+        sets += [f'{c} = {table}.{c} + EXCLUDED.{c}' for c in (qn(opts.get_field(n).column) for n in increment_fields)]
+        sql += 'DO UPDATE SET ' + ', '.join(sets)
+    else:
+        sql += 'DO NOTHING'
+    if returning:
+        sql += ' RETURNING ' + ', '.join(qn(opts.get_field(n).column) for n in returning)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        if returning:
+            return cursor.fetchall()
+    return []
@@ -0,0 +1,7 @@
+from redis_cache import RedisCache as BaseRedisCache
+
+from core.metrics import CacheMixin
+
+
+class RedisCache(CacheMixin, BaseRedisCache):
+    """redis_cache.RedisCache с учётом обращений в метриках запросов (core.metrics)"""
@@ -0,0 +1,274 @@
+"""Поиск анкеты в DMED сразу по всем регионам
+
+Запросы идут через пул keep-alive сессий (core.service.sessions) в потоках общего пула,
+а управляет ими asyncio: как только один из регионов нашёл человека, остальные запросы отменяются
+(ещё не начатые не выполняются вовсе, начатые больше не ждём), затем параллельно запрашиваются детали и маркеры.
+Работа с БД остаётся в вызывающем потоке.
+
+Порядок опроса регионов выбирается по истории поиска с того же КПП (см. core.routing),
+неисправные регионы пропускаются (см. core.health).
+
+Результаты поиска кэшируются: регионы, не знающие ИИН, не опрашиваются повторно DMED_NEGATIVE_TTL секунд,
+регионы, ответившие ошибкой - DMED_ERROR_TTL секунд. Найденные анкеты старше DMED_FRESHNESS
+отдаются сразу, а обновляются фоново.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.utils import timezone
+
+from core import health, metrics, refdata, routing, singleflight, stats
+from core.models import Person, CITIZENSHIPS_KZ, CITIZENSHIP_KZ
+from core.service import DMEDService
+
+log = logging.getLogger(__name__)
+
+executor = ThreadPoolExecutor(max_workers=settings.DMED_MAX_CONCURRENCY, thread_name_prefix='dmed')
+# фоновые обновления устаревших анкет: не больше DMED_REFRESH_QUEUE сразу, остальные - при следующем запросе
+refresh_executor = ThreadPoolExecutor(max_workers=settings.DMED_REFRESH_WORKERS, thread_name_prefix='dmed-refresh')
+refresh_slots = threading.BoundedSemaphore(settings.DMED_REFRESH_QUEUE)
+
+Found = namedtuple('Found', 'region person detail markers')
+
+STATS = (
+    'dmed_lookups',
+    'dmed_lookups_skipped',
+    'dmed_stale_refreshes',
+    'dmed_stale_refreshes_dropped',
+    'dmed_hedged',
+)
+
+
+def service(region) -> DMEDService:
+    return DMEDService(url=region.dmed_url, username=settings.DMED_LOGIN, password=settings.DMED_PASSWORD)
+
+
+def enabled_regions():
+    """Регионы, в которых ищем людей, по порядку приоритета"""
+    return refdata.dmed_regions()
+
+
+def probe(region, doc_id):
+    """Запрос человека в одном регионе: (запись DMED или None, ошибка или None, время ответа)
+
+    Результат учитывается в здоровье региона, даже если его уже никто не ждёт.
+    """
+    start = time.monotonic()
+    try:
+        r = service(region).fetch_person(doc_id)
+    except Exception as e:
+        health.record(region.dmed_url, time.monotonic() - start, False)
+        return None, e, time.monotonic() - start
+    health.record(region.dmed_url, time.monotonic() - start, True)
+    return r, None, time.monotonic() - start
+
+
+def hedge_delay(wave):
+    """Сколько ждать ответа волны, прежде чем параллельно запустить следующую"""
+    return max(settings.DMED_HEDGE_MIN, max(health.p95(r.dmed_url, settings.DMED_HEDGE_DEFAULT) for r in wave))
+
+
+async def find(doc_id, waves, outcomes=None):
+    """Ищет человека в регионах, возвращает (регион, запись DMED) первого нашедшего
+
+    Регионы одной волны опрашиваются одновременно, следующая волна - если предыдущая никого не нашла
+    или не ответила за свою p95 задержку (тогда ответа ждём от обеих).
+    Если несколько регионов ответили одновременно, побеждает стоящий раньше (по умолчанию - по dmed_priority).
+    В outcomes (если передан) собираются результаты опроса: (регион, нашёл ли - True/False, None при ошибке, время).
+    """
+    loop = asyncio.get_event_loop()
+    waves = [wave for wave in waves if wave]
+    rank = {region.id: i for i, region in enumerate(r for wave in waves for r in wave)}
+    tasks = {}
+    pending = set()
+    try:
+        for i, wave in enumerate(waves):
+            for region in wave:
+                if not health.allow(region.dmed_url):
+                    # пробный запрос полуоткрытого выключателя уже отправил другой воркер
+                    continue
+                t = loop.run_in_executor(executor, metrics.bind(probe), region, doc_id)
+                tasks[t] = region
+                pending.add(t)
+
+            deadline = loop.time() + hedge_delay(wave) if i < len(waves) - 1 else None
+            while pending:
+                timeout = max(0, deadline - loop.time()) if deadline is not None else None
+                done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                hits = []
+                for t in done:
+                    region = tasks[t]
+                    r, error, seconds = t.result()
+                    if error:
+                        log.warning(f'error while fetching {region.dmed_url}: {error}')
+                    if outcomes is not None:
+                        outcomes.append((region, None if error else bool(r), seconds))
+                    if r:
+                        hits.append((region, r))
+                if hits:
+                    return min(hits, key=lambda h: rank[h[0].id])
+                if deadline is not None and loop.time() >= deadline:
+                    log.info(f'dmed regions {wave} are slow, hedging with the next ones')
+                    stats.incr('dmed_hedged')
+                    break
+    finally:
+        for t in pending:
+            t.cancel()
+
+
+async def lookup(doc_id, waves, outcomes=None):
+    """Ищет человека и дозапрашивает его детали и маркеры в нашедшем регионе"""
+    hit = await find(doc_id, waves, outcomes)
+    if not hit:
+        return
+    region, r = hit
+
+    loop = asyncio.get_event_loop()
+    dmed = service(region)
+    fetch_detail, fetch_markers = metrics.bind(dmed.fetch_person_detail), metrics.bind(dmed.fetch_person_markers)
+    detail, markers = await asyncio.gather(
+        loop.run_in_executor(executor, fetch_detail, r.get('rpnID')) if r.get('rpnID') else none(),
+        loop.run_in_executor(executor, fetch_markers, r['id']),
+        return_exceptions=True,
+    )
+    if isinstance(detail, Exception):
+        log.warning(f'cannot fetch person detail from {region.dmed_url}: {detail}')
+        detail = None
+    if isinstance(markers, Exception):
+        log.warning(f'cannot fetch person markers from {region.dmed_url}: {markers}')
+        markers = None
+    return Found(region, r, detail, markers)
+
+
+async def none():
+    return None
+
+
+def memo_key(doc_id):
+    return f'dmed_lookup:{doc_id}'
+
+
+def enrich_person(p, regions=None, checkpoint=None):
+    """Заполняет анкету из DMED; возвращает True, если человек найден
+    :type p: core.models.Person
+    :param checkpoint: КПП, с которого пришёл запрос, по нему выбирается порядок опроса регионов"""
+    if regions is None:
+        regions = enabled_regions()
+
+    # не спрашиваем регионы, которые недавно не нашли этот ИИН или ответили ошибкой
+    now = time.time()
+    memo = {url: expires for url, expires in (cache.get(memo_key(p.doc_id)) or {}).items() if expires > now}
+    regions = [r for r in regions if r.dmed_url not in memo]
+    # и регионы с разомкнутым выключателем (пробный запрос полуоткрытого забирается в find перед отправкой)
+    regions = [r for r in regions if health.available(r.dmed_url)]
+    if not regions:
+        stats.incr('dmed_lookups_skipped')
+        return False
+
+    stats.incr('dmed_lookups')
+    ctxs = routing.contexts(checkpoint)
+    outcomes = []
+    found = asyncio.run(lookup(p.doc_id, routing.waves(regions, ctxs), outcomes))
+    if not found:
+        for region, hit, seconds in outcomes:
+            memo[region.dmed_url] = now + (settings.DMED_ERROR_TTL if hit is None else settings.DMED_NEGATIVE_TTL)
+        cache.set(memo_key(p.doc_id), memo, settings.DMED_NEGATIVE_TTL)
+        record_routes(ctxs, outcomes)
+        return False
+
+    cache.delete(memo_key(p.doc_id))
+    log.info(f'{p} found in {found.region.dmed_url}')
+    DMEDService.apply_person(p, found.person)
+    p.dmed_region = found.region  # запомним откуда получили информацию
+    p.dmed_updated_at = timezone.now()
+    if found.detail:
+        DMEDService.apply_person_detail(p, found.detail)
+    p.save()
+    if found.markers is not None:
+        DMEDService.apply_person_markers(p, found.markers)
+    record_routes(ctxs, outcomes)
+    return True
+
+
+def record_routes(ctxs, outcomes):
+    """Статистика опроса (core.routing) после сохранения анкеты; её ошибки не должны терять найденное в DMED"""
+    try:
+        with transaction.atomic():
+            routing.record(ctxs, outcomes)
+    except Exception as e:
+        log.warning(f'cannot record dmed routes: {e}')
+
+
+def ensure_person(doc_id, citizenship_id=CITIZENSHIP_KZ, checkpoint=None):
+    """Находит или создаёт анкету казахстанца и, если данных DMED в ней ещё нет, наполняет её из DMED
+
+    Одновременные запросы одного человека (инспекторы, вебхук камер) выполняются одним процессом,
+    остальные ждут его результата.
+    :param citizenship_id: гражданство для новой анкеты (одно из CITIZENSHIPS_KZ)
+    :rtype: core.models.Person
+    """
+    p = Person.objects.filter(doc_id=doc_id, citizenship__in=CITIZENSHIPS_KZ).first()
+    if p and p.dmed_id:
+        # инфа уже была получена, не ждём внешний запрос (устаревшая анкета обновится в фоне)
+        refresh_if_stale(p)
+        return p
+
+    def enrich():
+        p, created = Person.objects.get_or_create(
+            doc_id=doc_id,
+            citizenship__in=CITIZENSHIPS_KZ,
+            defaults={'citizenship_id': citizenship_id}
+        )
+        if created:
+            log.info(f'person created {p}')
+        if not p.dmed_id:
+            p.update_from_dmed(checkpoint=checkpoint)
+        return p.pk
+
+    pk = singleflight.run(f'person:{doc_id}:kz', enrich, timeout=settings.DMED_SINGLEFLIGHT_TIMEOUT)
+    return Person.objects.get(pk=pk)
+
+
+def refresh_if_stale(p):
+    """Если данные анкеты из DMED устарели, обновляет их в фоне (текущий запрос получает то, что есть)
+    :type p: core.models.Person"""
+    if is_fresh(p):
+        return
+    if not refresh_slots.acquire(blocking=False):
+        # очередь полна (например, после выкладки устарели все анкеты сразу) - обновим при следующем запросе
+        stats.incr('dmed_stale_refreshes_dropped')
+        return
+    if not cache.add(f'dmed_refresh:{p.pk}', 1, 60):
+        # уже обновляется
+        refresh_slots.release()
+        return
+    stats.incr('dmed_stale_refreshes')
+    refresh_executor.submit(refresh, p.pk)
+
+
+def is_fresh(p):
+    """:type p: core.models.Person"""
+    return bool(p.dmed_updated_at and timezone.now() - p.dmed_updated_at < timedelta(seconds=settings.DMED_FRESHNESS))
+
+
+def refresh(person_id):
+    try:
+        p = Person.objects.get(pk=person_id)
+        # сначала спрашиваем регион, где человека нашли в прошлый раз
+        last = refdata.regions.get(p.dmed_region_id)
+        if not (last and last.dmed_url and enrich_person(p, [last])):
+            enrich_person(p)
+    except Exception:
+        log.exception(f'cannot refresh person #{person_id} from dmed')
+    finally:
+        cache.delete(f'dmed_refresh:{person_id}')
+        refresh_slots.release()
+        connection.close()
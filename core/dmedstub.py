@@ -0,0 +1,216 @@
+"""Локальный имитатор DMED для нагрузочных тестов и бенчмарков (manage.py dmed_stub, manage.py dmed_bench)
+
+Один HTTP сервер обслуживает все регионы: регион - первая часть пути,
+dmed_url региона - http://host:port/<регион>/.
+Реализованы Authentication/SignInExternalApp, Person/GetPersons, Person/GetPersonDetail и Person/GetPersonMarkers.
+
+Настройки региона (все необязательны):
+    latency     - средняя задержка ответа в секундах
+    jitter      - её стандартное отклонение
+    error_rate  - доля запросов, на которые регион отвечает ошибкой
+    weight      - доля людей, "прописанных" в регионе (человек знаком ровно одному региону,
+                  регион выбирается по ИИН детерминированно, пропорционально весам)
+    persons     - {ИИН: запись GetPersons} явный набор данных региона, дополняет сгенерированный
+Общие настройки: miss_rate - доля ИИН, неизвестных ни одному региону, markers - сколько максимум маркеров у человека.
+"""
+import hashlib
+import json
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from core.models import CITIZENSHIP_KZ
+from core.validators import calculate_checksum
+
+log = logging.getLogger(__name__)
+
+MARKER_POOL = 50  # маркеры людей берутся из общего набора, чтобы они пересекались
+
+
+def load_config(path):
+    with open(path) as fp:
+        return json.load(fp)
+
+
+def make_config(regions, latency=0.05, jitter=0.02, error_rate=0.0, miss_rate=0.0, markers=3):
+    """Конфигурация из одинаковых регионов region-0 ... region-N"""
+    return dict(
+        miss_rate=miss_rate,
+        markers=markers,
+        regions={
+            f'region-{i}': dict(latency=latency, jitter=jitter, error_rate=error_rate, weight=1)
+            for i in range(regions)
+        },
+    )
+
+
+def random_iin(rnd=random):
+    """Случайный корректный ИИН (человек, не БИН)"""
+    while True:
+        v = f'{rnd.randint(0, 99):02}{rnd.randint(1, 12):02}{rnd.randint(1, 28):02}{rnd.randint(1, 6)}{rnd.randint(0, 9999):04}'
+        try:
+            return v + str(calculate_checksum(v))
+        except ValueError:
+            continue
+
+
+def fraction(iin, salt=''):
+    """Детерминированное псевдослучайное число [0, 1) для ИИН"""
+    return int(hashlib.md5(f'{salt}{iin}'.encode()).hexdigest()[:8], 16) / 0x100000000
+
+
+class Simulator:
+    def __init__(self, config):
+        self.config = config
+        self.regions = config['regions']
+        self.calls = Counter()  # (регион, метод) -> количество запросов
+        self.errors = Counter()
+        self.lock = threading.Lock()
+
+    def owner(self, iin):
+        """Регион, которому известен ИИН, или None"""
+        for name, region in self.regions.items():
+            if iin in region.get('persons', {}):
+                return name
+        if fraction(iin, 'miss') < self.config.get('miss_rate', 0):
+            return None
+        total = sum(r.get('weight', 1) for r in self.regions.values())
+        if not total:
+            return None
+        point, acc = fraction(iin, 'owner') * total, 0
+        for name, region in self.regions.items():
+            acc += region.get('weight', 1)
+            if point < acc:
+                return name
+
+    def person(self, region, iin):
+        explicit = self.regions[region].get('persons', {}).get(iin)
+        if explicit:
+            return explicit
+        if self.owner(iin) != region:
+            return None
+        try:
+            century = {'1': 1800, '2': 1800, '3': 1900, '4': 1900, '5': 2000, '6': 2000}[iin[6]]
+            birth_date = datetime(century + int(iin[:2]), int(iin[2:4]), int(iin[4:6]))
+        except (KeyError, ValueError):
+            birth_date = datetime(1980, 1, 1)
+        return dict(
+            id=int(iin[:11]),
+            rpnID=int(iin[:11]) + 1,
+            masterDataID=int(iin[:11]) + 2,
+            firstName='ИМЯ',
+            secondName='ОТЧЕСТВО',
+            lastName=f'ФАМИЛИЯ{iin[-4:]}',
+            fullName=f'ФАМИЛИЯ{iin[-4:]} ИМЯ ОТЧЕСТВО',
+            birthDate=birth_date.strftime('%Y-%m-%dT%H:%M:%S'),
+            sexID=1 if int(iin[6]) % 2 else 2,
+            citizenshipID=CITIZENSHIP_KZ,
+        )
+
+    def detail(self, region, rpn_id):
+        return dict(
+            phoneNumber=f'+7700{rpn_id % 10000000:07}',
+            workPlaces=None,
+            addresses=[
+                dict(addressTypeID=2, isMain=True, addressText=f'{region}, ул. Тестовая, {rpn_id % 100}'),
+                dict(addressTypeID=5, isMain=False, addressText=f'{region}, ул. Рабочая, {rpn_id % 50}'),
+            ],
+        )
+
+    def markers(self, person_id):
+        count = int(fraction(person_id, 'markers') * (self.config.get('markers', 3) + 1))
+        first = int(fraction(person_id, 'marker') * MARKER_POOL)
+        return dict(data=[
+            dict(markerID=(first + i) % MARKER_POOL + 1, markerName=f'Маркер {(first + i) % MARKER_POOL + 1}')
+            for i in range(count)
+        ])
+
+    def handle(self, region, method, headers, body):
+        """Ответ региона: (HTTP статус, тело)"""
+        r = self.regions[region]
+        with self.lock:
+            self.calls[region, method] += 1
+        delay = random.gauss(r.get('latency', 0), r.get('jitter', 0))
+        if delay > 0:
+            time.sleep(delay)
+
+        if random.random() < r.get('error_rate', 0):
+            with self.lock:
+                self.errors[region, method] += 1
+            return 500, dict(Code=500, Message='simulated error')
+
+        if method == 'Authentication/SignInExternalApp':
+            return 200, f'stub-{region}-{int(time.time())}'
+        if not headers.get('Authorization', '').startswith('Bearer stub-'):
+            return 401, dict(message='unauthorized')
+
+        if method == 'Person/GetPersons':
+            p = self.person(region, json.loads(body)['iin'])
+            return 200, [p] if p else []
+        if method == 'Person/GetPersonDetail':
+            return 200, self.detail(region, int(body))
+        if method == 'Person/GetPersonMarkers':
+            return 200, self.markers(json.loads(body)['personID'])
+        return 404, dict(message=f'unknown method {method}')
+
+
+def make_handler(simulator):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive, как у настоящего DMED за балансировщиком
+        disable_nagle_algorithm = True  # иначе заголовки и тело ответа уходят с задержкой
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            region, _, method = self.path.strip('/').partition('/')
+            if region not in simulator.regions:
+                status, data = 404, dict(message=f'unknown region {region}')
+            else:
+                status, data = simulator.handle(region, method, self.headers, body)
+            data = data.encode() if isinstance(data, str) else json.dumps(data, ensure_ascii=False).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+    return Handler
+
+
+def serve(config, host='127.0.0.1', port=0):
+    """Запускает имитатор в фоновом потоке, возвращает (сервер, имитатор, базовый url)"""
+    simulator = Simulator(config)
+    server = ThreadingHTTPServer((host, port), make_handler(simulator))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='dmed-stub', daemon=True).start()
+    return server, simulator, f'http://{host}:{server.server_port}/'
+
+
+def add_arguments(parser):
+    """Аргументы конфигурации имитатора для команд"""
+    parser.add_argument('--config', help='JSON файл с конфигурацией регионов (см. core.dmedstub)')
+    parser.add_argument('--regions', type=int, default=17, help='количество одинаковых регионов, если нет --config')
+    parser.add_argument('--latency', type=float, default=0.05, help='средняя задержка ответа региона, с')
+    parser.add_argument('--jitter', type=float, default=0.02, help='разброс задержки, с')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов с ошибкой')
+    parser.add_argument('--miss-rate', type=float, default=0.0, help='доля ИИН, которых нет ни в одном регионе')
+    parser.add_argument('--markers', type=int, default=3, help='максимум маркеров у человека')
+
+
+def config_from_options(options):
+    if options['config']:
+        return load_config(options['config'])
+    return make_config(
+        options['regions'],
+        latency=options['latency'],
+        jitter=options['jitter'],
+        error_rate=options['error_rate'],
+        miss_rate=options['miss_rate'],
+        markers=options['markers'],
+    )
@@ -0,0 +1,205 @@
+"""Топология КПП и камер из EGSV
+
+Документ https://application-rubezh.egsv.kz/checkpoints?sources=1 держим разобранным в памяти процесса и в кэше,
+фоново обновляем по расписанию (условными запросами по ETag/Last-Modified), при ошибке обновления
+продолжаем работать на последней известной версии. Если топологии нет или она устарела, в EGSV идёт один
+вызвавший, остальные ждут его результата (core.singleflight).
+"""
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Optional
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+
+from core import refdata, singleflight, stats
+from core.models import Checkpoint
+
+log = logging.getLogger(__name__)
+
+CACHE_KEY = 'egsv_topology'
+REFRESH_LOCK_KEY = 'egsv_topology_refresh'
+REFRESH_TIMEOUT = 10  # сколько ждать топологии, которую запрашивает у EGSV другой вызвавший
+
+STATS = (
+    'egsv_topology_hits',
+    'egsv_topology_misses',
+    'egsv_topology_not_modified',
+    'egsv_topology_refresh_errors',
+    'egsv_topology_refresh_count',
+    'egsv_topology_refresh_ms',
+)
+
+
+class Topology:
+    """Разобранный документ EGSV"""
+
+    def __init__(self, checkpoints, etag=None, last_modified=None, fetched_at=None):
+        self.checkpoints = checkpoints
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at or time.time()
+        self.parents = set([c['parent'] for c in checkpoints.values() if c['parent']])
+
+        cameras = defaultdict(list)
+        for cid, c in self.leaf_checkpoints():
+            for s in c['sources']:
+                cameras[s].append(cid)  # маппинг "имя камеры": "id кпп (не родительского)"
+        # считаем за актуальный последний кпп из списка (на случай, если их будет несколько)
+        self.cameras = {s: cids[-1] for s, cids in cameras.items()}
+
+    def leaf_checkpoints(self):
+        """КПП без родительских категорий"""
+        for cid, c in self.checkpoints.items():
+            if cid not in self.parents:
+                yield cid, c
+
+    def checkpoint_id(self, camera_name) -> Optional[str]:
+        return self.cameras.get(camera_name)
+
+    def to_dict(self):
+        return dict(
+            checkpoints=self.checkpoints,
+            etag=self.etag,
+            last_modified=self.last_modified,
+            fetched_at=self.fetched_at,
+        )
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**d)
+
+
+class TopologyCache:
+    def __init__(self, url, refresh_interval, max_age, local_ttl=5):
+        self.url = url
+        self.refresh_interval = refresh_interval
+        """как часто фоново обновлять топологию"""
+        self.max_age = max_age
+        """после какого возраста топология считается устаревшей"""
+        self.local_ttl = local_ttl
+        """как часто сверять копию процесса с копией в кэше"""
+        self._topology = None  # type: Optional[Topology]
+        self._synced_at = 0
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    def get(self) -> Topology:
+        self.ensure_refresher()
+        t = self._topology
+        now = time.time()
+        if t and now - self._synced_at < self.local_ttl:
+            stats.incr('egsv_topology_hits')
+            return t
+
+        t = self.sync()
+        if t and now - t.fetched_at < self.max_age:
+            stats.incr('egsv_topology_hits')
+            return t
+
+        stats.incr('egsv_topology_misses')
+        # в EGSV идёт один вызвавший на все процессы и потоки, остальные ждут его результата
+        d = singleflight.run(CACHE_KEY, lambda: self.refresh().to_dict(), timeout=REFRESH_TIMEOUT)
+        self._swap(Topology.from_dict(d))
+        return self._topology
+
+    def sync(self) -> Optional[Topology]:
+        """Подтягивает в процесс более свежую топологию из кэша, если такая есть"""
+        d = cache.get(CACHE_KEY)
+        self._synced_at = time.time()
+        if d and (not self._topology or d['fetched_at'] > self._topology.fetched_at):
+            self._swap(Topology.from_dict(d))
+        return self._topology
+
+    def refresh(self, stale_ok=True) -> Topology:
+        """Запрашивает топологию у EGSV; при ошибке возвращает последнюю известную (если stale_ok)"""
+        current = self._topology
+        headers = {}
+        if current and current.etag:
+            headers['If-None-Match'] = current.etag
+        if current and current.last_modified:
+            headers['If-Modified-Since'] = current.last_modified
+
+        log.debug('requesting egsv for checkpoints')
+        start = time.monotonic()
+        try:
+            rv = requests.get(self.url, headers=headers, timeout=5)
+            if rv.status_code == 304 and current:
+                stats.incr('egsv_topology_not_modified')
+                t = Topology(current.checkpoints, etag=current.etag, last_modified=current.last_modified)
+            else:
+                rv.raise_for_status()
+                t = Topology(
+                    rv.json()['checkpoints'],
+                    etag=rv.headers.get('ETag'),
+                    last_modified=rv.headers.get('Last-Modified'),
+                )
+                log.debug(f'egsv response: {t.checkpoints}')
+        except (requests.RequestException, ValueError, KeyError) as e:
+            stats.incr('egsv_topology_refresh_errors')
+            log.warning(f'cannot refresh egsv topology: {e}')
+            if current and stale_ok:
+                return current
+            raise
+        finally:
+            stats.observe('egsv_topology_refresh', time.monotonic() - start)
+
+        # храним без таймаута: устаревшая топология лучше, чем никакая
+        cache.set(CACHE_KEY, t.to_dict(), None)
+        self._swap(t)
+        return t
+
+    def _swap(self, t):
+        with self._lock:
+            if not self._topology or t.fetched_at >= self._topology.fetched_at:
+                self._topology = t
+                self._synced_at = time.time()
+
+    def ensure_refresher(self):
+        """Запускает фоновое обновление (лениво, чтобы поток создавался уже после форка воркера)"""
+        if self._refresher and self._refresher.is_alive():
+            return
+        with self._lock:
+            if self._refresher and self._refresher.is_alive():
+                return
+            self._refresher = threading.Thread(target=self._refresh_forever, name='egsv-topology', daemon=True)
+            self._refresher.start()
+
+    def _refresh_forever(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                # в EGSV за интервал ходит только один процесс, остальные подхватят результат из кэша
+                if cache.add(REFRESH_LOCK_KEY, 1, self.refresh_interval):
+                    self.refresh()
+                else:
+                    self.sync()
+            except Exception as e:
+                log.warning(f'egsv topology refresher failed: {e}')
+
+
+topology = TopologyCache(
+    url=settings.EGSV_CHECKPOINTS_URL,
+    refresh_interval=settings.EGSV_TOPOLOGY_REFRESH_INTERVAL,
+    max_age=settings.EGSV_TOPOLOGY_MAX_AGE,
+)
+
+
+def fetch_camera_checkpoint(camera_name):
+    t = topology.get()
+    cid = t.checkpoint_id(camera_name)
+    if cid:
+        name = t.checkpoints[cid]['name']
+        checkpoint = refdata.checkpoint(cid)
+        if checkpoint and checkpoint.name == name:
+            return checkpoint
+        # новый или переименованный КПП (общий объект справочника не меняем)
+        checkpoint, created = Checkpoint.objects.get_or_create(pk=cid, defaults={'name': name})
+        if checkpoint.name != name:
+            log.info(f'checkpoint {checkpoint} changed name to {name}')
+            checkpoint.name = name
+            checkpoint.save()
+        return checkpoint
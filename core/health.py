@@ -0,0 +1,104 @@
+"""Здоровье регионов DMED: скользящее окно задержек и ошибок и автоматический выключатель
+
+Состояние общее для всех воркеров (хранится в кэше).
+Выключатель размыкается, если в окне слишком много ошибок; разомкнутый регион не опрашивается
+DMED_BREAKER_COOLDOWN секунд, затем пропускается один пробный запрос: успех замыкает выключатель,
+ошибка - снова размыкает.
+"""
+import logging
+import math
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+log = logging.getLogger(__name__)
+
+WINDOW_SIZE = 50
+WINDOW_TIMEOUT = 60 * 10  # окно без свежих замеров устаревает
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def window_key(url):
+    return f'dmed_health:{url}'
+
+
+def breaker_key(url):
+    return f'dmed_breaker:{url}'
+
+
+def window(url):
+    """Последние замеры: [(время, длительность в секундах, успешно ли)]"""
+    return cache.get(window_key(url)) or []
+
+
+def p95(url, default):
+    latencies = sorted(s[1] for s in window(url) if s[2])
+    if len(latencies) < 5:
+        return default
+    return latencies[math.ceil(len(latencies) * 0.95) - 1]  # ближайший ранг
+
+
+def state(url):
+    b = cache.get(breaker_key(url))
+    if not b:
+        return CLOSED
+    if time.time() < b['until']:
+        return OPEN
+    return HALF_OPEN
+
+
+def available(url):
+    """Может ли регион участвовать в поиске (без побочных эффектов, для отбора регионов)"""
+    return state(url) != OPEN
+
+
+def allow(url):
+    """Можно ли отправить запрос в регион прямо сейчас; вызывается непосредственно перед запросом,
+    потому что забирает единственный пробный запрос полуоткрытого выключателя"""
+    s = state(url)
+    if s == CLOSED:
+        return True
+    if s == HALF_OPEN:
+        # пробный запрос пропускаем только один на все воркеры
+        return cache.add(f'dmed_breaker_trial:{url}', 1, settings.DMED_BREAKER_COOLDOWN)
+    return False
+
+
+def record(url, seconds, ok):
+    # окно пишут все воркеры и потоки поиска: без блокировки одновременные замеры затирают друг друга
+    with cache.lock(f'{window_key(url)}:lock', timeout=5):
+        w = window(url)[-(WINDOW_SIZE - 1):]
+        w.append((time.time(), seconds, ok))
+
+        s = state(url)
+        if ok and s != CLOSED:
+            log.info(f'dmed breaker for {url} closed')
+            cache.delete_many([breaker_key(url), f'dmed_breaker_trial:{url}'])
+            w = [w[-1]]
+        elif not ok and (s == HALF_OPEN or tripped(w)):
+            log.warning(f'dmed breaker for {url} opened')
+            cache.set(breaker_key(url), dict(until=time.time() + settings.DMED_BREAKER_COOLDOWN), None)
+            cache.delete(f'dmed_breaker_trial:{url}')
+        cache.set(window_key(url), w, WINDOW_TIMEOUT)
+
+
+def tripped(w):
+    recent = w[-settings.DMED_BREAKER_MIN_SAMPLES * 2:]
+    errors = sum(1 for s in recent if not s[2])
+    return len(recent) >= settings.DMED_BREAKER_MIN_SAMPLES and errors / len(recent) >= settings.DMED_BREAKER_ERROR_RATE
+
+
+def status(url):
+    w = window(url)
+    latencies = sorted(s[1] for s in w)
+    return dict(
+        state=state(url),
+        samples=len(w),
+        error_rate=sum(1 for s in w if not s[2]) / len(w) if w else None,
+        p50_ms=int(latencies[len(latencies) // 2] * 1000) if latencies else None,
+        p95_ms=int(p95(url, 0) * 1000) or None,
+    )
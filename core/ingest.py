@@ -0,0 +1,318 @@
+"""Очередь обработки событий с камер EGSV
+
+Вебхук только проверяет событие, отсекает дубли и кладёт его в таблицу CaptureEvent,
+а разбирают очередь воркеры (manage.py ingest_captures).
+События одной камеры попадают в один шард и обрабатываются строго по порядку поступления.
+"""
+import json
+import logging
+import time
+import zlib
+from datetime import datetime, timedelta
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Min
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
+
+from api2.consumers import CameraConsumer
+from core import authz, bulk, dmed, metrics, stats
+from core.egsv import fetch_camera_checkpoint
+from core.models import Camera, CameraCapture, CaptureEvent, Vehicle, Person, CITIZENSHIPS_KZ, CITIZENSHIP_KZ
+
+log = logging.getLogger(__name__)
+
+STATS = (
+    'ingest_enqueued',
+    'ingest_processed',
+    'ingest_retries',
+    'ingest_failed',
+    'ingest_process_count',
+    'ingest_process_ms',
+)
+
+
+def validate(body):
+    """Проверяет, что событие EGSV содержит всё необходимое для обработки"""
+    try:
+        pl = body['body']
+        assert body['id']
+        assert pl['source']
+        assert pl['number']
+        lat, lon = pl['latlng']
+        assert pl['raw']['event']['uuid']
+        datetime.strptime(pl['raw']['event']['time'], '%Y-%m-%dT%H:%M:%S.%f%z')
+        for v in pl.get('iins', []):
+            assert v['iin']
+    except (AssertionError, KeyError, TypeError, ValueError) as e:
+        raise ValidationError(f'malformed egsv event: {e!r}')
+
+
+def shard_of(source):
+    return zlib.crc32(source.encode()) % settings.CAPTURE_INGEST_SHARDS
+
+
+def enqueue(bodies):
+    """Ставит события в очередь, уже поставленные игнорируются"""
+    CaptureEvent.objects.bulk_create([
+        CaptureEvent(
+            event_id=body['id'],
+            source=body['body']['source'],
+            shard=shard_of(body['body']['source']),
+            body=json.dumps(body),
+        ) for body in bodies
+    ], ignore_conflicts=True)
+    stats.incr('ingest_enqueued', len(bodies))
+
+
+def claim(shards, limit):
+    """Забирает в работу очередную пачку событий из указанных шардов
+
+    Взятые события скрываются от остальных на время аренды (CAPTURE_INGEST_LEASE),
+    если воркер упадёт, не завершив обработку, они вернутся в очередь.
+    Событие не берётся, пока в очереди ждёт повтора более раннее событие той же камеры.
+    """
+    now = timezone.now()
+    blocked = CaptureEvent.objects.filter(
+        status=CaptureEvent.Status.PENDING,
+        shard=OuterRef('shard'),
+        source=OuterRef('source'),
+        id__lt=OuterRef('id'),
+        available_at__gt=now,
+    )
+    with transaction.atomic():
+        events = list(
+            CaptureEvent.objects.select_for_update(skip_locked=True).filter(
+                ~Exists(blocked),
+                status=CaptureEvent.Status.PENDING,
+                shard__in=shards,
+                available_at__lte=now,
+            ).order_by('id')[:limit]
+        )
+        CaptureEvent.objects.filter(id__in=[e.id for e in events]).update(
+            available_at=now + timedelta(seconds=settings.CAPTURE_INGEST_LEASE)
+        )
+    return events
+
+
+def process_claimed(events):
+    """Обрабатывает взятые события одной пачкой
+
+    Если пачка не прошла, обрабатывает события по одному, чтобы повторять только сбойные;
+    при ошибке следующие события той же камеры ждут повтора.
+    """
+    start = time.monotonic()
+    try:
+        process_events([json.loads(e.body) for e in events])
+    except Exception:
+        log.exception(f'cannot process {len(events)} capture events at once, falling back to one by one')
+    else:
+        done(events)
+        stats.observe('ingest_process', time.monotonic() - start)
+        return
+
+    failed_sources = set()
+    for event in events:
+        if event.source in failed_sources:
+            # вернём в очередь за упавшим событием, чтобы не нарушить порядок
+            CaptureEvent.objects.filter(id=event.id).update(available_at=timezone.now())
+            continue
+
+        start = time.monotonic()
+        try:
+            process_events([json.loads(event.body)])
+        except Exception as e:
+            log.exception(f'cannot process capture event {event}')
+            failed_sources.add(event.source)
+            retry(event, e)
+        else:
+            done([event])
+        finally:
+            stats.observe('ingest_process', time.monotonic() - start)
+
+
+def done(events):
+    CaptureEvent.objects.filter(id__in=[e.id for e in events]).update(
+        status=CaptureEvent.Status.DONE, processed_at=timezone.now(), attempts=F('attempts') + 1
+    )
+    stats.incr('ingest_processed', len(events))
+
+
+def retry(event, error):
+    attempts = event.attempts + 1
+    if attempts >= settings.CAPTURE_INGEST_MAX_ATTEMPTS:
+        status = CaptureEvent.Status.FAILED
+        stats.incr('ingest_failed')
+    else:
+        status = CaptureEvent.Status.PENDING
+        stats.incr('ingest_retries')
+    CaptureEvent.objects.filter(id=event.id).update(
+        status=status,
+        attempts=attempts,
+        last_error=repr(error),
+        # экспоненциальная задержка: 2, 4, 8... секунд
+        available_at=timezone.now() + timedelta(seconds=2 ** attempts),
+    )
+
+
+def process_events(bodies):
+    """Сохраняет захваты камер и связанных людей, уведомляет инспекторов КПП
+
+    Камеры, транспорт, захваты и связи с людьми пишутся массовыми upsert-ами (по одному запросу на таблицу),
+    при повторах в пачке побеждает более позднее событие.
+    """
+    with transaction.atomic():
+        cameras = save_cameras(bodies)
+        bodies = [b for b in bodies if cameras[b['body']['source']].checkpoint_id]
+        if not bodies:
+            return
+
+        bulk.upsert(
+            Vehicle,
+            list({
+                pl['number']: Vehicle(grnz=pl['number'], model=pl.get('mark')) for pl in (b['body'] for b in bodies)
+            }.values()),
+            conflict_fields=['grnz'],
+            update_fields=['model', 'add_date'],
+        )
+
+        captures = {}
+        for body in bodies:
+            pl = body['body']
+            captures[pl['raw']['event']['uuid']] = CameraCapture(
+                id=pl['raw']['event']['uuid'],
+                # перезаписываем дату создания чтобы приложение видело новые изменения вверху
+                add_date=datetime.utcnow(),
+                date=datetime.strptime(pl['raw']['event']['time'], '%Y-%m-%dT%H:%M:%S.%f%z'),
+                camera=cameras[pl['source']],
+                vehicle_id=pl['number'],
+                raw_data=body,
+            )
+        bulk.upsert(
+            CameraCapture,
+            list(captures.values()),
+            conflict_fields=['id'],
+            update_fields=['add_date', 'date', 'camera', 'vehicle', 'raw_data'],
+        )
+        log.info(f'{len(captures)} captures saved')
+
+        persons = get_or_create_persons(
+            set(v['iin'] for b in bodies for v in b['body'].get('iins', []))
+        )
+        # КПП, на котором человека заметили (для выбора порядка опроса регионов DMED)
+        person_checkpoints = {
+            v['iin']: cameras[b['body']['source']].checkpoint for b in bodies for v in b['body'].get('iins', [])
+        }
+        CameraCapture.persons.through.objects.bulk_create([
+            CameraCapture.persons.through(cameracapture_id=b['body']['raw']['event']['uuid'], person=persons[v['iin']])
+            for b in bodies for v in b['body'].get('iins', [])
+        ], ignore_conflicts=True)
+
+    # захваты уже сохранены, поэтому ошибки DMED и рассылки не должны возвращать события в очередь
+    for person in persons.values():
+        # не только созданные сейчас: анкету мог создать другой воркер, а прошлая попытка - не наполнить
+        if person.dmed_id:
+            continue
+        try:
+            # одновременно этого человека может запрашивать инспектор - ищем в DMED один раз на всех
+            dmed.ensure_person(person.doc_id, person.citizenship_id, checkpoint=person_checkpoints[person.doc_id])
+        except Exception:
+            log.exception(f'cannot enrich person {person} from dmed')
+
+    # рассылаем уведомления по вебсокетам, по одному на камеру
+    channel_layer = get_channel_layer()
+    for camera_id in set(cameras[b['body']['source']].id for b in bodies):
+        try:
+            with metrics.timed('group_send'):
+                async_to_sync(channel_layer.group_send)(
+                    CameraConsumer.GROUP_NAME_TEMPLATE.format(camera_id),
+                    {
+                        'type': 'notify_about_event',
+                        'payload': {'event': 'refresh', 'type': 'CameraCapture'}
+                    }
+                )
+        except Exception:
+            log.exception(f'cannot notify camera {camera_id} inspectors')
+
+
+def save_cameras(bodies):
+    """Сохраняет камеры (идентифицируем только по имени) и связывает их с КПП по топологии EGSV"""
+    latlngs = {b['body']['source']: b['body']['latlng'] for b in bodies}
+    rows = bulk.upsert(
+        Camera,
+        [Camera(location=source, lat=lat, lon=lon) for source, (lat, lon) in latlngs.items()],
+        conflict_fields=['location'],
+        update_fields=['lat', 'lon', 'add_date'],
+        returning=['id', 'location', 'checkpoint'],
+    )
+
+    cameras = {}
+    moved = False
+    for camera_id, location, checkpoint_id in rows:
+        camera = Camera(id=camera_id, location=location, checkpoint_id=checkpoint_id)
+        # узнаем, с каким КПП она связана (если не связана в api - деассоциируем у нас)
+        cp = fetch_camera_checkpoint(camera.location)
+        if cp:
+            if camera.checkpoint_id != cp.id:
+                log.info(f'camera {camera} moved from {camera.checkpoint_id} to {cp}')
+                Camera.objects.filter(id=camera.id).update(checkpoint=cp)
+                moved = True
+            camera.checkpoint = cp
+        elif camera.checkpoint_id:
+            log.info(f'camera {camera} dissociated with checkpoint {camera.checkpoint_id}')
+            camera.checkpoint = None
+            Camera.objects.filter(id=camera.id).update(checkpoint=None)
+            moved = True
+        cameras[location] = camera
+    if moved:
+        # upsert и update() сигналов не отправляют, а камеры КПП - в снимках прав инспекторов;
+        # новая камера вставляется без КПП и попадает сюда же, когда её привязывают
+        authz.on_change(authz.invalidate)
+    return cameras
+
+
+def get_or_create_persons(iins):
+    """Находит или создаёт анкеты казахстанцев по ИИН, возвращает анкеты по ИИН"""
+    persons = {p.doc_id: p for p in Person.objects.filter(doc_id__in=iins, citizenship__in=CITIZENSHIPS_KZ)}
+    missing = iins - set(persons)
+    if not missing:
+        return persons
+
+    Person.objects.bulk_create([
+        Person(doc_id=iin, citizenship_id=CITIZENSHIP_KZ) for iin in missing
+    ], ignore_conflicts=True)
+    # среди них могут быть и созданные одновременно другим воркером
+    for person in Person.objects.filter(doc_id__in=missing, citizenship__in=CITIZENSHIPS_KZ):
+        log.info(f'person created {person}')
+        persons[person.doc_id] = person
+    return persons
+
+
+def purge():
+    """Удаляет давно обработанные события"""
+    deleted, _ = CaptureEvent.objects.filter(
+        status=CaptureEvent.Status.DONE,
+        processed_at__lt=timezone.now() - timedelta(seconds=settings.CAPTURE_INGEST_RETENTION),
+    ).delete()
+    return deleted
+
+
+def queue_status():
+    """Состояние очереди: отставание, пропускная способность, повторы"""
+    now = timezone.now()
+    pending = CaptureEvent.objects.filter(status=CaptureEvent.Status.PENDING)
+    oldest = pending.aggregate(oldest=Min('add_date'))['oldest']
+    s = dict(
+        pending=pending.count(),
+        retrying=pending.filter(attempts__gt=0).count(),
+        failed=CaptureEvent.objects.filter(status=CaptureEvent.Status.FAILED).count(),
+        processed_last_minute=CaptureEvent.objects.filter(
+            status=CaptureEvent.Status.DONE, processed_at__gte=now - timedelta(minutes=1)
+        ).count(),
+        lag_seconds=(now - oldest).total_seconds() if oldest else 0,
+    )
+    s.update(stats.snapshot(*STATS))
+    return s
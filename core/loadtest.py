@@ -0,0 +1,406 @@
+"""Нагрузочный прогон против запущенного экземпляра (manage.py load_replay)
+
+Воспроизводит события камер EGSV (api/webhook/webcam, api/webhook/webcam/batch) и сессии инспекторов (api/v2)
+с заданной скоростью и числом параллельных запросов, а по окончании ждёт, пока воркеры ingest_captures
+разберут очередь, и считает, сколько захватов в секунду обработал один воркер.
+
+Запись - JSONL, по запросу на строку:
+    {"at": 0.12, "kind": "event", "body": {... событие EGSV, как в api/webhook/webcam ...}}
+    {"at": 0.50, "kind": "api", "session": "inspector-1", "method": "GET",
+     "path": "/api/v2/inspector/checkpoint/cameras/{camera}/captures/", "params": {...}, "json": {...}}
+at - секунды от начала записи, session - чьими правами идёт запрос, {camera} - камера КПП инспектора.
+Без записи события и сессии генерируются (synthesize()).
+
+Все сущности прогона свои: камеры load-<прогон>-<имя>, КПП, id событий и uuid захватов, номера и ИИН.
+Запись можно воспроизвести несколько раз одновременно (scale) - каждая копия получает свои номера и ИИН,
+повторы номеров и ИИН внутри копии сохраняются.
+
+EGSV и DMED заменяются имитаторами (serve_egsv() и core.dmedstub). Экземпляр должен работать с той же базой
+и тем же кэшем, что и команда, а EGSV_CHECKPOINTS_URL у него должен указывать на имитатор EGSV.
+Нагрузка на БД и Redis берётся из /metrics экземпляра (по маршрутам) и из статистики самих серверов
+(pg_stat_database, INFO у Redis) - разница между началом и концом прогона.
+"""
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Max, Min
+
+from core import bench, dmedstub
+from core.models import CaptureEvent
+
+log = logging.getLogger(__name__)
+
+WEBHOOK = '/api/webhook/webcam'
+BATCH_WEBHOOK = '/api/webhook/webcam/batch'
+
+# сессия инспектора по умолчанию: очередь камеры, захват в досмотр, список проходов
+INSPECTOR_SESSION = (
+    ('GET', '/api/v2/inspector/checkpoint/cameras/'),
+    ('GET', '/api/v2/inspector/checkpoint/cameras/{camera}/captures/'),
+    ('POST', '/api/v2/inspector/checkpoint/passes/claim/'),
+    ('GET', '/api/v2/inspector/checkpoint/passes/'),
+)
+
+# счётчики /metrics, разница которых попадает в отчёт
+METRICS = ('http_requests_total', 'db_calls_total', 'cache_calls_total', 'cache_hits_total', 'cache_misses_total',
+           'dmed_calls_total', 'group_send_calls_total', 'db_duration_seconds_sum', 'cache_duration_seconds_sum')
+PG_STATS = ('xact_commit', 'xact_rollback', 'tup_returned', 'tup_fetched', 'tup_inserted', 'tup_updated',
+            'tup_deleted', 'blks_read', 'blks_hit')
+REDIS_STATS = ('total_commands_processed', 'keyspace_hits', 'keyspace_misses', 'total_net_input_bytes',
+               'total_net_output_bytes')
+
+
+class Call:
+    """Запрос прогона: events - пачка событий EGSV или запрос API от имени session"""
+
+    def __init__(self, at, kind, events=None, session=None, method='GET', path=None, params=None, json=None):
+        self.at = at
+        self.kind = kind
+        self.events = events or []
+        self.session = session
+        self.method = method
+        self.path = path
+        self.params = params
+        self.json = json
+
+    @property
+    def name(self):
+        if self.kind == 'event':
+            return 'webhook batch' if len(self.events) > 1 else 'webhook'
+        return f'{self.method} {self.path}'
+
+
+class Synthesizer:
+    """Уникальные для прогона id событий, uuid захватов, камеры, номера и ИИН"""
+
+    def __init__(self, run_id, rnd=None):
+        self.run_id = run_id
+        self.rnd = rnd or random.Random()
+        self.sources = set()
+        self.sessions = set()
+        self.plates = {}  # (копия, номер в записи) -> номер прогона
+        self.iins = {}  # (копия, ИИН в записи) -> ИИН прогона
+        self._events = 0
+
+    def source(self, name):
+        source = f'load-{self.run_id}-{name}'
+        self.sources.add(source)
+        return source
+
+    def session(self, name, copy=0):
+        session = f'load-{self.run_id}-{name}-{copy}'
+        self.sessions.add(session)
+        return session
+
+    def plate(self, copy, number):
+        key = copy, number
+        if key not in self.plates:
+            self.plates[key] = f'LT{self.run_id[:4].upper()}{len(self.plates):05}'
+        return self.plates[key]
+
+    def iin(self, copy, iin):
+        key = copy, iin
+        if key not in self.iins:
+            taken = set(self.iins.values())
+            v = dmedstub.random_iin(self.rnd)
+            while v in taken:
+                v = dmedstub.random_iin(self.rnd)
+            self.iins[key] = v
+        return self.iins[key]
+
+    def event(self, body, copy=0):
+        """Копия события EGSV со своими id, uuid, камерой, номером и ИИН"""
+        body = json.loads(json.dumps(body))
+        self._events += 1
+        body['id'] = f'load-{self.run_id}-{self._events}'
+        pl = body['body']
+        pl['source'] = self.source(pl['source'])
+        pl['number'] = self.plate(copy, pl['number'])
+        pl['iins'] = [dict(v, iin=self.iin(copy, v['iin'])) for v in pl.get('iins', [])]
+        pl.setdefault('raw', {}).setdefault('event', {})
+        pl['raw']['event']['uuid'] = str(uuid.uuid4())
+        pl['raw']['event']['time'] = datetime.now().astimezone().strftime('%Y-%m-%dT%H:%M:%S.%f%z')
+        return body
+
+    @property
+    def event_prefix(self):
+        return f'load-{self.run_id}-'
+
+
+def load_recording(path):
+    with open(path) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def replay(records, synthesizer, scale=1, speed=1.0, batch=1):
+    """Запросы прогона по записи, воспроизведённой scale раз одновременно"""
+    calls = []
+    for copy in range(scale):
+        events = []
+        for r in sorted(records, key=lambda r: r['at']):
+            at = r['at'] / speed
+            if r['kind'] == 'event':
+                events.append((at, synthesizer.event(r['body'], copy)))
+            else:
+                calls.append(Call(
+                    at, 'api', session=synthesizer.session(r['session'], copy), method=r.get('method', 'GET'),
+                    path=r['path'], params=r.get('params'), json=r.get('json'),
+                ))
+        calls.extend(batched(events, batch))
+    return sorted(calls, key=lambda c: c.at)
+
+
+def synthesize(synthesizer, events=1000, rate=50.0, cameras=8, iins=2, repeat=0.2, inspectors=4, think=1.0,
+               batch=1, rnd=None):
+    """Запросы прогона без записи
+
+    :param events: сколько событий EGSV отправить со скоростью rate в секунду
+    :param cameras: на скольких камерах
+    :param iins: максимум ИИН в событии
+    :param repeat: доля номеров и ИИН, уже встречавшихся в прогоне
+    :param inspectors: сколько инспекторов одновременно проходят INSPECTOR_SESSION по кругу,
+        с паузой think секунд между запросами, пока идут события
+    """
+    rnd = rnd or random.Random()
+    numbers, persons, timed_events = [], [], []
+    for i in range(events):
+        if numbers and rnd.random() < repeat:
+            number = rnd.choice(numbers)
+        else:
+            number = f'N{i}'
+            numbers.append(number)
+        event_iins = []
+        for _ in range(rnd.randint(0, iins)):
+            if persons and rnd.random() < repeat:
+                event_iins.append(rnd.choice(persons))
+            else:
+                event_iins.append(f'P{len(persons)}')
+                persons.append(event_iins[-1])
+        body = dict(id=None, body=dict(
+            source=f'cam-{i % cameras}',
+            number=number,
+            latlng=[51.1 + i % cameras / 1000, 71.4],
+            iins=[dict(iin=v) for v in dict.fromkeys(event_iins)],
+            raw=dict(event={}),
+        ))
+        timed_events.append((i / rate, synthesizer.event(body)))
+
+    calls = batched(timed_events, batch)
+    duration = events / rate
+    for i in range(inspectors):
+        session = synthesizer.session(f'inspector-{i}')
+        at, step = think * i / max(inspectors, 1), 0
+        while at < duration:
+            method, path = INSPECTOR_SESSION[step % len(INSPECTOR_SESSION)]
+            calls.append(Call(at, 'api', session=session, method=method, path=path))
+            at += think
+            step += 1
+    return sorted(calls, key=lambda c: c.at)
+
+
+def batched(timed_events, batch):
+    """Пачки по batch событий, каждая уходит во время последнего события в ней"""
+    return [
+        Call(timed_events[i + len(chunk) - 1][0], 'event', events=[body for at, body in chunk])
+        for i in range(0, len(timed_events), batch)
+        for chunk in [timed_events[i:i + batch]]
+    ]
+
+
+class Client:
+    """HTTP к проверяемому экземпляру: keep-alive соединение на поток, токен на сессию"""
+
+    def __init__(self, url, tokens, webhook_token, cameras):
+        self.url = url.rstrip('/')
+        self.tokens = tokens
+        self.webhook_token = webhook_token
+        self.cameras = cameras  # сессия -> id камер её КПП
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        s = getattr(self._local, 'session', None)
+        if s is None:
+            s = self._local.session = requests.Session()
+        return s
+
+    def send(self, call):
+        """Отправляет запрос, возвращает HTTP статус"""
+        if call.kind == 'event':
+            if len(call.events) > 1:
+                path, body = BATCH_WEBHOOK, call.events
+            else:
+                path, body = WEBHOOK, call.events[0]
+            rv = self.session.post(self.url + path, json=body, timeout=30,
+                                   headers={'Authorization': f'Token {self.webhook_token}'})
+        else:
+            path = call.path
+            if '{camera}' in path:
+                path = path.format(camera=random.choice(self.cameras[call.session]))
+            rv = self.session.request(call.method, self.url + path, params=call.params, json=call.json, timeout=30,
+                                      headers={'Authorization': f'Token {self.tokens[call.session]}'})
+        return rv.status_code
+
+
+def route_of(call):
+    """Запросы в отчёте группируются по шаблону пути: числа и uuid заменяются на {id}"""
+    if call.kind == 'event':
+        return call.name
+    return f'{call.method} ' + re.sub(r'/(\d+|[0-9a-f-]{36})(?=/|$)', '/{id}', call.path)
+
+
+def run(client, calls, concurrency):
+    """Отправляет запросы по расписанию (открытая модель нагрузки: следующий не ждёт предыдущего)
+
+    Возвращает (результаты по маршрутам {маршрут: [(секунд, ошибка)]}, статусы по маршрутам,
+    максимальное отставание от расписания в секундах, длительность).
+    """
+    results = defaultdict(list)
+    statuses = defaultdict(Counter)
+    lock = threading.Lock()
+    lag = 0.0
+
+    def send(call):
+        start = time.monotonic()
+        error, code = None, None
+        try:
+            code = client.send(call)
+            if code >= 400:
+                error = f'HTTP {code}'
+        except requests.RequestException as e:
+            error = repr(e)
+        elapsed = time.monotonic() - start
+        route = route_of(call)
+        with lock:
+            results[route].append((elapsed, error))
+            statuses[route][code or 'error'] += 1
+
+    start = time.monotonic()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for call in calls:
+            delay = start + call.at - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                lag = max(lag, -delay)
+            executor.submit(send, call)
+    return results, statuses, lag, time.monotonic() - start
+
+
+def report(results, elapsed):
+    """Сводки bench.summary по маршрутам и по всем запросам"""
+    everything = [r for rs in results.values() for r in rs]
+    summaries = {route: bench.summary(rs, elapsed) for route, rs in sorted(results.items())}
+    return bench.summary(everything, elapsed), summaries
+
+
+def wait_drained(prefix, sent, timeout, poll=1.0):
+    """Ждёт, пока воркеры обработают события прогона; (обработано, ошибок, сек. от первой постановки до последней)"""
+    deadline = time.monotonic() + timeout
+    events = CaptureEvent.objects.filter(event_id__startswith=prefix)
+    while True:
+        counts = Counter(events.values_list('status', flat=True))
+        finished = counts[CaptureEvent.Status.DONE] + counts[CaptureEvent.Status.FAILED]
+        if finished >= sent or time.monotonic() > deadline:
+            break
+        time.sleep(poll)
+    window = events.filter(status=CaptureEvent.Status.DONE).aggregate(
+        first=Min('add_date'), last=Max('processed_at')
+    )
+    seconds = (window['last'] - window['first']).total_seconds() if window['last'] else None
+    return counts[CaptureEvent.Status.DONE], counts[CaptureEvent.Status.FAILED], seconds
+
+
+def scrape_metrics(url, token=None):
+    """Сумма счётчиков METRICS из /metrics экземпляра по маршрутам: {(имя, маршрут): значение}"""
+    headers = {'Authorization': f'Bearer {token}'} if token else {}
+    try:
+        rv = requests.get(url.rstrip('/') + '/metrics', headers=headers, timeout=10)
+        rv.raise_for_status()
+    except requests.RequestException as e:
+        log.warning(f'cannot scrape metrics: {e}')
+        return {}
+    values = Counter()
+    for line in rv.text.splitlines():
+        m = re.match(r'(\w+)\{([^}]*)\} (\S+)$', line)
+        if not m or m.group(1) not in METRICS:
+            continue
+        route = re.search(r'route="([^"]*)"', m.group(2))
+        values[m.group(1), route.group(1) if route else ''] += float(m.group(3))
+    return values
+
+
+def db_stats():
+    """Счётчики PostgreSQL по текущей базе или {} на других СУБД"""
+    if connection.vendor != 'postgresql':
+        return {}
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT {", ".join(PG_STATS)} FROM pg_stat_database WHERE datname = current_database()'
+        )
+        return dict(zip(PG_STATS, cursor.fetchone()))
+
+
+def redis_stats():
+    """Счётчики INFO сервера Redis кэша или {}, если кэш не в Redis"""
+    try:
+        info = cache.get_master_client().info()
+    except Exception:
+        return {}
+    return {k: info[k] for k in REDIS_STATS if k in info}
+
+
+def delta(before, after):
+    return {k: after[k] - before.get(k, 0) for k in after if after[k] != before.get(k, 0)}
+
+
+def topology(sources, checkpoints):
+    """Документ EGSV: камеры прогона по кругу распределены по КПП"""
+    checkpoints = list(checkpoints)
+    doc = {cp.id: dict(name=cp.name, parent=None, sources=[]) for cp in checkpoints}
+    for i, source in enumerate(sorted(sources)):
+        doc[checkpoints[i % len(checkpoints)].id]['sources'].append(source)
+    return dict(checkpoints=doc)
+
+
+def serve_egsv(doc, host='127.0.0.1', port=0):
+    """Имитатор EGSV: отдаёт документ топологии на любой GET, возвращает (сервер, url)"""
+    data = json.dumps(doc, ensure_ascii=False).encode()
+    etag = f'"{uuid.uuid4().hex}"'
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.send_header('ETag', etag)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='egsv-stub', daemon=True).start()
+    return server, f'http://{host}:{server.server_port}/checkpoints?sources=1'
@@ -0,0 +1,103 @@
+import random
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from core import bench, dmed, dmedstub
+from core.models import Country, Person, Region, User, CITIZENSHIP_KZ
+from core.service import DMEDService
+
+MODES = ('service', 'update', 'retrieve')
+
+
+class Command(BaseCommand):
+    help = 'Замеряет обращения к DMED на локальном имитаторе: DMEDService, Person.update_from_dmed, GET /api/person/{иин}'
+
+    def add_arguments(self, parser):
+        dmedstub.add_arguments(parser)
+        parser.add_argument('--url', help='адрес уже запущенного имитатора (manage.py dmed_stub) с той же конфигурацией')
+        parser.add_argument('--mode', choices=MODES, action='append', help='что замерять (по умолчанию всё)')
+        parser.add_argument('--requests', type=int, default=200, help='запросов на каждый замер')
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--seed', type=int, help='для повторяемого набора ИИН')
+
+    def handle(self, *args, url, mode, requests, concurrency, seed, **options):
+        config = dmedstub.config_from_options(options)
+        server = simulator = None
+        if not url:
+            server, simulator, url = dmedstub.serve(config)
+
+        # регионы и пользователь бенчмарка создаются на время замера и удаляются после
+        run_id = uuid.uuid4().hex[:8]
+        Country.objects.get_or_create(pk=CITIZENSHIP_KZ)
+        regions = [
+            Region.objects.create(name=f'bench-{run_id} {name}', dmed_url=f'{url}{name}/', dmed_priority=i)
+            for i, name in enumerate(config['regions'])
+        ]
+        user = User.objects.create(username=f'dmed-bench-{run_id}', is_superuser=True)
+        rnd = random.Random(seed)
+        iins = []
+
+        # опрашиваем только регионы имитатора, даже если в базе есть настоящие
+        enabled_regions = dmed.enabled_regions
+        dmed.enabled_regions = lambda: regions
+        try:
+            for m in mode or MODES:
+                batch = [dmedstub.random_iin(rnd) for _ in range(requests)]
+                iins.extend(batch)
+                s = bench.run(getattr(self, f'bench_{m}')(regions, user, config), batch, concurrency)
+                self.stdout.write(bench.format_summary(m, s))
+                if s['first_error']:
+                    self.stderr.write(s['first_error'])
+        finally:
+            dmed.enabled_regions = enabled_regions
+            Person.objects.filter(doc_id__in=iins).delete()
+            Region.objects.filter(pk__in=[r.pk for r in regions]).delete()
+            user.delete()
+            cache.delete_many([dmed.memo_key(iin) for iin in iins])
+            if server:
+                server.shutdown()
+
+        if simulator:
+            for (region, method), count in sorted(simulator.calls.items()):
+                self.stdout.write(f'  {region} {method}: {count} requests, {simulator.errors[region, method]} errors')
+
+    def bench_service(self, regions, user, config):
+        """Поиск, детали и маркеры в одном регионе, где человек точно есть, без записи в БД"""
+        simulator = dmedstub.Simulator(config)
+        by_name = {r.dmed_url.rstrip('/').rsplit('/', 1)[-1]: r for r in regions}
+
+        def call(iin):
+            owner = simulator.owner(iin)
+            region = by_name[owner] if owner else regions[0]
+            s = DMEDService(url=region.dmed_url, username=settings.DMED_LOGIN, password=settings.DMED_PASSWORD)
+            r = s.fetch_person(iin)
+            if r:
+                s.fetch_person_detail(r['rpnID'])
+                s.fetch_person_markers(r['id'])
+        return call
+
+    def bench_update(self, regions, user, config):
+        """Person.update_from_dmed по всем регионам для новой анкеты"""
+        def call(iin):
+            p = Person.objects.create(doc_id=iin, citizenship_id=CITIZENSHIP_KZ)
+            p.update_from_dmed()
+        return call
+
+    def bench_retrieve(self, regions, user, config):
+        """GET /api/person/{иин} целиком: создание анкеты, поиск в DMED и сериализация"""
+        from rest_framework.test import APIRequestFactory, force_authenticate
+        from api.viewsets import PersonViewSet
+
+        view = PersonViewSet.as_view({'get': 'retrieve'})
+        factory = APIRequestFactory()
+
+        def call(iin):
+            request = factory.get(f'/api/person/{iin}/')
+            force_authenticate(request, user)
+            response = view(request, pk=iin)
+            if response.status_code != 200:
+                raise Exception(f'HTTP {response.status_code}: {response.data}')
+        return call
@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from core import prefetch
+
+
+class Command(BaseCommand):
+    help = 'Заранее наполняет анкеты из DMED по списку ИИН (CSV или JSONL, см. core.prefetch.read)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--rate', type=float, default=settings.DMED_PREFETCH_RATE,
+                            help='анкет в секунду, запрашиваемых из DMED, 0 - без ограничения')
+        parser.add_argument('--journal', help='журнал обработанных ИИН для продолжения после остановки '
+                                              '(по умолчанию <path>.done)')
+        parser.add_argument('--progress', type=float, default=5, help='как часто выводить прогресс, с')
+
+    def handle(self, *args, path, workers, rate, journal, progress, **options):
+        with open(path, 'rb') as fp:
+            rows = prefetch.read(fp, path)
+        self.stdout.write(f'{len(rows)} iins in {path}')
+
+        try:
+            p = prefetch.run(
+                rows,
+                workers,
+                journal=journal or f'{path}.done',
+                on_progress=lambda p: self.stdout.write(str(p)),
+                progress_interval=progress,
+                rate=rate,
+            )
+        except KeyboardInterrupt:
+            self.stdout.write('interrupted, run again to continue')
+            return
+        self.stdout.write(self.style.SUCCESS(f'done: {p}'))
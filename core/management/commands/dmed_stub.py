@@ -0,0 +1,28 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from core import dmedstub
+
+
+class Command(BaseCommand):
+    help = 'Запускает локальный имитатор DMED (см. core.dmedstub)'
+
+    def add_arguments(self, parser):
+        dmedstub.add_arguments(parser)
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8800)
+
+    def handle(self, *args, host, port, **options):
+        server, simulator, url = dmedstub.serve(dmedstub.config_from_options(options), host, port)
+        for name in simulator.regions:
+            self.stdout.write(f'{name}: {url}{name}/')
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.shutdown()
+        for (region, method), count in sorted(simulator.calls.items()):
+            self.stdout.write(f'{region} {method}: {count} requests, {simulator.errors[region, method]} errors')
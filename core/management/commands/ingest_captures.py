@@ -0,0 +1,72 @@
+import logging
+import multiprocessing
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from core import ingest, metrics
+
+log = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Запускает пул воркеров, разбирающих очередь событий с камер EGSV'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.CAPTURE_INGEST_WORKERS)
+        parser.add_argument('--batch', type=int, default=50, help='сколько событий брать за раз')
+        parser.add_argument('--poll', type=float, default=0.5, help='пауза в секундах, если очередь пуста')
+
+    def handle(self, *args, workers, batch, poll, **options):
+        workers = min(workers, settings.CAPTURE_INGEST_SHARDS)
+        # у каждого воркера свой набор шардов, поэтому события одной камеры не обрабатываются параллельно
+        shards = {i: [s for s in range(settings.CAPTURE_INGEST_SHARDS) if s % workers == i] for i in range(workers)}
+
+        # соединения с БД не должны наследоваться дочерними процессами
+        connections.close_all()
+        processes = {}
+        stopping = False
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        while not stopping:
+            for i in shards:
+                if i not in processes or not processes[i].is_alive():
+                    if i in processes:
+                        log.warning(f'ingest worker {i} died with code {processes[i].exitcode}, restarting')
+                    processes[i] = multiprocessing.Process(
+                        target=work, args=(shards[i], batch, poll), name=f'ingest-{i}', daemon=True
+                    )
+                    processes[i].start()
+            time.sleep(1)
+
+        for p in processes.values():
+            p.terminate()
+        for p in processes.values():
+            p.join()
+
+
+def work(shards, batch, poll):
+    log.info(f'ingest worker started for shards {shards}')
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # останавливает родитель через SIGTERM
+    purged_at = 0
+    while True:
+        events = ingest.claim(shards, batch)
+        if events:
+            with metrics.task('ingest'):
+                ingest.process_claimed(events)
+        else:
+            time.sleep(poll)
+
+        if shards[0] == 0 and time.monotonic() - purged_at > 60 * 10:
+            # чистит только один воркер
+            log.info(f'purged {ingest.purge()} processed capture events')
+            purged_at = time.monotonic()
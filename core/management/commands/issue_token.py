@@ -0,0 +1,39 @@
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand, CommandError
+
+from core import auth
+from core.models import User
+
+
+class Command(BaseCommand):
+    help = 'Выдаёт токен API пользователю, например сервисной учётке вебхука EGSV (Authorization: Token <ключ>)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('username')
+        parser.add_argument('--create', action='store_true', help='создать сервисного пользователя без пароля')
+        parser.add_argument('--group', action='append', default=[], help='добавить пользователя в группу')
+        parser.add_argument('--rotate', action='store_true', help='выпустить новый токен, отозвав прежний')
+        parser.add_argument('--revoke', action='store_true', help='только отозвать токен')
+
+    def handle(self, *args, username, create, group, rotate, revoke, **options):
+        user = User.objects.filter(username=username).first()
+        if user is None:
+            if not create:
+                raise CommandError(f'user {username} does not exist, use --create for a service account')
+            user = User(username=username)
+            user.set_unusable_password()
+            user.save()
+            self.stderr.write(f'created user {username}')
+
+        for name in group:
+            try:
+                user.groups.add(Group.objects.get(name=name))
+            except Group.DoesNotExist:
+                raise CommandError(f'group {name} does not exist')
+
+        if revoke:
+            auth.revoke(user)
+            self.stderr.write(f'token of {username} revoked')
+            return
+
+        self.stdout.write(auth.issue(user, rotate=rotate).key)
@@ -0,0 +1,186 @@
+import random
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core.management.base import BaseCommand
+
+from core import auth, authz, bench, dmedstub, egsv, loadtest
+from core.models import (
+    Camera, CameraCapture, CaptureEvent, Checkpoint, CheckpointPass, Country, Person, Region, User, Vehicle,
+    CITIZENSHIP_KZ,
+)
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный прогон запущенного экземпляра: события EGSV и сессии инспекторов из записи '
+            'или сгенерированные, с имитаторами EGSV и DMED (см. core.loadtest)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', required=True, help='адрес экземпляра, например http://127.0.0.1:8000/')
+        parser.add_argument('--recording', help='JSONL с событиями и запросами API (формат в core.loadtest)')
+        parser.add_argument('--scale', type=int, default=1, help='сколько копий записи воспроизводить одновременно')
+        parser.add_argument('--speed', type=float, default=1.0, help='во сколько раз ускорить запись')
+        parser.add_argument('--events', type=int, default=1000, help='событий без записи')
+        parser.add_argument('--rate', type=float, default=50.0, help='событий в секунду без записи')
+        parser.add_argument('--cameras', type=int, default=8, help='камер без записи')
+        parser.add_argument('--iins', type=int, default=2, help='максимум ИИН в событии без записи')
+        parser.add_argument('--repeat', type=float, default=0.2, help='доля повторных номеров и ИИН без записи')
+        parser.add_argument('--inspectors', type=int, default=4, help='инспекторов без записи')
+        parser.add_argument('--think', type=float, default=1.0, help='пауза инспектора между запросами, с')
+        parser.add_argument('--batch', type=int, default=1, help='событий в запросе (больше 1 - webhook/webcam/batch)')
+        parser.add_argument('--concurrency', type=int, default=32, help='максимум одновременных запросов')
+        parser.add_argument('--checkpoints', type=int, default=2, help='КПП прогона')
+        parser.add_argument('--egsv-port', type=int, default=8801,
+                            help='порт имитатора EGSV (на него должен указывать EGSV_CHECKPOINTS_URL экземпляра)')
+        parser.add_argument('--isolate-dmed', action='store_true',
+                            help='на время прогона убрать dmed_url у настоящих регионов, чтобы не опрашивать их')
+        parser.add_argument('--ingest-workers', type=int, default=settings.CAPTURE_INGEST_WORKERS,
+                            help='сколько воркеров ingest_captures запущено у экземпляра')
+        parser.add_argument('--drain-timeout', type=float, default=300, help='сколько ждать разбора очереди, с')
+        parser.add_argument('--metrics-token', default=settings.METRICS_TOKEN)
+        parser.add_argument('--keep', action='store_true', help='не удалять данные прогона')
+        parser.add_argument('--seed', type=int, help='для повторяемого набора номеров и ИИН')
+        dmedstub.add_arguments(parser)
+
+    def handle(self, *args, url, recording, scale, speed, batch, concurrency, checkpoints, egsv_port, isolate_dmed,
+               ingest_workers, drain_timeout, metrics_token, keep, seed, **options):
+        rnd = random.Random(seed)
+        run_id = uuid.uuid4().hex[:8]
+        synthesizer = loadtest.Synthesizer(run_id, rnd)
+        if recording:
+            calls = loadtest.replay(loadtest.load_recording(recording), synthesizer, scale, speed, batch)
+        else:
+            calls = loadtest.synthesize(
+                synthesizer, events=options['events'], rate=options['rate'], cameras=options['cameras'],
+                iins=options['iins'], repeat=options['repeat'], inspectors=options['inspectors'],
+                think=options['think'], batch=batch, rnd=rnd,
+            )
+        sent = sum(len(c.events) for c in calls)
+
+        config = dmedstub.config_from_options(options)
+        dmed_server, simulator, dmed_url = dmedstub.serve(config)
+        egsv_server = None
+        isolated = {}
+        users = []
+        try:
+            # данные прогона: регионы имитатора DMED, КПП с камерами, пользователи с токенами
+            kz, _ = Country.objects.get_or_create(pk=CITIZENSHIP_KZ)
+            real = Region.objects.exclude(dmed_url=None).exclude(dmed_url='')
+            if isolate_dmed:
+                isolated = dict(real.values_list('pk', 'dmed_url'))
+                for region in Region.objects.filter(pk__in=isolated):
+                    region.dmed_url = None
+                    region.save()
+            elif real.exists():
+                self.stderr.write('экземпляр будет опрашивать и настоящие регионы DMED, см. --isolate-dmed')
+            regions = [
+                Region.objects.create(name=f'load-{run_id} {name}', country=kz, dmed_url=f'{dmed_url}{name}/',
+                                      dmed_priority=i)
+                for i, name in enumerate(config['regions'])
+            ]
+            cps = [
+                Checkpoint.objects.create(id=f'load-{run_id}-cp{i}', name=f'КПП load-{run_id} {i}', region=regions[0])
+                for i in range(checkpoints)
+            ]
+            doc = loadtest.topology(synthesizer.sources, cps)
+            for cid, c in doc['checkpoints'].items():
+                Camera.objects.bulk_create([Camera(location=s, checkpoint_id=cid) for s in c['sources']])
+            authz.invalidate()  # камеры добавлены bulk_create, без сигналов
+
+            egsv_server, egsv_url = loadtest.serve_egsv(doc, port=egsv_port)
+            # экземпляр подхватит топологию из общего кэша, не дожидаясь своего обновления
+            egsv.TopologyCache(url=egsv_url, refresh_interval=0, max_age=0).refresh(stale_ok=False)
+            if settings.EGSV_CHECKPOINTS_URL != egsv_url:
+                self.stderr.write(f'экземпляр должен быть запущен с EGSV_CHECKPOINTS_URL={egsv_url}')
+
+            webhook_user = User.objects.create_user(f'load-{run_id}-egsv')
+            users.append(webhook_user)
+            inspectors = Group.objects.get(name=authz.INSPECTORS)
+            tokens, cameras = {}, {}
+            for i, session in enumerate(sorted(synthesizer.sessions)):
+                user = User.objects.create_user(session, checkpoint=cps[i % len(cps)])
+                user.groups.add(inspectors)
+                users.append(user)
+                tokens[session] = auth.issue(user).key
+                cameras[session] = list(Camera.objects.filter(checkpoint=user.checkpoint).values_list('id', flat=True))
+            client = loadtest.Client(url, tokens, auth.issue(webhook_user).key, cameras)
+
+            self.stdout.write(f'run {run_id}: {len(calls)} requests, {sent} events, '
+                              f'{len(synthesizer.sessions)} inspector sessions, concurrency {concurrency}')
+            metrics_before = loadtest.scrape_metrics(url, metrics_token)
+            db_before, redis_before = loadtest.db_stats(), loadtest.redis_stats()
+
+            results, statuses, lag, elapsed = loadtest.run(client, calls, concurrency)
+            total, summaries = loadtest.report(results, elapsed)
+            self.stdout.write(bench.format_summary('total', total))
+            for route, s in summaries.items():
+                codes = ', '.join(f'{code}: {n}' for code, n in sorted(statuses[route].items(), key=str))
+                self.stdout.write(f'  {bench.format_summary(route, s)} ({codes})')
+                if s['first_error']:
+                    self.stderr.write(f'    {s["first_error"]}')
+            self.stdout.write(f'schedule lag: max {lag:.2f} s')
+
+            if sent:
+                done, failed, seconds = loadtest.wait_drained(synthesizer.event_prefix, sent, drain_timeout)
+                line = f'ingest: {done} of {sent} events processed, {failed} failed'
+                if seconds:
+                    rate = done / seconds
+                    line += (f' in {seconds:.1f} s: {rate:.1f} captures/s, '
+                             f'{rate / max(ingest_workers, 1):.1f} captures/s per worker ({ingest_workers} workers)')
+                self.stdout.write(line)
+
+            self.write_load(
+                loadtest.delta(metrics_before, loadtest.scrape_metrics(url, metrics_token)),
+                loadtest.delta(db_before, loadtest.db_stats()),
+                loadtest.delta(redis_before, loadtest.redis_stats()),
+            )
+            for (region, method), count in sorted(simulator.calls.items()):
+                self.stdout.write(f'  dmed {region} {method}: {count} requests, '
+                                  f'{simulator.errors[region, method]} errors')
+        finally:
+            if egsv_server:
+                egsv_server.shutdown()
+            dmed_server.shutdown()
+            for region in Region.objects.filter(pk__in=isolated):
+                region.dmed_url = isolated[region.pk]
+                region.save()
+            if not keep:
+                self.cleanup(run_id, synthesizer, users)
+
+    def write_load(self, metrics, db, redis):
+        """Нагрузка на БД и кэш за прогон"""
+        routes = defaultdict(dict)
+        for (name, route), v in metrics.items():
+            if route != 'metrics':  # наши же опросы /metrics
+                routes[route][name] = v
+        if routes:
+            self.stdout.write('per route (from /metrics):')
+        for route, m in sorted(routes.items()):
+            requests = m.get('http_requests_total', 0)
+            lookups = m.get('cache_hits_total', 0) + m.get('cache_misses_total', 0)
+            line = (f'  {route}: {requests:.0f} requests, db {m.get("db_calls_total", 0):.0f} queries '
+                    f'{m.get("db_duration_seconds_sum", 0):.2f} s, cache {m.get("cache_calls_total", 0):.0f} calls '
+                    f'{m.get("cache_duration_seconds_sum", 0):.2f} s')
+            if lookups:
+                line += f' ({m.get("cache_hits_total", 0) / lookups:.0%} hits)'
+            if m.get('dmed_calls_total'):
+                line += f', dmed {m["dmed_calls_total"]:.0f} calls'
+            self.stdout.write(line)
+        if db:
+            self.stdout.write('postgres: ' + ', '.join(f'{k} {v}' for k, v in db.items()))
+        if redis:
+            self.stdout.write('redis: ' + ', '.join(f'{k} {v}' for k, v in redis.items()))
+
+    def cleanup(self, run_id, synthesizer, users):
+        cps = Checkpoint.objects.filter(id__startswith=f'load-{run_id}-')
+        CheckpointPass.objects.filter(checkpoint__in=cps).delete()
+        CameraCapture.objects.filter(camera__location__in=synthesizer.sources).delete()
+        Camera.objects.filter(location__in=synthesizer.sources).delete()
+        cps.delete()
+        Region.objects.filter(name__startswith=f'load-{run_id} ').delete()
+        Vehicle.objects.filter(grnz__in=synthesizer.plates.values()).delete()
+        Person.objects.filter(doc_id__in=synthesizer.iins.values()).delete()
+        CaptureEvent.objects.filter(event_id__startswith=synthesizer.event_prefix).delete()
+        User.objects.filter(pk__in=[u.pk for u in users]).delete()
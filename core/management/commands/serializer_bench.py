@@ -0,0 +1,97 @@
+import json
+import time
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Count
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from api2.viewsets import CheckpointCameraCaptureViewSet, InspectorCheckpointPassViewSet
+from core import authz, bench, testing
+from core.models import CameraCapture, CheckpointPass, User
+
+SERIALIZERS = ('drf', 'fast')
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает страницы списков захватов и проходов api2 с сериализаторами DRF и api2.fastserializers: '
+            'время запроса с отрисовкой JSON, число SQL-запросов и совпадение ответов')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page-size', type=int, default=100)
+        parser.add_argument('--requests', type=int, default=50, help='запросов на каждый замер')
+        parser.add_argument('--seed', type=int, metavar='CAPTURES',
+                            help='заполнить базу захватами (core.testing.seed); всё откатывается после замера')
+
+    def handle(self, *args, page_size, requests, seed, **options):
+        # замер идёт в транзакции, которая откатывается: и заполнение, и пользователь замера не остаются в базе
+        with transaction.atomic():
+            if seed:
+                testing.seed(captures=seed)
+            try:
+                self.bench(page_size, requests)
+            finally:
+                transaction.set_rollback(True)
+
+    def bench(self, page_size, requests):
+        busiest = CameraCapture.objects.filter(pending=True).values('camera', 'camera__checkpoint').annotate(
+            n=Count('id')
+        ).order_by('-n').first()
+        if not busiest or not busiest['camera__checkpoint']:
+            raise CommandError('no pending captures on checkpoint cameras, use --seed')
+        user = User.objects.create_superuser(f'serializer-bench-{time.monotonic_ns()}', None, None,
+                                             checkpoint_id=busiest['camera__checkpoint'])
+        passes = CheckpointPass.objects.filter(checkpoint_id=user.checkpoint_id).count()
+        self.stdout.write(f'camera {busiest["camera"]}: {busiest["n"]} pending captures, '
+                          f'checkpoint {user.checkpoint_id}: {passes} passes, pages of {page_size}')
+
+        endpoints = (
+            ('captures', CheckpointCameraCaptureViewSet, dict(camera_pk=busiest['camera'])),
+            ('passes', InspectorCheckpointPassViewSet, {}),
+        )
+        factory = APIRequestFactory()
+        try:
+            for name, viewset, kwargs in endpoints:
+                view = viewset.as_view({'get': 'list'})
+
+                def get(serializer):
+                    request = factory.get('/', {'cursor': '', 'page_size': page_size, 'serializer': serializer})
+                    force_authenticate(request, user)
+                    response = view(request, **kwargs)
+                    response.render()
+                    if response.status_code != 200:
+                        raise CommandError(f'{name}: HTTP {response.status_code}: {response.content[:200]}')
+                    return response
+
+                bodies = {}
+                for serializer in SERIALIZERS:
+                    get(serializer)  # прогрев: снимок прав, компиляция быстрого сериализатора
+                    with CaptureQueriesContext(connection) as queries:
+                        bodies[serializer] = normalized(get(serializer))
+                    results = []
+                    for _ in range(requests):
+                        start = time.monotonic()
+                        get(serializer)
+                        results.append((time.monotonic() - start, None))
+                    s = bench.summary(results, sum(seconds for seconds, error in results))
+                    self.stdout.write(f'{bench.format_summary(f"{name} {serializer}", s)}, {len(queries)} queries')
+
+                rows = len(bodies['drf']['results'])
+                if bodies['fast'] == bodies['drf']:
+                    self.stdout.write(f'{name}: responses match ({rows} rows)')
+                else:
+                    self.stderr.write(f'{name}: responses differ')
+        finally:
+            cache.delete(authz.user_key(user.pk))
+
+
+def normalized(response):
+    """Ответ для сравнения: ссылка на следующую страницу отличается параметром serializer,
+    порядок людей в списке не задан"""
+    data = json.loads(response.content)
+    data['next'] = bool(data['next'])
+    for row in data['results']:
+        row['persons'].sort(key=lambda p: p['id'])
+    return data
@@ -0,0 +1,344 @@
+"""Метрики по маршрутам URL: длительность запроса, запросы к БД, обращения к DMED, кэшу и channel layer
+
+MetricsMiddleware заводит на время запроса Collector, в который попадают SQL-запросы (connection.execute_wrapper),
+обращения к кэшу (core.cache.RedisCache) и всё, что обёрнуто в timed() - вызовы DMED и group_send.
+Задачи, которые запрос отдаёт в пул потоков (поиск в DMED), учитываются, если обёрнуты в bind().
+Фоновые задачи (воркеры ingest_captures) собирают то же самое под маршрутом task:<имя> через task().
+
+Гистограммы копятся в памяти процесса. Раз в METRICS_FLUSH_INTERVAL секунд процесс кладёт их в кэш (Redis)
+под своим ключом, и /metrics отдаёт сумму по всем процессам (gunicorn, daphne, воркеры) в формате Prometheus.
+Значения процесса хранятся WORKER_TTL после его последней записи, после этого счётчики уменьшаются,
+и Prometheus видит это как перезапуск.
+
+Запросы дольше SLOW_REQUEST_THRESHOLD секунд пишутся в лог со списком SQL-запросов.
+"""
+import logging
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+log = logging.getLogger(__name__)
+
+WORKERS_KEY = 'metrics:workers'
+WORKER_TTL = 60 * 60 * 24
+MAX_LOGGED_QUERIES = 100
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+# обращения к внешним системам, время и число которых считается за запрос
+TIMERS = ('db', 'dmed', 'cache', 'group_send')
+
+HISTOGRAMS = {
+    'http_request_duration_seconds': ('Длительность обработки запроса', TIME_BUCKETS),
+    'db_queries_per_request': ('SQL-запросов за запрос', COUNT_BUCKETS),
+    **{f'{t}_duration_seconds': (f'Суммарное время обращений {t} за запрос', TIME_BUCKETS) for t in TIMERS},
+}
+COUNTERS = {
+    'http_requests_total': 'Запросов',
+    'cache_hits_total': 'Найдено в кэше',
+    'cache_misses_total': 'Не найдено в кэше',
+    **{f'{t}_calls_total': f'Обращений {t}' for t in TIMERS},
+}
+
+
+class Collector:
+    """Обращения к внешним системам за один запрос или задачу"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.calls = defaultdict(int)
+        self.seconds = defaultdict(float)
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.queries = []  # [(sql, секунд)], первые MAX_LOGGED_QUERIES
+        # обращения из потоков пула (см. bind) идут одновременно с вызывающим потоком
+        self.lock = threading.Lock()
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.calls[name] += 1
+            self.seconds[name] += seconds
+
+
+_local = threading.local()
+
+
+def current():
+    """Collector текущего запроса или None"""
+    return getattr(_local, 'collector', None)
+
+
+@contextmanager
+def timed(name):
+    """Учитывает время блока как обращение name в текущем запросе"""
+    collector = current()
+    if collector is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        collector.add(name, time.monotonic() - start)
+
+
+def cache_lookup(hits, misses):
+    collector = current()
+    if collector is not None:
+        with collector.lock:
+            collector.cache_hits += hits
+            collector.cache_misses += misses
+
+
+def execute_wrapper(execute, sql, params, many, context):
+    collector = current()
+    if collector is None:
+        return execute(sql, params, many, context)
+    start = time.monotonic()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.monotonic() - start
+        collector.add('db', elapsed)
+        if len(collector.queries) < MAX_LOGGED_QUERIES:
+            collector.queries.append((sql, elapsed))
+
+
+def bind(fn):
+    """fn, который в потоке пула учитывает обращения в Collector вызывающего потока
+
+    Collector хранится в threading.local, поэтому задачи, отданные в ThreadPoolExecutor, без этого не учитываются.
+    """
+    collector = current()
+    if collector is None:
+        return fn
+
+    def wrapper(*args, **kwargs):
+        previous = current()
+        _local.collector = collector
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _local.collector = previous
+    return wrapper
+
+
+@contextmanager
+def collect():
+    """Заводит Collector на время блока"""
+    collector = _local.collector = Collector()
+    try:
+        with connection.execute_wrapper(execute_wrapper):
+            yield collector
+    finally:
+        _local.collector = None
+
+
+@contextmanager
+def task(name):
+    """Метрики фоновой задачи, под маршрутом task:<name>"""
+    with collect() as collector:
+        yield
+    record(f'task:{name}', collector)
+    registry.maybe_flush()
+
+
+def route_of(request):
+    """Шаблон маршрута запроса: api/v2/inspector/checkpoint/cameras/{camera_pk}/captures/"""
+    match = getattr(request, 'resolver_match', None)
+    if match is None or match.route is None:
+        return 'unmatched'
+    route = re.sub(r'\(\?P<(\w+)>[^)]*\)', r'{\1}', match.route)  # re_path и роутеры DRF
+    route = re.sub(r'<(?:\w+:)?(\w+)>', r'{\1}', route)  # path
+    route = re.sub(r'[\^$?\\]', '', route)
+    return route or '/'
+
+
+def record(route, collector, method=None, status=None):
+    labels = (('route', route),)
+    duration = time.monotonic() - collector.started
+    with registry.lock:
+        if method:
+            registry.inc('http_requests_total', labels + (('method', method), ('status', str(status))))
+        registry.observe('http_request_duration_seconds', labels, duration)
+        registry.observe('db_queries_per_request', labels, collector.calls['db'])
+        for t in TIMERS:
+            registry.observe(f'{t}_duration_seconds', labels, collector.seconds[t])
+            registry.inc(f'{t}_calls_total', labels, collector.calls[t])
+        registry.inc('cache_hits_total', labels, collector.cache_hits)
+        registry.inc('cache_misses_total', labels, collector.cache_misses)
+
+    if duration >= settings.SLOW_REQUEST_THRESHOLD:
+        log_slow(route, method, duration, collector)
+
+
+def log_slow(route, method, duration, collector):
+    timers = ', '.join(
+        f'{t} {collector.calls[t]} calls {collector.seconds[t] * 1000:.0f} ms' for t in TIMERS if collector.calls[t]
+    )
+    queries = '\n'.join(f'  {seconds * 1000:7.1f} ms  {sql}' for sql, seconds in collector.queries)
+    more = collector.calls['db'] - len(collector.queries)
+    if more > 0:
+        queries += f'\n  ... and {more} more'
+    name = f'{method} {route}' if method else route
+    log.warning(f'slow {name}: {duration * 1000:.0f} ms ({timers})\n{queries}')
+
+
+class Registry:
+    """Гистограммы и счётчики процесса"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}  # (имя, метки): [число в каждой корзине..., в +Inf, сумма]
+        self.counters = {}  # (имя, метки): значение
+        self.flushed_at = 0
+        self.pid = None
+        self.worker_key = None
+
+    def observe(self, name, labels, value):
+        buckets = HISTOGRAMS[name][1]
+        h = self.histograms.get((name, labels))
+        if h is None:
+            h = self.histograms[name, labels] = [0] * (len(buckets) + 1) + [0]
+        h[next((i for i, le in enumerate(buckets) if value <= le), len(buckets))] += 1
+        h[-1] += value
+
+    def inc(self, name, labels, value=1):
+        if value:
+            self.counters[name, labels] = self.counters.get((name, labels), 0) + value
+
+    def maybe_flush(self):
+        if time.monotonic() - self.flushed_at >= settings.METRICS_FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Кладёт накопленные значения процесса в кэш"""
+        self.flushed_at = time.monotonic()
+        if self.pid != os.getpid():
+            if self.pid is not None:
+                # дочерний процесс после fork: значения родителя уже учтены под его ключом
+                self.histograms, self.counters = {}, {}
+            self.pid = os.getpid()
+            self.worker_key = f'metrics:worker:{socket.gethostname()}:{self.pid}:{uuid.uuid4().hex[:6]}'
+            register(self.worker_key)
+        with self.lock:
+            data = dict(histograms={k: list(h) for k, h in self.histograms.items()}, counters=dict(self.counters))
+        try:
+            cache.set(self.worker_key, data, WORKER_TTL)
+        except Exception as e:
+            # метрики не должны ломать основной функционал
+            log.warning(f'cannot flush metrics: {e}')
+
+
+registry = Registry()
+
+
+def register(worker_key):
+    try:
+        with cache.lock(f'{WORKERS_KEY}:lock', timeout=5):
+            workers = cache.get(WORKERS_KEY) or set()
+            workers.add(worker_key)
+            cache.set(WORKERS_KEY, workers, None)
+    except Exception as e:
+        log.warning(f'cannot register metrics worker: {e}')
+
+
+def collect_all():
+    """Сумма значений всех процессов: (гистограммы, счётчики)"""
+    registry.flush()
+    workers = cache.get(WORKERS_KEY) or set()
+    data = cache.get_many(list(workers))
+    if len(data) < len(workers):
+        # значения умерших процессов истекли
+        with cache.lock(f'{WORKERS_KEY}:lock', timeout=5):
+            cache.set(WORKERS_KEY, (cache.get(WORKERS_KEY) or set()) & set(data), None)
+
+    histograms, counters = {}, {}
+    for d in data.values():
+        for key, h in d['histograms'].items():
+            if key[0] not in HISTOGRAMS:
+                continue
+            total = histograms.setdefault(key, [0] * len(h))
+            for i, v in enumerate(h):
+                total[i] += v
+        for key, v in d['counters'].items():
+            counters[key] = counters.get(key, 0) + v
+    return histograms, counters
+
+
+def render():
+    """Текстовый формат Prometheus"""
+    histograms, counters = collect_all()
+    lines = []
+
+    def labels_str(labels):
+        return ','.join(f'{k}="{v}"' for k, v in labels)
+
+    for name, (help_text, buckets) in HISTOGRAMS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} histogram']
+        for (n, labels), h in sorted(histograms.items()):
+            if n != name:
+                continue
+            cumulative = 0
+            for le, count in zip([*map(str, buckets), '+Inf'], h[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{labels_str(labels + (("le", le),))}}} {cumulative}')
+            lines.append(f'{name}_sum{{{labels_str(labels)}}} {h[-1]}')
+            lines.append(f'{name}_count{{{labels_str(labels)}}} {cumulative}')
+
+    for name, help_text in COUNTERS.items():
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+        for (n, labels), v in sorted(counters.items()):
+            if n == name:
+                lines.append(f'{name}{{{labels_str(labels)}}} {v}')
+    return '\n'.join(lines) + '\n'
+
+
+class CacheMixin:
+    """Учитывает обращения к кэшу в метриках запроса; подмешивается к бэкенду кэша (core.cache)"""
+
+    def get(self, key, default=None, version=None):
+        with timed('cache'):
+            value = super().get(key, default=default, version=version)
+        cache_lookup(value is not default, value is default)
+        return value
+
+    def get_many(self, keys, version=None):
+        with timed('cache'):
+            values = super().get_many(keys, version=version)
+        cache_lookup(len(values), len(keys) - len(values))
+        return values
+
+    def set(self, *args, **kwargs):
+        with timed('cache'):
+            return super().set(*args, **kwargs)
+
+    def set_many(self, *args, **kwargs):
+        with timed('cache'):
+            return super().set_many(*args, **kwargs)
+
+    def add(self, *args, **kwargs):
+        with timed('cache'):
+            return super().add(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        with timed('cache'):
+            return super().delete(*args, **kwargs)
+
+    def delete_many(self, *args, **kwargs):
+        with timed('cache'):
+            return super().delete_many(*args, **kwargs)
+
+    def incr(self, *args, **kwargs):
+        with timed('cache'):
+            return super().incr(*args, **kwargs)
@@ -0,0 +1,31 @@
+from django.utils.functional import SimpleLazyObject
+
+from core import authz, metrics
+
+
+class AuthzMiddleware:
+    """Снимок прав пользователя (core.authz) в request.authz
+
+    Собирается при первом обращении: к этому времени DRF уже аутентифицировал пользователя и записал его в request.user.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.authz = SimpleLazyObject(lambda: authz.for_user(request.user))
+        return self.get_response(request)
+
+
+class MetricsMiddleware:
+    """Метрики запроса по его маршруту (core.metrics); должна стоять первой, чтобы учитывать всю обработку"""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with metrics.collect() as collector:
+            response = self.get_response(request)
+        metrics.record(metrics.route_of(request), collector, request.method, response.status_code)
+        metrics.registry.maybe_flush()
+        return response
@@ -0,0 +1,34 @@
+# Generated by Django 3.0.5 on 2020-05-04 12:10
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0002_auto_20200422_2034'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CaptureEvent',
+            fields=[
+                ('add_date', models.DateTimeField(auto_now=True)),
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('event_id', models.CharField(max_length=100, unique=True)),
+                ('source', models.CharField(max_length=1000)),
+                ('shard', models.SmallIntegerField()),
+                ('body', models.TextField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('processed_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='captureevent',
+            index=models.Index(condition=models.Q(status='pending'), fields=['shard', 'available_at', 'id'], name='captureevent_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.0.5 on 2020-05-06 10:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_captureevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='person',
+            name='dmed_updated_at',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='Обновлено из DMED'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.0.5 on 2020-05-08 16:20
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0004_person_dmed_updated_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DMEDRouteStat',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('add_date', models.DateTimeField(auto_now=True)),
+                ('context', models.CharField(blank=True, max_length=120)),
+                ('lookups', models.IntegerField(default=0)),
+                ('hits', models.IntegerField(default=0)),
+                ('errors', models.IntegerField(default=0)),
+                ('latency_ms', models.BigIntegerField(default=0)),
+                ('region', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='route_stats', to='core.Region')),
+            ],
+            options={
+                'ordering': ['context', '-hits'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='dmedroutestat',
+            constraint=models.UniqueConstraint(fields=('context', 'region'), name='unique_dmedroutestat_context_region'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 3.0.5 on 2020-05-11 10:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0005_dmedroutestat'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cameracapture',
+            index=models.Index(fields=['camera', 'add_date', 'id'], name='cameracapture_camera_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='checkpointpass',
+            index=models.Index(fields=['checkpoint', 'status', 'add_date', 'id'], name='checkpointpass_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='checkpointpass',
+            index=models.Index(fields=['checkpoint', 'add_date', 'id'], name='checkpointpass_date_idx'),
+        ),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 3.0.5 on 2020-05-12 09:15
+
+from django.db import migrations, models
+
+
+def fill_pending(apps, schema_editor):
+    CameraCapture = apps.get_model('core', 'CameraCapture')
+    CameraCapture.objects.exclude(checkpoint_pass__isnull=True).exclude(
+        checkpoint_pass__status='not_passed'
+    ).update(pending=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_auto_20200511_1030'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cameracapture',
+            name='pending',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.RunPython(fill_pending, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='cameracapture',
+            name='cameracapture_camera_date_idx',
+        ),
+        migrations.AddIndex(
+            model_name='cameracapture',
+            index=models.Index(condition=models.Q(pending=True), fields=['camera', 'add_date', 'id'], name='cameracapture_pending_idx'),
+        ),
+    ]
@@ -1,8 +1,8 @@
 from typing import Optional
 
 from django.conf import settings
-from django.db import models
-from django.db.models import fields as f, Manager, constraints
+from django.db import models, transaction
+from django.db.models import fields as f, Manager, constraints, OuterRef, Subquery
 from django.contrib.auth import models as auth_models
 from django.utils import timezone
 
@@ -47,6 +47,18 @@ class Region(BaseModel):
         return self.name
 
 
+class PersonQuerySet(models.QuerySet):
+    def with_temperature(self):
+        """Последняя замеренная температура (last_temperature) и время замера (last_temperature_at) одним запросом"""
+        latest = PersonPassData.objects.filter(
+            person=OuterRef('pk'), temperature__isnull=False
+        ).order_by('-add_date', '-id')
+        return self.annotate(
+            last_temperature=Subquery(latest.values('temperature')[:1]),
+            last_temperature_at=Subquery(latest.values('add_date')[:1]),
+        )
+
+
 class Person(BaseModel):
     """Анкета"""
 
@@ -59,6 +71,8 @@ class Person(BaseModel):
             models.UniqueConstraint(fields=('doc_id', 'citizenship'), name='unique_doc_id_citizenship')
         ]
 
+    objects = PersonQuerySet.as_manager()
+
     # обязательные
     doc_id = f.CharField('ID документа', max_length=32, help_text='Для Казахстана - ИИН')
     citizenship = models.ForeignKey(Country, verbose_name='Гражданство', on_delete=models.CASCADE,
@@ -86,6 +100,7 @@ class Person(BaseModel):
     dmed_rpn_id = f.BigIntegerField(null=True, blank=True)
     dmed_master_data_id = f.BigIntegerField(null=True, blank=True)
     dmed_region = models.ForeignKey(Region, on_delete=models.SET_NULL, null=True, blank=True)
+    dmed_updated_at = f.DateTimeField('Обновлено из DMED', null=True, blank=True)
 
     def __str__(self):
         m = f'#{self.doc_id}'
@@ -103,7 +118,7 @@ class Person(BaseModel):
     @property
     def iin(self):
         """Для обратной совместимости"""
-        if self.citizenship.id in CITIZENSHIPS_KZ:
+        if self.citizenship_id in CITIZENSHIPS_KZ:
             return self.doc_id
 
     @iin.setter
@@ -112,26 +127,32 @@ class Person(BaseModel):
         if value:
             # validate_iin(value)
             self.doc_id = value
-            self.citizenship = Country.objects.get(pk=CITIZENSHIP_KZ)
+            from .refdata import country
+            self.citizenship = country(CITIZENSHIP_KZ)
 
     @property
     def temperature(self) -> Optional[float]:
         """Последняя замеренная температура"""
-        p = self.passes.order_by('-add_date').last()
-        if p:
-            return p.temperature
-
-    def update_from_dmed(self):
-        for region in Region.objects.filter(dmed_url__isnull=False).order_by('dmed_priority'):
-            try:
-                updated = self.update_from_dmed_region(region)
-            except Exception as e:
-                log.warning(f'error while fetching {region.dmed_url}: {e}')
-            else:
-                if updated:
-                    log.info(f'updated from {region.dmed_url}')
-                    return True
-            return False
+        return self.latest_temperature()[0]
+
+    @property
+    def temperature_at(self):
+        """Когда замерена последняя температура"""
+        return self.latest_temperature()[1]
+
+    def latest_temperature(self):
+        """(температура, время замера); без аннотации with_temperature() - запросом"""
+        if not hasattr(self, 'last_temperature'):
+            ppd = self.personpassdata_set.filter(temperature__isnull=False).order_by('-add_date', '-id').first()
+            self.last_temperature = ppd.temperature if ppd else None
+            self.last_temperature_at = ppd.add_date if ppd else None
+        return self.last_temperature, self.last_temperature_at
+
+    def update_from_dmed(self, checkpoint=None):
+        """Ищет анкету в регионах DMED и заполняет её данными первого нашедшего
+        :param checkpoint: КПП, с которого пришёл запрос"""
+        from .dmed import enrich_person
+        return enrich_person(self, checkpoint=checkpoint)
 
     def update_from_dmed_region(self, region):
         from .service import DMEDService
@@ -148,6 +169,25 @@ class Person(BaseModel):
         return updated
 
 
+class DMEDRouteStat(BaseModel):
+    """Статистика поиска анкет в регионе DMED в разрезе места запроса (см. core.routing)"""
+    class Meta:
+        ordering = ['context', '-hits']
+        constraints = [
+            models.UniqueConstraint(fields=('context', 'region'), name='unique_dmedroutestat_context_region')
+        ]
+
+    context = f.CharField(max_length=120, blank=True)  # '' - все запросы, 'region:<id>', 'checkpoint:<id>'
+    region = models.ForeignKey(Region, on_delete=models.CASCADE, related_name='route_stats')
+    lookups = f.IntegerField(default=0)  # сколько раз регион спрашивали
+    hits = f.IntegerField(default=0)  # сколько раз регион нашёл человека
+    errors = f.IntegerField(default=0)
+    latency_ms = f.BigIntegerField(default=0)  # суммарное время ответов
+
+    def __str__(self):
+        return f'{self.context or "*"} / {self.region}'
+
+
 class Marker(BaseModel):
     id = f.IntegerField(primary_key=True)
     name = f.CharField(max_length=512)
@@ -200,6 +240,16 @@ class Camera(BaseModel):
         return self.location
 
 
+class CheckpointPassQuerySet(models.QuerySet):
+    def with_legacy_person(self):
+        """Аннотирует legacy-поля: первого человека (legacy_person_id) и его температуру (legacy_temperature)"""
+        first = PersonPassData.objects.filter(checkpoint_pass=OuterRef('pk')).order_by('person_id')
+        return self.annotate(
+            legacy_person_id=Subquery(first.values('person_id')[:1]),
+            legacy_temperature=Subquery(first.values('temperature')[:1]),
+        )
+
+
 class CheckpointPass(BaseModel):
     """Акт прохождения КПП"""
     class Direction(models.TextChoices):
@@ -210,6 +260,15 @@ class CheckpointPass(BaseModel):
         NOT_PASSED = 'not_passed'  # процедура проверки ещё не пройдена
         PASSED = 'passed'  # процедура проверки пройдена
 
+    class Meta:
+        indexes = [
+            # очередь проходов КПП и опрос изменений по ключу (api2.pagination)
+            models.Index(fields=['checkpoint', 'status', 'add_date', 'id'], name='checkpointpass_queue_idx'),
+            models.Index(fields=['checkpoint', 'add_date', 'id'], name='checkpointpass_date_idx'),
+        ]
+
+    objects = CheckpointPassQuerySet.as_manager()
+
     persons = models.ManyToManyField(Person, through='PersonPassData', related_name='passes', blank=True)
     inspector = models.ForeignKey(User, verbose_name='Мединспектор', on_delete=models.SET_NULL, null=True)
     checkpoint = models.ForeignKey(Checkpoint, verbose_name='КПП', on_delete=models.SET_NULL, null=True, blank=True)
@@ -220,8 +279,12 @@ class CheckpointPass(BaseModel):
 
     @property
     def person(self):
-        # legacy - человек, проходящий КПП
-        # FIXME сериализатор DRF не понимает объект, скрытый под property, и не может его сериализовать
+        # legacy - человек, проходящий КПП (id, сериализуется через serializable_value)
+        # для списков - CheckpointPassQuerySet.with_legacy_person() или prefetch_related('persons')
+        if hasattr(self, 'legacy_person_id'):
+            return self.legacy_person_id
+        if 'persons' in getattr(self, '_prefetched_objects_cache', {}):
+            return min((p.id for p in self.persons.all()), default=None)
         p = self.persons.first()
         if p:
             return p.id
@@ -229,11 +292,11 @@ class CheckpointPass(BaseModel):
     @property
     def temperature(self):
         # legacy - температура этого человека
-        try:
-            ppd = PersonPassData.objects.get(person=self.persons.first(), checkpoint_pass=self)
-        except PersonPassData.DoesNotExist:
-            return
-        return ppd.temperature
+        if hasattr(self, 'legacy_temperature'):
+            return self.legacy_temperature
+        ppd = self.personpassdata_set.order_by('person_id').first()
+        if ppd:
+            return ppd.temperature
 
     def __str__(self):
         m = ''
@@ -249,6 +312,14 @@ class CheckpointPass(BaseModel):
 
 class CameraCapture(BaseModel):
     """Захват проезжающего мимо камеры транспорта"""
+    class Meta:
+        indexes = [
+            # очередь непроверенных захватов камеры по ключу (api2.pagination)
+            models.Index(
+                fields=['camera', 'add_date', 'id'], name='cameracapture_pending_idx', condition=models.Q(pending=True)
+            ),
+        ]
+
     id = f.UUIDField(primary_key=True)
     camera = models.ForeignKey(Camera, on_delete=models.CASCADE)
     vehicle = models.ForeignKey(Vehicle, on_delete=models.CASCADE)
@@ -258,21 +329,53 @@ class CameraCapture(BaseModel):
     checkpoint_pass = models.OneToOneField(
         CheckpointPass, on_delete=models.SET_NULL, null=True, blank=True, related_name='camera_capture'
     )
+    # досмотр ещё не проведён: прохода нет или он не пройден (см. core.signals)
+    pending = f.BooleanField(default=True)
+
+    @classmethod
+    def claim_next(cls, inspector, camera_id=None) -> Optional['CheckpointPass']:
+        """Берёт в досмотр самый старый ещё никем не открытый захват с камер КПП инспектора и создаёт по нему проход
+
+        Захваты, заблокированные параллельными вызовами, пропускаются (SKIP LOCKED), поэтому несколько инспекторов
+        разбирают одну очередь, не дожидаясь друг друга и не получая один и тот же захват.
+        Возвращает None, если брать нечего.
+        """
+        q = cls.objects.filter(
+            camera__checkpoint_id=inspector.checkpoint_id, pending=True, checkpoint_pass__isnull=True,
+        )
+        if camera_id is not None:
+            q = q.filter(camera_id=camera_id)
+        with transaction.atomic():
+            capture = q.select_for_update(skip_locked=True, of=('self',)).order_by('add_date', 'id').first()
+            if capture is None:
+                return None
+            return capture._attach_checkpoint_pass(inspector)
 
     def create_or_update_checkpoint_pass(self, inspector):
-        if not self.checkpoint_pass:
+        with transaction.atomic():
+            # захват блокируется: инспекторы, открывшие его одновременно, получат один и тот же проход
+            locked = CameraCapture.objects.select_for_update().only('checkpoint_pass').get(pk=self.pk)
+            self.checkpoint_pass_id = locked.checkpoint_pass_id
+            return self._attach_checkpoint_pass(inspector)
+
+    def _attach_checkpoint_pass(self, inspector):
+        # вызывается под блокировкой строки захвата
+        if self.checkpoint_pass_id is None:
             checkpoint_pass = CheckpointPass()
-            self.checkpoint_pass = checkpoint_pass
             log.info(f'{checkpoint_pass} created')
         else:
             checkpoint_pass = self.checkpoint_pass
-        checkpoint_pass.vehicle = self.vehicle
-        checkpoint_pass.checkpoint = inspector.checkpoint
+        checkpoint_pass.vehicle_id = self.vehicle_id
+        checkpoint_pass.checkpoint_id = inspector.checkpoint_id
         checkpoint_pass.inspector = inspector
         checkpoint_pass.save()
-        self.save()
-        for person in self.persons.all():
-            checkpoint_pass.persons.add(person)
+        self.checkpoint_pass = checkpoint_pass
+        self.pending = checkpoint_pass.status == CheckpointPass.Status.NOT_PASSED
+        self.save(update_fields=['checkpoint_pass', 'pending', 'add_date'])
+        PersonPassData.objects.bulk_create([
+            PersonPassData(person_id=person_id, checkpoint_pass=checkpoint_pass)
+            for person_id in self.persons.values_list('id', flat=True)
+        ], ignore_conflicts=True)
 
         return checkpoint_pass
 
@@ -297,3 +400,37 @@ class PersonPassData(BaseModel):
             m += f' {self.temperature:.01f} °C'
         m += f' ({self.checkpoint_pass})'
         return m
+
+
+class CaptureEvent(BaseModel):
+    """Событие с камеры EGSV в очереди на обработку
+
+    add_date - время постановки в очередь, поэтому после создания запись меняется только через update()
+    """
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['shard', 'available_at', 'id'],
+                name='captureevent_pending_idx',
+                condition=models.Q(status='pending')
+            ),
+        ]
+
+    class Status(models.TextChoices):
+        PENDING = 'pending'  # ждёт обработки (или повторной попытки)
+        DONE = 'done'
+        FAILED = 'failed'  # исчерпаны попытки
+
+    id = f.BigAutoField(primary_key=True)
+    event_id = f.CharField(max_length=100, unique=True)  # id события EGSV, по нему отсекаем дубли
+    source = f.CharField(max_length=1000)  # имя камеры
+    shard = f.SmallIntegerField()  # события одной камеры всегда в одном шарде - сохраняем их порядок
+    body = f.TextField()  # тело запроса вебхука
+    status = f.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    attempts = f.IntegerField(default=0)
+    last_error = f.TextField(null=True, blank=True)
+    available_at = f.DateTimeField(default=timezone.now)  # раньше этого времени событие не берётся в работу
+    processed_at = f.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f'{self.event_id} @ {self.source} ({self.status})'
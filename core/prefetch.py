@@ -0,0 +1,247 @@
+"""Предварительное наполнение анкет из DMED по спискам ИИН (manage.py dmed_prefetch, действие в админке анкет)
+
+Перед крупными мероприятиями приходят списки ИИН людей, ожидаемых на КПП. Анкеты из такого списка
+наполняются заранее, и первое сканирование инспектором обходится без запроса в DMED.
+Число анкет, запрашиваемых из DMED в секунду, ограничивается (DMED_PREFETCH_RATE, --rate), чтобы наполнение
+не отнимало у регионов DMED запросы инспекторов; сами инспекторы и вебхук камер не ограничиваются.
+"""
+import csv
+import io
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from core import dmed, refdata
+from core.models import Person, CITIZENSHIPS_KZ
+from core.validators import is_iin
+
+log = logging.getLogger(__name__)
+
+FOUND = 'found'
+MISSING = 'missing'
+FRESH = 'fresh'  # анкета уже свежая, в DMED не ходили
+ERROR = 'error'
+
+JOBS_KEY = 'dmed_prefetch_jobs'
+
+
+def read(fp, name=''):
+    """Читает список из CSV или JSONL (по расширению name), возвращает [(ИИН, id КПП или None)]
+
+    CSV: колонка iin (или первая колонка, если заголовка нет), необязательная колонка checkpoint.
+    JSONL: в каждой строке ИИН или объект {"iin": ..., "checkpoint": ...}.
+    Некорректные и повторные ИИН пропускаются.
+    """
+    if isinstance(fp.read(0), bytes):
+        fp = io.TextIOWrapper(fp, encoding='utf-8-sig')
+
+    if name.endswith(('.jsonl', '.json')):
+        rows = []
+        for line in fp:
+            if not line.strip():
+                continue
+            d = json.loads(line)
+            if isinstance(d, dict):
+                checkpoint = d.get('checkpoint')
+                rows.append((str(d.get('iin', '')), str(checkpoint).strip() if checkpoint is not None else None))
+            else:
+                rows.append((str(d), None))
+    else:
+        reader = csv.reader(fp)
+        first = next(reader, None) or []
+        header = [c.strip().lower() for c in first]
+        if header and not is_iin(header[0]) and not header[0].isdigit():
+            iin_col = header.index('iin') if 'iin' in header else 0
+            checkpoint_col = header.index('checkpoint') if 'checkpoint' in header else None
+        else:
+            iin_col, checkpoint_col = 0, None
+            reader = [first] + list(reader) if first else []
+        rows = []
+        for r in reader:
+            if len(r) <= iin_col:
+                continue
+            checkpoint = r[checkpoint_col].strip() if checkpoint_col is not None and len(r) > checkpoint_col else None
+            rows.append((r[iin_col].strip(), checkpoint))
+
+    seen = set()
+    rv = []
+    for iin, checkpoint in rows:
+        if not is_iin(iin):
+            log.warning(f'skipping invalid iin {iin!r}')
+            continue
+        if iin in seen:
+            continue
+        seen.add(iin)
+        # id КПП из EGSV - строка
+        rv.append((iin, checkpoint or None))
+    return rv
+
+
+def read_journal(path):
+    """ИИН, уже обработанные прошлым запуском (кроме упавших с ошибкой)"""
+    try:
+        with open(path) as fp:
+            return {iin for iin, status in (line.split() for line in fp if line.strip()) if status != ERROR}
+    except FileNotFoundError:
+        return set()
+
+
+class RateLimiter:
+    """Не чаще rate вызовов wait() в секунду на все потоки, 0 - без ограничения"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + 1 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def prefetch_person(iin, checkpoint=None, limiter=None):
+    """Наполняет одну анкету, возвращает FOUND, MISSING или FRESH
+    :param limiter: RateLimiter, который ждём перед запросом в DMED (свежие анкеты его не тратят)"""
+    p = Person.objects.filter(doc_id=iin, citizenship__in=CITIZENSHIPS_KZ).first()
+    if p and p.dmed_id:
+        if dmed.is_fresh(p):
+            return FRESH
+        if limiter:
+            limiter.wait()
+        return FOUND if dmed.enrich_person(p, checkpoint=checkpoint) else MISSING
+    if limiter:
+        limiter.wait()
+    p = dmed.ensure_person(iin, checkpoint=checkpoint)
+    return FOUND if p.dmed_id else MISSING
+
+
+class Progress:
+    def __init__(self, total, done=0):
+        self.total = total
+        self.done = done
+        self.counts = Counter()
+        self.started = time.monotonic()
+
+    def add(self, status):
+        self.counts[status] += 1
+        self.done += 1
+
+    def to_dict(self):
+        elapsed = time.monotonic() - self.started
+        processed = sum(self.counts.values())
+        rate = processed / elapsed if elapsed else 0
+        return dict(
+            total=self.total,
+            done=self.done,
+            rate=round(rate, 1),
+            eta=int((self.total - self.done) / rate) if rate else None,
+            **self.counts,
+        )
+
+    def __str__(self):
+        d = self.to_dict()
+        counts = ', '.join(f'{k} {v}' for k, v in self.counts.items())
+        eta = f', eta {d["eta"]} s' if d['eta'] is not None else ''
+        return f'{d["done"]}/{d["total"]} ({counts}), {d["rate"]}/s{eta}'
+
+
+def run(rows, workers, journal=None, on_progress=None, progress_interval=5, rate=None):
+    """Наполняет анкеты списка в workers потоков
+
+    :param rows: [(ИИН, id КПП или None)], см. read()
+    :param journal: путь к журналу обработанных ИИН; при повторном запуске они пропускаются
+    :param on_progress: вызывается с Progress не реже чем раз в progress_interval секунд и в конце
+    :param rate: анкет в секунду, запрашиваемых из DMED, по умолчанию DMED_PREFETCH_RATE; 0 - без ограничения
+    :rtype: Progress
+    """
+    done = read_journal(journal) if journal else set()
+    rows = [r for r in rows if r[0] not in done]
+    progress = Progress(len(rows) + len(done), len(done))
+    limiter = RateLimiter(settings.DMED_PREFETCH_RATE if rate is None else rate)
+
+    def task(iin, checkpoint_id):
+        try:
+            return prefetch_person(iin, refdata.checkpoint(checkpoint_id), limiter)
+        except Exception:
+            log.exception(f'cannot prefetch {iin}')
+            return ERROR
+        finally:
+            connection.close()
+
+    journal_fp = open(journal, 'a') if journal else None
+    reported_at = 0  # первый раз - сразу после первых обработанных
+    try:
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prefetch') as executor:
+            in_flight = {}
+            rows = iter(rows)
+            while True:
+                # в очереди не больше двух задач на поток, чтобы не держать весь список в памяти пула
+                for iin, checkpoint_id in rows:
+                    in_flight[executor.submit(task, iin, checkpoint_id)] = iin
+                    if len(in_flight) >= workers * 2:
+                        break
+                if not in_flight:
+                    break
+
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    iin = in_flight.pop(future)
+                    status = future.result()
+                    progress.add(status)
+                    if journal_fp:
+                        journal_fp.write(f'{iin} {status}\n')
+                if journal_fp:
+                    journal_fp.flush()
+
+                if on_progress and time.monotonic() - reported_at >= progress_interval:
+                    on_progress(progress)
+                    reported_at = time.monotonic()
+    finally:
+        if journal_fp:
+            journal_fp.close()
+
+    if on_progress:
+        on_progress(progress)
+    return progress
+
+
+def start(rows, workers, name):
+    """Запускает наполнение в фоновом потоке текущего процесса (для админки), прогресс - в jobs()
+
+    Журнала нет: если процесс перезапустится, список нужно загрузить заново (наполненные анкеты пропустятся как свежие).
+    """
+    job_id = uuid.uuid4().hex[:8]
+
+    def report(progress):
+        jobs = cache.get(JOBS_KEY) or {}
+        jobs[job_id] = dict(name=name, updated_at=time.time(), **progress.to_dict())
+        recent = sorted(jobs.items(), key=lambda j: j[1]['updated_at'])[-10:]
+        cache.set(JOBS_KEY, dict(recent), 60 * 60 * 24)
+
+    def target():
+        try:
+            run(rows, workers, on_progress=report)
+        except Exception:
+            log.exception(f'dmed prefetch {name} failed')
+
+    threading.Thread(target=target, name=f'dmed-prefetch-{job_id}', daemon=True).start()
+    return job_id
+
+
+def jobs():
+    """Последние фоновые наполнения, от новых к старым"""
+    return sorted((cache.get(JOBS_KEY) or {}).values(), key=lambda j: -j['updated_at'])
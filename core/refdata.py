@@ -0,0 +1,100 @@
+"""Справочники (страны, регионы, КПП) в памяти процесса
+
+Таблицы маленькие, меняются редко, а читаются почти в каждом запросе. Каждый процесс держит их целиком в памяти.
+Изменение любой записи (сигналы post_save/post_delete, после коммита) увеличивает версию справочника в кэше,
+и все процессы перечитывают его при следующем обращении; версия проверяется не чаще раза в CHECK_INTERVAL секунд.
+Изменения через QuerySet.update() сигналов не отправляют - после них нужно вызывать invalidate() самому.
+
+Объекты общие для всех потоков процесса, менять их нельзя.
+"""
+import logging
+import threading
+import time
+
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+
+from core.models import Country, Region, Checkpoint
+
+log = logging.getLogger(__name__)
+
+CHECK_INTERVAL = 1
+
+
+class Table:
+    def __init__(self, model):
+        self.model = model
+        self.key = f'refdata_version:{model._meta.label_lower}'
+        self.rows = None
+        self.version = None
+        self.checked_at = 0
+        self.lock = threading.Lock()
+
+    def all(self):
+        """{pk: объект}"""
+        now = time.monotonic()
+        if self.rows is not None and now - self.checked_at < CHECK_INTERVAL:
+            return self.rows
+
+        with self.lock:
+            version = cache.get(self.key)
+            if version is None:
+                cache.add(self.key, 1, None)
+                version = cache.get(self.key)
+            # версию читаем до таблицы: изменение между ними приведёт к лишнему перечитыванию, а не к устаревшим данным
+            if self.rows is None or version != self.version:
+                self.rows = {o.pk: o for o in self.model.objects.all()}
+                self.version = version
+                log.debug(f'{self.model.__name__} reloaded, version {version}')
+            self.checked_at = now
+            return self.rows
+
+    def get(self, pk):
+        return self.all().get(pk)
+
+    def invalidate(self):
+        self.rows = None
+        try:
+            cache.incr(self.key)
+        except ValueError:
+            cache.add(self.key, 1, None)
+
+
+countries = Table(Country)
+regions = Table(Region)
+checkpoints = Table(Checkpoint)
+
+TABLES = {t.model: t for t in (countries, regions, checkpoints)}
+
+
+def country(pk) -> Country:
+    """Страна по id; как и Country.objects.get, бросает Country.DoesNotExist"""
+    c = countries.get(pk)
+    if c is None:
+        raise Country.DoesNotExist(f'Country #{pk} does not exist')
+    return c
+
+
+def checkpoint(pk):
+    """КПП по id или None (в том числе для pk=None)
+    :rtype: core.models.Checkpoint"""
+    return checkpoints.get(pk) if pk is not None else None
+
+
+def dmed_regions():
+    """Регионы с DMED по порядку приоритета"""
+    return sorted((r for r in regions.all().values() if r.dmed_url), key=lambda r: r.dmed_priority)
+
+
+def changed(sender, **kwargs):
+    table = TABLES[sender]
+    # свой процесс перечитает сразу, остальные - когда изменение станет им видно
+    table.rows = None
+    transaction.on_commit(table.invalidate)
+
+
+def connect():
+    for model in TABLES:
+        post_save.connect(changed, sender=model, dispatch_uid=f'refdata_{model.__name__}_save')
+        post_delete.connect(changed, sender=model, dispatch_uid=f'refdata_{model.__name__}_delete')
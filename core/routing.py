@@ -0,0 +1,97 @@
+"""Порядок опроса регионов DMED, выученный по истории поиска
+
+Для каждого места запроса (КПП, регион КПП, все запросы вообще) копится статистика DMEDRouteStat:
+сколько раз регион спрашивали, сколько раз он нашёл человека, сколько ошибался и как долго отвечал.
+Если для места запроса накоплено достаточно находок, сначала опрашиваются регионы, в которых
+обычно находятся люди с этого места (первая волна), и только если они не нашли - остальные.
+"""
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+from core import bulk
+from core.models import DMEDRouteStat
+
+log = logging.getLogger(__name__)
+
+CACHE_TIMEOUT = 60
+
+
+def contexts(checkpoint=None):
+    """Места запроса от самого точного к самому общему
+    :type checkpoint: core.models.Checkpoint"""
+    rv = []
+    if checkpoint:
+        rv.append(f'checkpoint:{checkpoint.pk}')
+        if checkpoint.region_id:
+            rv.append(f'region:{checkpoint.region_id}')
+    rv.append('')
+    return rv
+
+
+def context_stats(context):
+    """{id региона: (запросов, находок, ошибок, суммарная задержка в мс)}"""
+    key = f'dmed_route:{context}'
+    rv = cache.get(key)
+    if rv is None:
+        rv = {
+            s.region_id: (s.lookups, s.hits, s.errors, s.latency_ms)
+            for s in DMEDRouteStat.objects.filter(context=context)
+        }
+        cache.set(key, rv, CACHE_TIMEOUT)
+    return rv
+
+
+def waves(regions, ctxs):
+    """Разбивает регионы на волны опроса; без достаточной статистики - все регионы одной волной"""
+    for context in ctxs:
+        s = context_stats(context)
+        total_hits = sum(v[1] for v in s.values())
+        if total_hits >= settings.DMED_ROUTING_MIN_HITS:
+            break
+    else:
+        return [regions]
+
+    def key(region):
+        lookups, hits, errors, latency_ms = s.get(region.id, (0, 0, 0, 0))
+        return -hits, latency_ms / lookups if lookups else 0, region.dmed_priority
+
+    ordered = sorted(regions, key=key)
+    first, share = [], 0
+    for region in ordered:
+        if share >= settings.DMED_ROUTING_CONFIDENCE:
+            break
+        first.append(region)
+        share += s.get(region.id, (0, 0))[1] / total_hits
+    rest = ordered[len(first):]
+    return [first, rest] if rest else [first]
+
+
+def record(ctxs, outcomes):
+    """Учитывает результаты опроса регионов
+
+    :param outcomes: список (регион, нашёл ли человека - True/False, None при ошибке, время ответа в секундах)
+    """
+    if not outcomes:
+        return
+    rows = [
+        DMEDRouteStat(
+            context=context,
+            region=region,
+            lookups=1,
+            hits=int(found is True),
+            errors=int(found is None),
+            latency_ms=int(seconds * 1000),
+        )
+        for context in ctxs for region, found, seconds in outcomes
+    ]
+    # строки общих мест запроса ('') обновляют все воркеры: в одном порядке, иначе взаимная блокировка
+    rows.sort(key=lambda s: (s.context, s.region_id))
+    bulk.upsert(
+        DMEDRouteStat,
+        rows,
+        conflict_fields=['context', 'region'],
+        update_fields=['add_date'],
+        increment_fields=['lookups', 'hits', 'errors', 'latency_ms'],
+    )
@@ -1,13 +1,20 @@
 import io
 import logging
+import threading
+import time
 from datetime import datetime
 
 import requests
+from django.conf import settings
 from django.core.cache import cache
+from django.db import transaction
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from django.utils.translation import gettext_lazy as _
 from rest_framework.exceptions import APIException, status
 
-from core.models import Country
+from core import bulk, metrics, refdata
+from core.models import Country, Marker
 
 log = logging.getLogger(__name__)
 
@@ -18,6 +25,119 @@ class BadGateway(APIException):
     default_code = 'bad_gateway'
 
 
+class SessionPool:
+    """Общие для процесса keep-alive сессии к DMED, по одной на регион (url)"""
+
+    def __init__(self, pool_size, retries, backoff):
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def get(self, url) -> requests.Session:
+        s = self._sessions.get(url)
+        if s is None:
+            with self._lock:
+                s = self._sessions.get(url)
+                if s is None:
+                    s = self._sessions[url] = self.create(url)
+        return s
+
+    def create(self, url):
+        s = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.pool_size,
+            # повторяем только неудачные соединения: запрос до сервера не дошёл, повтор безопасен
+            max_retries=Retry(total=self.retries, connect=self.retries, read=0, status=0, backoff_factor=self.backoff),
+        )
+        s.mount(url, adapter)
+        return s
+
+    def stats(self):
+        """Соединения по регионам; пулы разных хостов одного региона (например, после редиректа) суммируются"""
+        rv = {}
+        for url, s in list(self._sessions.items()):
+            pools = s.get_adapter(url).poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None or pool.pool is None:
+                    continue
+                d = rv.setdefault(url, dict(connections_opened=0, requests=0, idle=0, busy=0, maxsize=0))
+                d['connections_opened'] += pool.num_connections
+                d['requests'] += pool.num_requests
+                # в очереди пула лежат свободные соединения и пустые слоты (None)
+                d['idle'] += sum(1 for c in list(pool.pool.queue) if c)
+                d['busy'] += self.pool_size - pool.pool.qsize()
+                d['maxsize'] += self.pool_size
+        return rv
+
+
+sessions = SessionPool(
+    pool_size=settings.DMED_POOL_SIZE,
+    retries=settings.DMED_CONNECT_RETRIES,
+    backoff=settings.DMED_RETRY_BACKOFF,
+)
+
+
+class DMEDTokenStore:
+    """Токены DMED, отдельные для каждого региона (url)
+
+    Токен обновляется заранее, до истечения срока жизни; за новым токеном ходит только один воркер,
+    остальные в это время используют старый (или ждут, если токена ещё нет).
+    """
+    TTL = 60 * 60
+    REFRESH_BEFORE = 60 * 10
+    LOCK_TIMEOUT = 10
+
+    def __init__(self, url, username, password):
+        self.url = url
+        self.username = username
+        self.password = password
+        self.key = f'dmed_token:{url}'
+        self.lock_key = f'dmed_token_lock:{url}'
+
+    def get(self):
+        d = cache.get(self.key)
+        if d:
+            if time.time() - d['obtained_at'] > self.TTL - self.REFRESH_BEFORE:
+                lock = cache.lock(self.lock_key, timeout=self.LOCK_TIMEOUT)
+                if lock.acquire(blocking=False):
+                    try:
+                        return self.refresh()
+                    except Exception as e:
+                        log.warning(f'cannot refresh dmed token for {self.url}, using the old one: {e}')
+                    finally:
+                        lock.release()
+            return d['token']
+
+        with cache.lock(self.lock_key, timeout=self.LOCK_TIMEOUT, blocking_timeout=self.LOCK_TIMEOUT):
+            # пока ждали, токен мог получить другой воркер
+            d = cache.get(self.key)
+            if d:
+                return d['token']
+            return self.refresh()
+
+    def refresh(self):
+        log.info(f'requesting new auth token for dmed {self.url}')
+        rv = sessions.get(self.url).post(url=self.url + DMEDService.URL_GET_TOKEN, json=dict(
+            systemUsername=self.username,
+            systemPassword=self.password
+        ), timeout=4)
+        if rv.status_code != 200:
+            raise BadGateway(f'DMED auth error - {rv.status_code} {rv.text!r}')
+        token = rv.text
+        cache.set(self.key, dict(token=token, obtained_at=time.time()), self.TTL)
+        return token
+
+    def invalidate(self, token):
+        """Забывает токен, если его ещё не заменили на новый"""
+        d = cache.get(self.key)
+        if d and d['token'] == token:
+            cache.delete(self.key)
+
+
 class DMEDService:
     URL_GET_TOKEN = 'Authentication/SignInExternalApp'
     URL_GET_PERSONS = 'Person/GetPersons'
@@ -26,30 +146,31 @@ class DMEDService:
 
     def __init__(self, url, token=None, username=None, password=None):
         self.url = url
-        self.username = username
-        self.password = password
-        self.s = requests.Session()
-        if token:
-            self.token = token
-        elif not self.token:
-            self.token = self.obtain_token()
-        self.s.headers['Authorization'] = f'Bearer {self.token}'
+        self.tokens = DMEDTokenStore(url, username, password)
+        self._token = token
+        self.s = sessions.get(url)
 
     @property
     def token(self):
-        return cache.get('dmed_token')
-
-    @token.setter
-    def token(self, value):
-        cache.set('dmed_token', value, 60 * 60)
+        return self._token or self.tokens.get()
 
     def obtain_token(self):
-        log.info('requesting new auth token for dmed')
-        rv = requests.post(url=self.url + self.URL_GET_TOKEN, json=dict(
-            systemUsername=self.username,
-            systemPassword=self.password
-        ), timeout=4)
-        return rv.text
+        return self.tokens.refresh()
+
+    def post(self, url, headers=None, **kwargs):
+        """POST с авторизацией; на 401 один раз повторяет запрос с новым токеном"""
+        token = self.token
+        with metrics.timed('dmed'):
+            rv = self.s.post(url, headers=dict(headers or {}, Authorization=f'Bearer {token}'), **kwargs)
+        if rv.status_code == 401 and not self._token:
+            log.info(f'dmed token for {self.url} rejected, retrying with a new one')
+            self.tokens.invalidate(token)
+            data = kwargs.get('data')
+            if hasattr(data, 'seek'):
+                data.seek(0)
+            with metrics.timed('dmed'):
+                rv = self.s.post(url, headers=dict(headers or {}, Authorization=f'Bearer {self.token}'), **kwargs)
+        return rv
 
     def handle_response(self, rv):
         data = rv.json()
@@ -60,42 +181,67 @@ class DMEDService:
             raise BadGateway(f"DMED gateway error - {data.get('message')!r}")
         return data
 
-    def update_person(self, p):
-        """Заполняет пустой или обновляет существующий Person
-        :type p: core.models.Person"""
+    def fetch_person(self, iin):
+        """Ищет человека по ИИН, возвращает запись DMED или None"""
         url = self.url + self.URL_GET_PERSONS
-        payload = dict(iin=p.doc_id)
+        payload = dict(iin=iin)
 
         log.info(f'dmed person rq: POST {url}: {payload}')
-        rv = self.s.post(url, json=payload, timeout=4)
+        rv = self.post(url, json=payload, timeout=4)
 
         data = self.handle_response(rv)
         if data:
             r = data[0]
             if r.get('birthDate'):
                 r['birthDate'] = datetime.strptime(r['birthDate'], '%Y-%m-%dT%H:%M:%S')
+            return r
+
+    @staticmethod
+    def apply_person(p, r):
+        """:type p: core.models.Person"""
+        p.dmed_id = r['id']
+        p.first_name = r.get('firstName') or p.first_name
+        p.second_name = r.get('secondName') or p.second_name
+        p.last_name = r.get('lastName') or p.last_name
+        p.full_name = r.get('fullName') or p.full_name
+        p.birth_date = r.get('birthDate') or p.birth_date
+        sex_id = r.get('sexID')
+        if sex_id:
+            p.sex = p.Sex.FEMALE if sex_id in [2, 4, 6] else p.Sex.MALE
+        # p.nationality = r.get('nationalityID')
+
+        if r.get('citizenshipID') is not None:
+            try:
+                p.citizenship = refdata.country(r['citizenshipID'])
+            except Country.DoesNotExist:
+                p.citizenship, created = Country.objects.get_or_create(pk=r['citizenshipID'])
+
+        p.dmed_rpn_id = r.get('rpnID')
+        p.dmed_master_data_id = r.get('masterDataID')
 
-            p.dmed_id = r['id']
-            p.first_name = r.get('firstName') or p.first_name
-            p.second_name = r.get('secondName') or p.second_name
-            p.last_name = r.get('lastName') or p.last_name
-            p.full_name = r.get('fullName') or p.full_name
-            p.birth_date = r.get('birthDate') or p.birth_date
-            sex_id = r.get('sexID')
-            if sex_id:
-                p.sex = p.Sex.FEMALE if sex_id in [2, 4, 6] else p.Sex.MALE
-            # p.nationality = r.get('nationalityID')
-
-            if r.get('citizenshipID') is not None:
-                country, created = Country.objects.get_or_create(pk=r['citizenshipID'])
-                p.citizenship = country
-
-            p.dmed_rpn_id = r.get('rpnID')
-            p.dmed_master_data_id = r.get('masterDataID')
+    def update_person(self, p):
+        """Заполняет пустой или обновляет существующий Person
+        :type p: core.models.Person"""
+        r = self.fetch_person(p.doc_id)
+        if r:
+            self.apply_person(p, r)
             return True
         return False
 
-    def update_person_detail(self, p):
+    def fetch_person_detail(self, rpn_id):
+        url = self.url + self.URL_GET_PERSON_DETAIL
+
+        log.info(f'dmed person detail rq: POST {url}: {rpn_id}')
+        rv = self.post(
+            url,
+            data=io.StringIO(f'{rpn_id}'),
+            timeout=4,
+            headers={'content-type': 'application/json'}
+        )
+        return self.handle_response(rv)
+
+    @staticmethod
+    def apply_person_detail(p, data):
         """
         Типы адресов addressTypeID
         1 Не указано
@@ -105,40 +251,56 @@ class DMEDService:
         5 Адрес работы
         310013005 Место рождения
         :type p: core.models.Person"""
+        p.contact_numbers = data.get('phoneNumber') or p.contact_numbers
+        p.working_place = data.get('workPlaces') or p.working_place
+        for address in data.get('addresses', []):
+            if address.get('isMain') or address['addressTypeID'] == 2 and not p.residence_place:
+                # основной адрес или фактическое место жительства
+                p.residence_place = address['addressText']
+            elif address['addressTypeID'] == 5:
+                p.working_place = address['addressText']
+
+    def update_person_detail(self, p):
+        """:type p: core.models.Person"""
         if not p.dmed_rpn_id:
             log.info(f'{p} has no rpn id, cannot request details')
             return
 
-        url = self.url + self.URL_GET_PERSON_DETAIL
-
-        log.info(f'dmed person detail rq: POST {url}: {p.dmed_rpn_id}')
-        rv = self.s.post(
-            url,
-            data=io.StringIO(f'{p.dmed_rpn_id}'),
-            timeout=4,
-            headers={'content-type': 'application/json'}
-        )
-
-        data = self.handle_response(rv)
+        data = self.fetch_person_detail(p.dmed_rpn_id)
         if data:
-            p.contact_numbers = data.get('phoneNumber') or p.contact_numbers
-            p.working_place = data.get('workPlaces') or p.working_place
-            for address in data.get('addresses', []):
-                if address.get('isMain') or address['addressTypeID'] == 2 and not p.residence_place:
-                    # основной адрес или фактическое место жительства
-                    p.residence_place = address['addressText']
-                elif address['addressTypeID'] == 5:
-                    p.working_place = address['addressText']
+            self.apply_person_detail(p, data)
             return True
         return False
 
-    def update_person_markers(self, p):
-        """Добавляет недобавленные маркеры к Person (с автосохранением)
-        :type p: core.models.Person"""
+    def fetch_person_markers(self, dmed_id):
         url = self.url + self.URL_GET_MARKERS
-        payload = dict(personID=p.dmed_id, limit=1024)
+        payload = dict(personID=dmed_id, limit=1024)
         log.info(f'dmed markers rq: POST {url}: {payload}')
-        rv = self.s.post(url, json=payload, timeout=4)
-        d = self.handle_response(rv)['data']
-        for marker in d:
-            p.markers.update_or_create(id=marker['markerID'], defaults={'name': marker['markerName']})
+        rv = self.post(url, json=payload, timeout=4)
+        return self.handle_response(rv)['data']
+
+    @staticmethod
+    def apply_person_markers(p, markers):
+        """Приводит маркеры Person к списку из DMED одной транзакцией (с автосохранением)
+
+        Маркеры сохраняются одним upsert-ом, связи с анкетой - одной вставкой недостающих и одним удалением лишних.
+        Возвращает, сколько маркеров пришло и сколько связей добавлено и удалено.
+        :type p: core.models.Person"""
+        names = {m['markerID']: m['markerName'] for m in markers}
+        through = Marker.persons.through
+        with transaction.atomic():
+            bulk.upsert(
+                Marker, [Marker(id=i, name=n) for i, n in names.items()], conflict_fields=['id'], update_fields=['name']
+            )
+            current = set(through.objects.filter(person_id=p.pk).values_list('marker_id', flat=True))
+            added = names.keys() - current
+            removed = current - names.keys()
+            through.objects.bulk_create([through(person_id=p.pk, marker_id=i) for i in added], ignore_conflicts=True)
+            if removed:
+                through.objects.filter(person_id=p.pk, marker_id__in=removed).delete()
+        log.info(f'{p} markers synced: {len(names)} received, {len(added)} added, {len(removed)} removed')
+        return dict(received=len(names), added=len(added), removed=len(removed))
+
+    def update_person_markers(self, p):
+        """:type p: core.models.Person"""
+        return self.apply_person_markers(p, self.fetch_person_markers(p.dmed_id))
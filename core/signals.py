@@ -0,0 +1,19 @@
+"""Поддержка денормализованных полей в актуальном состоянии"""
+from django.db.models.signals import post_save, pre_delete
+from django.dispatch import receiver
+
+from core.models import CameraCapture, CheckpointPass
+
+
+@receiver(post_save, sender=CheckpointPass, dispatch_uid='camera_capture_pending_save')
+def checkpoint_pass_saved(sender, instance, **kwargs):
+    """Статус прохода изменился - захват выходит из очереди камеры или возвращается в неё"""
+    CameraCapture.objects.filter(checkpoint_pass=instance).update(
+        pending=instance.status == CheckpointPass.Status.NOT_PASSED
+    )
+
+
+@receiver(pre_delete, sender=CheckpointPass, dispatch_uid='camera_capture_pending_delete')
+def checkpoint_pass_deleted(sender, instance, **kwargs):
+    # связь с захватом обнулится (SET_NULL), и он снова ждёт досмотра
+    CameraCapture.objects.filter(checkpoint_pass=instance).update(pending=True)
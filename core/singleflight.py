@@ -0,0 +1,69 @@
+"""Объединение одновременных одинаковых операций между процессами (через кэш)
+
+Первый вызвавший run() с ключом выполняет функцию, остальные ждут её результата.
+"""
+import logging
+import time
+import uuid
+
+from django.core.cache import cache
+
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.05
+RESULT_TTL = 30
+
+
+class Failed(Exception):
+    """Операция упала у выполнявшего её процесса"""
+
+
+def run(key, fn, timeout):
+    """Выполняет fn один раз на всех для key и возвращает её результат (он должен сериализоваться)
+
+    :param timeout: сколько ждать результата чужого вызова; если не дождались - выполняем сами
+    """
+    lock_key = f'singleflight:{key}'
+    deadline = time.monotonic() + timeout
+    while True:
+        flight = uuid.uuid4().hex
+        if cache.add(lock_key, flight, timeout * 2):
+            return lead(key, lock_key, flight, fn)
+        flight = cache.get(lock_key)
+        # None - ведущий закончил между add и get: его результата не узнать, пробуем занять ключ снова
+        if flight is not None or time.monotonic() >= deadline:
+            break
+
+    while flight and time.monotonic() < deadline:
+        time.sleep(POLL_INTERVAL)
+        result = cache.get(result_key(key, flight))
+        if result is None and cache.get(lock_key) != flight:
+            # ведущий закончил между двумя чтениями (тогда результат уже есть) или пропал, не оставив его
+            result = cache.get(result_key(key, flight))
+            if result is None:
+                break
+        if result is not None:
+            ok, value = result
+            if not ok:
+                raise Failed(value)
+            return value
+
+    log.warning(f'gave up waiting for {key}, running it myself')
+    return fn()
+
+
+def result_key(key, flight):
+    return f'singleflight:{key}:{flight}'
+
+
+def lead(key, lock_key, flight, fn):
+    try:
+        value = fn()
+    except Exception as e:
+        cache.set(result_key(key, flight), (False, repr(e)), RESULT_TTL)
+        raise
+    else:
+        cache.set(result_key(key, flight), (True, value), RESULT_TTL)
+        return value
+    finally:
+        cache.delete(lock_key)
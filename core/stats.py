@@ -0,0 +1,33 @@
+"""Простые счётчики, общие для всех воркеров (хранятся в кэше)"""
+import logging
+
+from django.core.cache import cache
+
+log = logging.getLogger(__name__)
+
+PREFIX = 'stats:'
+
+
+def incr(name, delta=1):
+    key = PREFIX + name
+    try:
+        try:
+            cache.incr(key, delta)
+        except ValueError:
+            # счётчика ещё нет
+            cache.add(key, 0, None)
+            cache.incr(key, delta)
+    except Exception as e:
+        # метрики не должны ломать основной функционал
+        log.warning(f'cannot increment {name}: {e}')
+
+
+def observe(name, seconds):
+    """Фиксирует длительность операции: количество замеров и суммарное время в мс"""
+    incr(f'{name}_count')
+    incr(f'{name}_ms', int(seconds * 1000))
+
+
+def snapshot(*names):
+    values = cache.get_many([PREFIX + n for n in names])
+    return {n: values.get(PREFIX + n, 0) for n in names}
@@ -0,0 +1,150 @@
+"""Общее для тестов бюджетов запросов (api/tests.py, api2/tests.py, core/tests.py)
+
+seed() наполняет базу объёмами, близкими к боевым: КПП с камерами, тысячи захватов, люди с маркерами и проходами.
+QueryBudgetMixin.assertBudget() проверяет верхнюю границу числа SQL-запросов и времени блока и при превышении
+падает со списком выполненных запросов. DMEDStubMixin поднимает имитатор DMED (core.dmedstub) на время тестов класса.
+"""
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from core import dmed, dmedstub
+from core.models import (
+    Camera, CameraCapture, Checkpoint, CheckpointPass, Country, Marker, Person, PersonPassData, Region, User, Vehicle,
+    CITIZENSHIP_KZ,
+)
+
+BUDGET_SECONDS = 0.5  # на один запрос к API по умолчанию
+
+
+class Seed:
+    """Созданные seed() объекты"""
+
+
+def seed(checkpoints=2, cameras=2, captures=2000, persons_per_capture=2, markers=5, rnd=None):
+    """Наполняет базу массовыми вставками; половина захватов уже с проходами и температурой"""
+    rnd = rnd or random.Random(0)
+    s = Seed()
+    s.kz, _ = Country.objects.get_or_create(pk=CITIZENSHIP_KZ)
+    s.region = Region.objects.create(name='ТЕСТОВАЯ ОБЛАСТЬ', country=s.kz)
+    s.checkpoints = Checkpoint.objects.bulk_create([
+        Checkpoint(id=f'cp{i}', name=f'КПП {i}', region=s.region) for i in range(checkpoints)
+    ])
+    Camera.objects.bulk_create([
+        Camera(location=f'cam{i}-{j}', checkpoint=cp) for i, cp in enumerate(s.checkpoints) for j in range(cameras)
+    ])
+    s.cameras = list(Camera.objects.order_by('id'))
+    s.checkpoint = s.checkpoints[0]
+    s.camera = next(c for c in s.cameras if c.checkpoint_id == s.checkpoint.id)
+    s.markers = Marker.objects.bulk_create([Marker(id=i, name=f'маркер {i}') for i in range(markers)])
+
+    s.persons = Person.objects.bulk_create([
+        # как большинство анкет боевой базы - уже наполнены из DMED
+        Person(doc_id=dmedstub.random_iin(rnd), citizenship=s.kz, full_name=f'ЧЕЛОВЕК {i}', dmed_id=i + 1,
+               dmed_updated_at=timezone.now())
+        for i in range(captures * persons_per_capture // 2)
+    ])
+    if not s.persons[0].pk:
+        s.persons = list(Person.objects.order_by('id'))
+    Marker.persons.through.objects.bulk_create([
+        Marker.persons.through(person_id=p.pk, marker_id=m.pk) for p in s.persons for m in rnd.sample(s.markers, 2)
+    ])
+
+    s.vehicles = Vehicle.objects.bulk_create([Vehicle(grnz=f'{i:03}AAA{i % 20:02}') for i in range(captures // 4)])
+
+    now = timezone.now()
+    passes = CheckpointPass.objects.bulk_create([
+        CheckpointPass(checkpoint=s.checkpoints[i % checkpoints], vehicle=s.vehicles[i % len(s.vehicles)],
+                       status=CheckpointPass.Status.PASSED if i % 4 else CheckpointPass.Status.NOT_PASSED)
+        for i in range(captures // 2)
+    ])
+    if not passes[0].pk:
+        passes = list(CheckpointPass.objects.order_by('id'))
+
+    s.captures = []
+    links, pass_data = [], []
+    for i in range(captures):
+        camera = s.cameras[i % len(s.cameras)]
+        checkpoint_pass = passes[i // 2] if i % 2 else None
+        capture = CameraCapture(
+            id=uuid.uuid4(), camera=camera, vehicle=s.vehicles[i % len(s.vehicles)], raw_data='{}',
+            date=now - timedelta(seconds=captures - i), checkpoint_pass=checkpoint_pass,
+            pending=checkpoint_pass is None or checkpoint_pass.status == CheckpointPass.Status.NOT_PASSED,
+        )
+        s.captures.append(capture)
+        for person in rnd.sample(s.persons, persons_per_capture):
+            links.append(CameraCapture.persons.through(cameracapture_id=capture.id, person_id=person.pk))
+            if checkpoint_pass:
+                pass_data.append(PersonPassData(
+                    person=person, checkpoint_pass=checkpoint_pass, temperature=round(rnd.uniform(36, 38), 1)
+                ))
+    CameraCapture.objects.bulk_create(s.captures)
+    CameraCapture.persons.through.objects.bulk_create(links)
+    PersonPassData.objects.bulk_create(pass_data, ignore_conflicts=True)
+    s.passes = passes
+
+    s.inspector = User.objects.create_user('inspector', password='secret', checkpoint=s.checkpoint)
+    s.inspector.groups.add(Group.objects.get(name='inspectors'))
+    s.admin = User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+    return s
+
+
+class QueryBudgetMixin:
+    """assertBudget() для TestCase"""
+
+    @contextmanager
+    def assertBudget(self, queries, seconds=BUDGET_SECONDS):
+        with CaptureQueriesContext(connection) as context:
+            start = time.monotonic()
+            yield context
+            elapsed = time.monotonic() - start
+        if len(context) <= queries and elapsed <= seconds:
+            return
+        executed = '\n'.join(
+            f'{i}. ({q["time"]} s) {q["sql"]}' for i, q in enumerate(context.captured_queries, start=1)
+        )
+        self.fail(
+            f'over budget: {len(context)} queries (budget {queries}), {elapsed:.3f} s (budget {seconds} s)\n'
+            f'{executed}'
+        )
+
+    def assertGetBudget(self, url, queries, seconds=BUDGET_SECONDS, status=200, **params):
+        """GET по url укладывается в бюджет; первый запрос прогревает кэши (права, справочники)"""
+        self.client.get(url, params)
+        with self.assertBudget(queries, seconds):
+            r = self.client.get(url, params)
+        self.assertEqual(r.status_code, status, getattr(r, 'data', r.content))
+        return r
+
+
+class DMEDStubMixin:
+    """Имитатор DMED вместо настоящих регионов на время тестов класса"""
+    dmed_config = dmedstub.make_config(2, latency=0, jitter=0)
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.dmed_server, cls.dmed_simulator, url = dmedstub.serve(cls.dmed_config)
+        # внутри транзакции класса - откатятся вместе с его данными
+        cls.dmed_regions = [
+            Region.objects.create(name=f'stub {name}', dmed_url=f'{url}{name}/', dmed_priority=i)
+            for i, name in enumerate(cls.dmed_config['regions'])
+        ]
+        cls.dmed_patch = mock.patch.object(dmed, 'enabled_regions', lambda: cls.dmed_regions)
+        cls.dmed_patch.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dmed_patch.stop()
+        cls.dmed_server.shutdown()
+        cache.clear()
+        super().tearDownClass()
@@ -1,3 +1,497 @@
-from django.test import TestCase
+import io
+import socket
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
-# Create your tests here.
+import requests
+import urllib3
+from urllib3._collections import RecentlyUsedContainer
+from django.core.cache import cache
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+
+from core import bulk, dmed, dmedstub, egsv, health, ingest, loadtest, prefetch, refdata, routing, service, singleflight
+from core.models import (
+    Camera, CameraCapture, Checkpoint, CheckpointPass, Country, Marker, Person, Region, User, CITIZENSHIP_KZ,
+)
+from core.testing import DMEDStubMixin, QueryBudgetMixin, seed
+
+
+class QueryBudgetTestCase(DMEDStubMixin, QueryBudgetMixin, TestCase):
+    """Число SQL-запросов обработки событий камер, досмотра и поиска в DMED не зависит от объёма данных"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.s = seed()
+
+    def events(self, n, new_persons=0):
+        iins = [p.doc_id for p in self.s.persons[:3]] + [dmedstub.random_iin() for _ in range(new_persons)]
+        return [{
+            'id': uuid.uuid4().hex,
+            'body': {
+                'source': self.s.cameras[i % len(self.s.cameras)].location,
+                'number': f'{i:03}BBB01',
+                'latlng': [51.1, 71.4],
+                'iins': [{'iin': iin} for iin in iins],
+                'raw': {'event': {'uuid': str(uuid.uuid4()), 'time': '2020-05-12T10:00:00.000+0600'}},
+            },
+        } for i in range(n)]
+
+    def process(self, bodies):
+        # топология EGSV: камеры остаются на своих КПП
+        by_location = {c.location: c.checkpoint_id for c in self.s.cameras}
+        with mock.patch.object(ingest, 'fetch_camera_checkpoint', lambda loc: refdata.checkpoint(by_location[loc])):
+            ingest.process_events(bodies)
+
+    def test_process_events(self):
+        self.process(self.events(1))
+        for n in (1, 50):
+            with self.assertBudget(8, seconds=2):
+                self.process(self.events(n))
+
+    def test_process_events_new_persons(self):
+        # новые люди ищутся в DMED (имитатор) по одному, статистика опроса - в своей точке сохранения
+        with self.assertBudget(34, seconds=2):
+            self.process(self.events(1, new_persons=2))
+
+    def test_claim_next(self):
+        for _ in range(2):
+            with self.assertBudget(8):
+                checkpoint_pass = CameraCapture.claim_next(self.s.inspector, camera_id=self.s.camera.pk)
+            self.assertIsNotNone(checkpoint_pass)
+
+    def test_create_or_update_checkpoint_pass(self):
+        capture = CameraCapture.objects.filter(camera__checkpoint=self.s.checkpoint, checkpoint_pass=None).first()
+        for _ in range(2):
+            with self.assertBudget(8):
+                checkpoint_pass = capture.create_or_update_checkpoint_pass(self.s.inspector)
+        self.assertEqual(CheckpointPass.objects.filter(camera_capture=capture).get(), checkpoint_pass)
+
+    def test_ensure_person(self):
+        with self.assertBudget(18, seconds=2):
+            p = dmed.ensure_person(dmedstub.random_iin(), checkpoint=self.s.checkpoint)
+        self.assertTrue(p.pk)
+
+    def test_refdata(self):
+        for table in refdata.TABLES.values():
+            table.all()
+        with self.assertBudget(0):
+            refdata.checkpoint(self.s.checkpoint.pk)
+            refdata.country(self.s.kz.pk)
+            refdata.dmed_regions()
+
+
+class LoadReplayTestCase(TestCase):
+    """Копии записи для нагрузочного прогона не пересекаются, а повторы внутри копии сохраняются"""
+
+    def test_replay_scale(self):
+        event = {'at': 0, 'kind': 'event', 'body': {
+            'id': 'e', 'body': {
+                'source': 'cam', 'number': '001AAA01', 'latlng': [51.1, 71.4], 'iins': [{'iin': '1'}],
+                'raw': {'event': {'uuid': 'u', 'time': '2020-05-12T10:00:00.000+0600'}},
+            },
+        }}
+        records = [event, dict(event, at=1), {'at': 0.5, 'kind': 'api', 'session': 'i', 'path': '/api/v2/inspector'}]
+        synthesizer = loadtest.Synthesizer('test')
+        calls = loadtest.replay(records, synthesizer, scale=2, speed=2)
+
+        self.assertEqual([c.at for c in calls], [0, 0, 0.25, 0.25, 0.5, 0.5])
+        events = [b for c in calls for b in c.events]
+        for body in events:
+            ingest.validate(body)
+        self.assertEqual(len({b['id'] for b in events}), 4)
+        self.assertEqual(len({b['body']['raw']['event']['uuid'] for b in events}), 4)
+        self.assertEqual({b['body']['source'] for b in events}, {'load-test-cam'})
+        # у каждой копии свои номер и ИИН, одни и те же для обоих её событий
+        self.assertEqual(len({b['body']['number'] for b in events}), 2)
+        self.assertEqual(len({b['body']['iins'][0]['iin'] for b in events}), 2)
+        self.assertEqual(synthesizer.sessions, {'load-test-i-0', 'load-test-i-1'})
+
+    def test_synthesize_batch(self):
+        calls = loadtest.synthesize(loadtest.Synthesizer('test'), events=10, rate=10, inspectors=1, batch=4)
+        batches = [c for c in calls if c.kind == 'event']
+        self.assertEqual([len(c.events) for c in batches], [4, 4, 2])
+        self.assertEqual(len([c for c in calls if c.kind == 'api']), 1)
+
+
+class DMEDTestCase(DMEDStubMixin, TestCase):
+    """Поиск в DMED через имитатор"""
+
+    @classmethod
+    def setUpTestData(cls):
+        Country.objects.get_or_create(pk=CITIZENSHIP_KZ)
+
+    def test_route_stats_failure(self):
+        # ошибка статистики опроса (например, взаимная блокировка) не теряет найденную анкету
+        with mock.patch.object(routing, 'record', side_effect=DatabaseError('deadlock detected')):
+            p = dmed.ensure_person(dmedstub.random_iin())
+        self.assertTrue(Person.objects.get(pk=p.pk).dmed_id)
+
+    def test_route_stats_order(self):
+        regions = self.dmed_regions
+        with mock.patch.object(bulk, 'upsert') as upsert:
+            routing.record(['region:1', ''], [(regions[1], True, 0.1), (regions[0], False, 0.2)])
+        rows = upsert.call_args[0][1]
+        self.assertEqual(
+            [(s.context, s.region_id) for s in rows],
+            [('', regions[0].id), ('', regions[1].id), ('region:1', regions[0].id), ('region:1', regions[1].id)],
+        )
+
+
+    def test_half_open_trial_kept_for_unqueried_region(self):
+        # второй регион полуоткрыт, но до него очередь не дошла: пробный запрос остаётся за ним
+        first, second = self.dmed_regions
+        iin = next(iin for iin in iter(dmedstub.random_iin, None) if self.dmed_simulator.owner(iin) == 'region-0')
+        url = second.dmed_url
+        cache.set(health.breaker_key(url), dict(until=time.time() - 1), None)
+        self.addCleanup(cache.delete_many, [health.breaker_key(url), f'dmed_breaker_trial:{url}'])
+        with mock.patch.object(routing, 'waves', lambda regions, ctxs: [[first], [second]]):
+            self.assertTrue(dmed.ensure_person(iin).dmed_id)
+        self.assertEqual(health.state(url), health.HALF_OPEN)
+        self.assertTrue(health.allow(url))
+
+
+    def test_stale_refresh_bounded(self):
+        # после выкладки устарели все анкеты: в фоне обновляется не больше DMED_REFRESH_QUEUE
+        persons = [Person(pk=10 ** 6 + i, doc_id=dmedstub.random_iin()) for i in range(5)]
+        self.addCleanup(cache.delete_many, [f'dmed_refresh:{p.pk}' for p in persons])
+        slots = threading.BoundedSemaphore(2)
+        with mock.patch.object(dmed, 'refresh_slots', slots), \
+                mock.patch.object(dmed, 'refresh_executor') as refresh_executor:
+            dmed.refresh_if_stale(persons[0])
+            dmed.refresh_if_stale(persons[0])  # уже обновляется
+            for p in persons[1:]:
+                dmed.refresh_if_stale(p)
+        self.assertEqual([c[0][1] for c in refresh_executor.submit.call_args_list], [persons[0].pk, persons[1].pk])
+
+
+class DMEDServiceTestCase(TestCase):
+    """Токены DMED и повтор запроса на 401 против имитатора"""
+    AUTH = ('region-0', service.DMEDService.URL_GET_TOKEN)
+    DETAIL = ('region-0', service.DMEDService.URL_GET_PERSON_DETAIL)
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.dmed_server, cls.dmed_simulator, url = dmedstub.serve(dmedstub.make_config(1, latency=0.1, jitter=0))
+        cls.url = f'{url}region-0/'
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dmed_server.shutdown()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.dmed_simulator.calls.clear()
+        self.tokens = service.DMEDTokenStore(self.url, 'login', 'password')
+        self.addCleanup(cache.delete_many, [self.tokens.key, self.tokens.lock_key])
+        cache.delete_many([self.tokens.key, self.tokens.lock_key])
+
+    def test_first_token(self):
+        # токена нет: за ним идёт один поток, остальные ждут его
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            tokens = list(executor.map(lambda i: self.tokens.get(), range(5)))
+        self.assertEqual(len(set(tokens)), 1)
+        self.assertEqual(self.dmed_simulator.calls[self.AUTH], 1)
+
+    def test_proactive_refresh(self):
+        obtained_at = time.time() - (self.tokens.TTL - self.tokens.REFRESH_BEFORE) - 1
+        cache.set(self.tokens.key, dict(token='stub-old', obtained_at=obtained_at))
+
+        # токен обновляет другой воркер: отдаём старый, не дожидаясь
+        lock = cache.lock(self.tokens.lock_key, timeout=10)
+        lock.acquire()
+        self.assertEqual(self.tokens.get(), 'stub-old')
+        self.assertEqual(self.dmed_simulator.calls[self.AUTH], 0)
+        lock.release()
+
+        token = self.tokens.get()
+        self.assertNotEqual(token, 'stub-old')
+        self.assertEqual(self.dmed_simulator.calls[self.AUTH], 1)
+        self.assertEqual(self.tokens.get(), token)
+
+    def test_retry_on_401(self):
+        # отозванный токен: забываем его, получаем новый и повторяем запрос с начала тела
+        cache.set(self.tokens.key, dict(token='revoked', obtained_at=time.time()))
+        dmed_service = service.DMEDService(self.url, username='login', password='password')
+        rv = dmed_service.post(self.url + service.DMEDService.URL_GET_PERSON_DETAIL, data=io.BytesIO(b'42'), timeout=4)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(self.dmed_simulator.calls[self.DETAIL], 2)
+        self.assertEqual(self.dmed_simulator.calls[self.AUTH], 1)
+        self.assertTrue(cache.get(self.tokens.key)['token'].startswith('stub-'))
+
+    def test_single_retry(self):
+        dmed_service = service.DMEDService(self.url, username='login', password='password')
+        cache.set(self.tokens.key, dict(token='stub-token', obtained_at=time.time()))
+        with mock.patch.object(dmed_service, 's') as session:
+            session.post.return_value = mock.Mock(status_code=401)
+            rv = dmed_service.post(self.url + service.DMEDService.URL_GET_PERSONS, json={})
+        self.assertEqual(rv.status_code, 401)
+        self.assertEqual(session.post.call_count, 2)
+
+
+class PersonMarkersTestCase(TestCase):
+    def test_apply_person_markers(self):
+        Country.objects.get_or_create(pk=CITIZENSHIP_KZ)
+        p = Person.objects.create(doc_id=dmedstub.random_iin(), citizenship_id=CITIZENSHIP_KZ)
+        Marker.objects.create(id=1, name='старое имя')
+
+        def sync(*ids):
+            return service.DMEDService.apply_person_markers(
+                p, [dict(markerID=i, markerName=f'Маркер {i}') for i in ids]
+            )
+
+        self.assertEqual(sync(1, 2), dict(received=2, added=2, removed=0))
+        self.assertEqual(Marker.objects.get(id=1).name, 'Маркер 1')
+        # добавлен 3, снят 1
+        self.assertEqual(sync(2, 3), dict(received=2, added=1, removed=1))
+        self.assertEqual(sorted(p.markers.values_list('id', flat=True)), [2, 3])
+        self.assertEqual(sync(2, 3), dict(received=2, added=0, removed=0))
+
+
+class SessionPoolTestCase(TestCase):
+    def test_stats(self):
+        server, simulator, url = dmedstub.serve(dmedstub.make_config(1, latency=0, jitter=0))
+        self.addCleanup(server.shutdown)
+        pool = service.SessionPool(pool_size=4, retries=0, backoff=0)
+        manager = pool.get(url).get_adapter(url).poolmanager
+        # два пула одного региона: по адресу и по имени хоста (адаптер держит один, здесь - оба)
+        manager.pools = RecentlyUsedContainer(2)
+        for host in ('127.0.0.1', 'localhost'):
+            manager.connection_from_url(f'http://{host}:{server.server_port}/').urlopen(
+                'POST', '/region-0/' + service.DMEDService.URL_GET_TOKEN, body=b'{}'
+            )
+        self.assertEqual(pool.stats()[url], dict(connections_opened=2, requests=2, idle=2, busy=0, maxsize=8))
+
+    def test_connect_retries(self):
+        # порт закрыт: соединение повторяется, запрос до сервера не дошёл
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            url = f'http://127.0.0.1:{sock.getsockname()[1]}/'
+        pool = service.SessionPool(pool_size=1, retries=2, backoff=0)
+        with mock.patch.object(urllib3.util.connection, 'create_connection',
+                               wraps=urllib3.util.connection.create_connection) as connect:
+            with self.assertRaises(requests.ConnectionError):
+                pool.get(url).post(url, timeout=1)
+        self.assertEqual(connect.call_count, 3)
+
+    def test_no_read_retries(self):
+        # сервер принял запрос и оборвал соединение: запрос мог выполниться, не повторяем
+        received = []
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen()
+        self.addCleanup(sock.close)
+
+        def serve():
+            while True:
+                try:
+                    conn, _ = sock.accept()
+                except OSError:
+                    return
+                received.append(conn.recv(65536))
+                conn.close()
+
+        threading.Thread(target=serve, daemon=True).start()
+        url = f'http://127.0.0.1:{sock.getsockname()[1]}/'
+        pool = service.SessionPool(pool_size=1, retries=2, backoff=0)
+        with self.assertRaises(requests.ConnectionError):
+            pool.get(url).post(url, data=b'{}', timeout=1)
+        self.assertEqual(len(received), 1)
+
+
+class HealthTestCase(TestCase):
+    def setUp(self):
+        self.url = f'http://dmed-{uuid.uuid4().hex[:8]}/'
+
+    def test_p95(self):
+        for seconds in range(1, 11):
+            health.record(self.url, seconds, True)
+        self.assertEqual(health.p95(self.url, 0), 10)
+
+    def test_concurrent_record(self):
+        window = health.window
+
+        def slow_window(url):
+            w = window(url)
+            time.sleep(0.001)  # другие потоки успевают прочитать то же окно
+            return w
+
+        with mock.patch.object(health, 'window', slow_window), ThreadPoolExecutor(max_workers=8) as executor:
+            list(executor.map(lambda i: health.record(self.url, 0.1, True), range(40)))
+        self.assertEqual(len(health.window(self.url)), 40)
+
+
+class SingleflightTestCase(TestCase):
+    def setUp(self):
+        self.key = f'test:{uuid.uuid4().hex}'
+
+    def test_concurrent_run(self):
+        calls = []
+
+        def fn():
+            calls.append(1)
+            time.sleep(0.2)
+            return 42
+
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            results = list(executor.map(lambda i: singleflight.run(self.key, fn, timeout=5), range(5)))
+        self.assertEqual(results, [42] * 5)
+        self.assertEqual(len(calls), 1)
+
+    def test_leader_finished_between_reads(self):
+        # ведущий закончил после чтения результата, но до проверки ключа: результат уже в кэше
+        lock_key = f'singleflight:{self.key}'
+        cache.set(singleflight.result_key(self.key, 'f1'), (True, 42))
+        reads = Counter()
+
+        def get(key, default=None):
+            reads[key] += 1
+            if key == lock_key:
+                return 'f1' if reads[key] == 1 else None
+            if reads[key] == 1:
+                return None
+            return cache.get(key, default)
+
+        fake = mock.Mock(add=mock.Mock(return_value=False), get=get)
+        fn = mock.Mock(return_value=0)
+        with mock.patch.object(singleflight, 'cache', fake):
+            self.assertEqual(singleflight.run(self.key, fn, timeout=5), 42)
+        fn.assert_not_called()
+
+
+class TopologyTestCase(TestCase):
+    def test_concurrent_miss(self):
+        # холодный кэш: одновременные запросы и воркеры ходят в EGSV один раз
+        self.addCleanup(cache.delete, egsv.CACHE_KEY)
+        cache.delete(egsv.CACHE_KEY)
+        calls = []
+
+        def get(url, headers, timeout):
+            calls.append(url)
+            time.sleep(0.2)
+            return mock.Mock(status_code=200, headers={}, json=lambda: {'checkpoints': {
+                'cp0': {'name': 'КПП 0', 'parent': None, 'sources': ['cam0']},
+            }})
+
+        topology = egsv.TopologyCache(url='http://egsv/checkpoints', refresh_interval=3600, max_age=3600)
+        with mock.patch.object(egsv.requests, 'get', get), ThreadPoolExecutor(max_workers=5) as executor:
+            results = list(executor.map(lambda i: topology.get().checkpoint_id('cam0'), range(5)))
+        self.assertEqual(results, ['cp0'] * 5)
+        self.assertEqual(len(calls), 1)
+
+
+class MetricsViewTestCase(TestCase):
+    @override_settings(METRICS_TOKEN=None, DEBUG=False)
+    def test_without_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.client.force_login(User.objects.create_user('metrics-staff', is_staff=True))
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_token(self):
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+
+class IngestTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.checkpoint = Checkpoint.objects.create(id='cp0', name='КПП 0')
+        Camera.objects.create(location='cam0', checkpoint=cls.checkpoint)
+
+    def event(self, iin):
+        return {
+            'id': uuid.uuid4().hex,
+            'body': {
+                'source': 'cam0', 'number': '001AAA01', 'latlng': [51.1, 71.4], 'iins': [{'iin': iin}],
+                'raw': {'event': {'uuid': str(uuid.uuid4()), 'time': '2020-05-12T10:00:00.000+0600'}},
+            },
+        }
+
+    def test_enrich_existing_person(self):
+        # анкету создал другой воркер (или прошлая попытка), но из DMED не наполнил; ошибка DMED не роняет обработку
+        person = Person.objects.create(doc_id=dmedstub.random_iin(), citizenship_id=CITIZENSHIP_KZ)
+        with mock.patch.object(ingest, 'fetch_camera_checkpoint', lambda location: self.checkpoint), \
+                mock.patch.object(dmed, 'ensure_person', side_effect=ConnectionError) as ensure_person:
+            ingest.process_events([self.event(person.doc_id)])
+        ensure_person.assert_called_once_with(person.doc_id, CITIZENSHIP_KZ, checkpoint=self.checkpoint)
+        self.assertTrue(CameraCapture.objects.filter(persons=person).exists())
+
+
+class RefdataTestCase(TestCase):
+    """Изменение справочника видно другим процессам: их копия (здесь - отдельная Table) перечитывается"""
+
+    def setUp(self):
+        # транзакция теста не коммитится - версию увеличиваем сразу; сверка версии - при каждом обращении
+        for patch in (mock.patch.object(refdata.transaction, 'on_commit', lambda fn: fn()),
+                      mock.patch.object(refdata, 'CHECK_INTERVAL', 0)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        for table in refdata.TABLES.values():
+            self.addCleanup(table.invalidate)
+
+    def assertReloaded(self, model, change):
+        other = refdata.Table(model)
+        other.all()
+        version = cache.get(other.key)
+        obj = change()
+        self.assertGreater(cache.get(other.key), version)
+        rows = other.all()
+        if obj.pk in rows:
+            self.assertEqual(rows[obj.pk].name, obj.name)
+        else:
+            self.assertFalse(model.objects.filter(pk=obj.pk).exists())
+
+    def test_save_and_delete(self):
+        kz, _ = Country.objects.get_or_create(pk=CITIZENSHIP_KZ, defaults={'name': 'Казахстан'})
+        region = Region.objects.create(name='ОБЛАСТЬ', country=kz)
+        checkpoint = Checkpoint.objects.create(id='cp-refdata', name='КПП', region=region)
+
+        def rename(obj):
+            obj.name = f'{obj.name} (новое имя)'
+            obj.save()
+            return obj
+
+        def delete(obj):
+            pk = obj.pk
+            obj.delete()
+            obj.pk = pk
+            return obj
+
+        for obj in (kz, region, checkpoint):
+            self.assertReloaded(type(obj), lambda: rename(obj))
+        for obj in (checkpoint, region):
+            self.assertReloaded(type(obj), lambda: delete(obj))
+        self.assertIsNone(refdata.checkpoint('cp-refdata'))
+
+
+class PrefetchTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.checkpoint = Checkpoint.objects.create(id='cp0', name='КПП 0')
+
+    def test_checkpoint_column(self):
+        iin = dmedstub.random_iin()
+        rows = prefetch.read(io.StringIO(f'iin,checkpoint\n{iin}, cp0 \n'), 'list.csv')
+        self.assertEqual(rows, [(iin, 'cp0')])
+
+        # поток пула не видит транзакцию теста - справочник загружается заранее и сбрасывается после отката
+        refdata.checkpoint('cp0')
+        self.addCleanup(refdata.checkpoints.invalidate)
+        calls = []
+        with mock.patch.object(prefetch, 'prefetch_person', lambda iin, checkpoint, limiter: calls.append(checkpoint)):
+            prefetch.run(rows, workers=1)
+        self.assertEqual(calls, [self.checkpoint])
+
+    def test_rate_limiter(self):
+        # общий на все потоки наполнения: 6 анкет при 50 в секунду - не быстрее 0.1 с
+        limiter = prefetch.RateLimiter(50)
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            list(executor.map(lambda i: limiter.wait(), range(6)))
+        self.assertGreaterEqual(time.monotonic() - start, 0.1)
@@ -1,12 +1,15 @@
+import hmac
 import os
 
-from django.http import HttpResponse, JsonResponse
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
 from django.shortcuts import render
 import requests
 
 # Create your views here.
 from django.views.decorators.csrf import csrf_exempt
 
+from core import metrics
 from meduserstore.settings import BASE_DIR
 
 @csrf_exempt
@@ -20,3 +23,24 @@ def validate_merchant(request):
             "initiativeContext": "wopay.tk"
         }, cert=(os.path.join(BASE_DIR, 'merchantId.crt.pem'), os.path.join(BASE_DIR, 'merchantId.key.pem')))
         return JsonResponse(rs.json())
+
+
+def metrics_view(request):
+    """Метрики всех процессов в формате Prometheus
+
+    Доступ - по METRICS_TOKEN (Authorization: Bearer <токен>) или сотрудникам; без токена в настройках
+    и не сотрудникам - только при DEBUG.
+    """
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def metrics_allowed(request):
+    if settings.METRICS_TOKEN:
+        auth = request.META.get('HTTP_AUTHORIZATION', '')
+        if hmac.compare_digest(auth.encode(), f'Bearer {settings.METRICS_TOKEN}'.encode()):
+            return True
+    elif settings.DEBUG:
+        return True
+    return request.user.is_authenticated and request.user.is_staff
@@ -57,6 +57,7 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'django.contrib.postgres',
     'rest_framework',
+    'rest_framework.authtoken',
     'django_filters',
     'corsheaders',
     'channels',
@@ -72,15 +73,54 @@ AUTH_USER_MODEL = 'core.User'
 # rest_framework
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.BasicAuthentication',
+        # Basic - для старых клиентов, новые меняют логин и пароль на токен (core.auth)
+        'core.auth.CachedBasicAuthentication',
+        'core.auth.CachedTokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
     ],
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend']
 }
 
 # core
+AUTH_CACHE_TTL = int(os.environ.get('AUTH_CACHE_TTL', 60 * 5))  # сколько помнить проверенные токены, пароли, пользователей и их права
+AUTH_TOKEN_LIFETIME = int(os.environ.get('AUTH_TOKEN_LIFETIME', 0))  # секунд жизни токена API, 0 - бессрочно
+API_FAST_SERIALIZERS = os.environ.get('API_FAST_SERIALIZERS', '1') == '1'  # списки захватов и проходов api2 без DRF (api2.fastserializers)
 DMED_LOGIN = os.environ['DMED_LOGIN']
 DMED_PASSWORD = os.environ['DMED_PASSWORD']
+DMED_POOL_SIZE = int(os.environ.get('DMED_POOL_SIZE', 20))  # keep-alive соединений на регион в процессе
+DMED_CONNECT_RETRIES = 2
+DMED_RETRY_BACKOFF = 0.1  # секунд, удваивается с каждым повтором
+DMED_MAX_CONCURRENCY = int(os.environ.get('DMED_MAX_CONCURRENCY', 32))  # одновременных запросов к DMED в процессе
+DMED_PREFETCH_RATE = float(os.environ.get('DMED_PREFETCH_RATE', 10))  # анкет в секунду при наполнении по спискам, 0 - без ограничения
+DMED_NEGATIVE_TTL = int(os.environ.get('DMED_NEGATIVE_TTL', 60 * 10))  # не переспрашиваем регион, не знающий ИИН
+DMED_ERROR_TTL = 60  # не переспрашиваем регион, ответивший на запрос ИИН ошибкой
+DMED_FRESHNESS = int(os.environ.get('DMED_FRESHNESS', 60 * 60 * 24))  # после этого анкета обновляется в фоне
+DMED_REFRESH_WORKERS = 4  # потоков фонового обновления анкет в процессе
+DMED_REFRESH_QUEUE = 100  # сколько анкет процесс обновляет и держит в очереди, остальные - при следующем запросе
+DMED_ROUTING_MIN_HITS = 20  # сколько находок нужно с места запроса, чтобы опрашивать регионы волнами
+DMED_ROUTING_CONFIDENCE = 0.9  # какую долю находок должна покрывать первая волна регионов
+DMED_HEDGE_DEFAULT = 1.0  # секунд ожидания волны регионов до запуска следующей, пока нет статистики задержек
+DMED_HEDGE_MIN = 0.1
+DMED_BREAKER_MIN_SAMPLES = 5  # сколько последних запросов нужно, чтобы разомкнуть выключатель региона
+DMED_BREAKER_ERROR_RATE = 0.5  # при какой доле ошибок среди них
+DMED_BREAKER_COOLDOWN = 30  # секунд регион не опрашивается после размыкания
+DMED_SINGLEFLIGHT_TIMEOUT = 15  # сколько ждать чужого запроса того же человека в DMED
+
+EGSV_CHECKPOINTS_URL = os.environ.get('EGSV_CHECKPOINTS_URL', 'https://application-rubezh.egsv.kz/checkpoints?sources=1')
+EGSV_TOPOLOGY_REFRESH_INTERVAL = int(os.environ.get('EGSV_TOPOLOGY_REFRESH_INTERVAL', 60))  # секунд
+EGSV_TOPOLOGY_MAX_AGE = int(os.environ.get('EGSV_TOPOLOGY_MAX_AGE', 60 * 10))  # секунд
+
+# метрики (core.metrics, /metrics)
+METRICS_FLUSH_INTERVAL = 5  # секунд между записями накопленных значений процесса в кэш
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # /metrics с Authorization: Bearer <токен>; без него - сотрудникам
+SLOW_REQUEST_THRESHOLD = float(os.environ.get('SLOW_REQUEST_THRESHOLD', 1))  # секунд, дольше - в лог со списком SQL
+
+# очередь событий с камер (manage.py ingest_captures)
+CAPTURE_INGEST_WORKERS = int(os.environ.get('CAPTURE_INGEST_WORKERS', 4))
+CAPTURE_INGEST_SHARDS = 64  # не менять на работающей очереди - нарушит порядок событий камер
+CAPTURE_INGEST_LEASE = 60  # секунд на обработку взятой пачки
+CAPTURE_INGEST_MAX_ATTEMPTS = 8
+CAPTURE_INGEST_RETENTION = 60 * 60 * 24  # сколько хранить обработанные события, секунд
 
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_HOST = 'smtp.gmail.com'
@@ -132,12 +172,14 @@ LOGGING = {
 
 
 MIDDLEWARE = [
+    'core.middleware.MetricsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.middleware.AuthzMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -177,7 +219,7 @@ CHANNEL_LAYERS = {
 
 CACHES = {
     'default': {
-        'BACKEND': 'redis_cache.RedisCache',
+        'BACKEND': 'core.cache.RedisCache',
         'LOCATION': [
             os.environ['REDIS_DSN'],
         ],
@@ -27,6 +27,7 @@ def index(request):
 urlpatterns = [
     path('', index),
     path('applepay/session', views.validate_merchant),
+    path('metrics', views.metrics_view),
     path('admin/', admin.site.urls),
     path('api/v2/', include('api2.urls')),
     path('api/', include('api.urls')),